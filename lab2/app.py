@@ -1,37 +1,89 @@
+import argparse
+import json
+import time
 from typing import List, Dict
 
-import redis
-from flask import Flask, request
+from flask import Flask, Response, g, request
 from flask_smorest import abort
+from werkzeug.exceptions import HTTPException
 
+from domain.config import create_redis
 from domain.db import seed_db, start_listeners
+from domain.inbox_push import (
+    DELIVERY_ID_PATTERN,
+    MAX_WAIT_SECONDS,
+    SSE_HEARTBEAT_SECONDS,
+    inbox_waiters,
+)
+from domain.pub_sub_listeners import CacheInvalidationListener, InboxDeliveryListener
 from domain.exceptions import (
     UsernameNotFoundException,
     AlreadyLoggedInException,
     NotLoggedInException,
+    RateLimitException,
 )
 from domain.message import (
     create_message,
     RawMessage,
     Message,
+    DeliveredMessage,
     UserMessagingStats,
     fetch_messaging_stats_for_user,
     fetch_most_spamming_users,
     fetch_online_users,
     fetch_user_inbound_messages,
+    wait_for_inbound_messages,
     fetch_highest_activity_stats,
     fetch_event_journal,
+    fetch_pipeline_gauges,
 )
+from domain.metrics import MetricsBuffer, MetricsFlusher, render_metrics
+from domain.rate_limit import admit_message
+from domain.read_cache import fetch_read_cache_counters
 from domain.user import login_user, logout_user
 
 app = Flask(__name__)
 
 app.secret_key = "not_safe"
-# Create a connection instance to redis.
-r = redis.Redis("127.0.0.1", decode_responses=True)
+# Create a connection instance to redis, see domain.config for the LAB2_REDIS_* settings.
+# Importing the app doesn't write to Redis, so any number of replicas can share one.
+r = create_redis()
+
+# Keep the read caches of this process in sync with the other processes
+CacheInvalidationListener(r).start()
+# A single subscription wakes every push request of this process
+InboxDeliveryListener(r).start()
+# Request timings are written to Redis in the background, not by every request
+request_metrics = MetricsBuffer()
+MetricsFlusher(r, request_metrics).start()
+
+
+@app.errorhandler(HTTPException)
+def handle_http_exception(error: HTTPException):
+    """ Render errors as JSON with the message and the headers given to flask_smorest's abort. """
+    data = getattr(error, "data", None) or {}
+    payload = dict(code=error.code, status=error.name)
+    if "message" in data:
+        payload["message"] = data["message"]
+    return payload, error.code, data.get("headers", {})
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
 
-r.flushall()
-seed_db(r)
+
+@app.after_request
+def record_request_duration(response):
+    """ Keep per-route request timings for the /metrics endpoint. """
+    duration = time.perf_counter() - g.request_started_at
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_metrics.observe(
+        "http_request_duration_seconds",
+        [duration],
+        labels=dict(route=route, method=request.method, status=response.status_code),
+    )
+    return response
 
 
 @app.route("/login", methods=["POST"])
@@ -79,6 +131,11 @@ def send_message() -> Message:
     content: str = request.json["content"]
     message: RawMessage = dict(sender=sender, recipient=recipient, content=content)
 
+    try:
+        admit_message(r, sender)
+    except RateLimitException as exc:
+        abort(429, message=str(exc), headers={"Retry-After": str(exc.retry_after)})
+
     message_id: int = create_message(r, message)
     return dict(id=message_id, **message)
 
@@ -91,6 +148,50 @@ def get_inbound_messages():
     return dict(inbound_messages=inbound_messages)
 
 
+@app.route("/inbound-messages/wait", methods=["GET"])
+def wait_for_new_inbound_messages():
+    """ Long-poll for messages delivered to the user after the "after" delivery id. """
+    username: str = request.args.get("username")
+    if not username:
+        abort(400, message="Missing 'username' in the query string")
+    after: str = request.args.get("after", "0")
+    if not DELIVERY_ID_PATTERN.fullmatch(after):
+        abort(400, message="'after' must be a delivery id")
+    timeout: float = request.args.get("timeout", MAX_WAIT_SECONDS, type=float)
+    inbound_messages: List[DeliveredMessage] = wait_for_inbound_messages(
+        r, username, after, timeout
+    )
+    return dict(inbound_messages=inbound_messages)
+
+
+@app.route("/inbound-messages/stream", methods=["GET"])
+def stream_inbound_messages():
+    """ Push messages delivered to the user as server-sent events, resuming after the "Last-Event-ID" delivery id. """
+    username: str = request.args.get("username")
+    if not username:
+        abort(400, message="Missing 'username' in the query string")
+    after: str = request.headers.get("Last-Event-ID") or request.args.get("after", "0")
+    if not DELIVERY_ID_PATTERN.fullmatch(after):
+        abort(400, message="'Last-Event-ID' must be a delivery id")
+
+    def events(after: str):
+        while True:
+            inbound_messages = wait_for_inbound_messages(
+                r, username, after, SSE_HEARTBEAT_SECONDS
+            )
+            if not inbound_messages:
+                yield ": keep-alive\n\n"
+            for message in inbound_messages:
+                after = message["delivery_id"]
+                yield f"id: {after}\nevent: message\ndata: {json.dumps(message)}\n\n"
+
+    return Response(
+        events(after),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/user-stats", methods=["GET"])
 def get_message_stats():
     """ Get user's messages by status. """
@@ -127,6 +228,31 @@ def get_event_journal():
     return dict(events=events)
 
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """ Get queue depth, messages by status, spam-check and request latencies in the Prometheus format. """
+    # Include this process's latest requests
+    request_metrics.flush(r)
+    gauges: Dict[str, int] = fetch_pipeline_gauges(r)
+    gauges["inbox_waiting_requests"] = inbox_waiters.count()
+    metrics: str = render_metrics(r, gauges, local_counters=fetch_read_cache_counters())
+    return Response(metrics, mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
-    start_listeners(r)
-    app.run()
+    # Development server with everything in one process. In production run the app with e.g.
+    # "gunicorn -w 4 app:app" and listeners.py/worker.py as separate processes.
+    parser = argparse.ArgumentParser(description="Run the development server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--no-listeners",
+        action="store_true",
+        help="Don't process the queue in this process, e.g. when listeners.py or worker.py run",
+    )
+    args = parser.parse_args()
+
+    seed_db(r)
+    if not args.no_listeners:
+        start_listeners(r)
+    app.run(args.host, args.port, threaded=True)
@@ -0,0 +1,125 @@
+"""
+Compare message encodings: bytes per message and encode/decode time.
+
+    python -m bench.codec_benchmark --messages 10000
+    python -m bench.codec_benchmark --redis-url redis://127.0.0.1:6379/15
+
+With --redis-url the messages are also written to Redis, once into a single JSON hash (the old
+layout) and once into bucketed hashes per codec, and the memory used by each layout is reported.
+The given database is flushed.
+"""
+import argparse
+import json
+import random
+import string
+import time
+from typing import List
+
+from domain.codec import CODECS, get_codec, msgpack
+from domain.redis_structures import MESSAGE_BUCKET_SIZE
+
+USERNAMES = ["Alice", "Malory", "flain1", "Ilya"]
+
+
+def generate_messages(count: int) -> List[dict]:
+    rnd = random.Random(422)
+    words = [
+        "".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(2, 9)))
+        for _ in range(500)
+    ]
+    return [
+        dict(
+            sender=rnd.choice(USERNAMES),
+            recipient=rnd.choice(USERNAMES),
+            content=" ".join(rnd.choices(words, k=rnd.randint(3, 12))),
+        )
+        for _ in range(count)
+    ]
+
+
+def benchmark_legacy_json(messages: List[dict]) -> dict:
+    start = time.perf_counter()
+    encoded = [json.dumps(message) for message in messages]
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in encoded:
+        json.loads(data)
+    decode_time = time.perf_counter() - start
+    return dict(
+        bytes_per_message=sum(len(data.encode()) for data in encoded) / len(messages),
+        encode_us=encode_time / len(messages) * 1e6,
+        decode_us=decode_time / len(messages) * 1e6,
+    )
+
+
+def benchmark_codec(name: str, messages: List[dict]) -> dict:
+    codec = get_codec(name)
+    start = time.perf_counter()
+    encoded = [codec.tag + codec.encode(message) for message in messages]
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in encoded:
+        codec.decode(data[1:])
+    decode_time = time.perf_counter() - start
+    return dict(
+        bytes_per_message=sum(len(data) for data in encoded) / len(messages),
+        encode_us=encode_time / len(messages) * 1e6,
+        decode_us=decode_time / len(messages) * 1e6,
+    )
+
+
+def measure_redis_memory(redis_url: str, messages: List[dict], codecs: List[str]) -> dict:
+    from redis import Redis
+
+    r = Redis.from_url(redis_url)
+    memory = {}
+
+    r.flushdb()
+    p = r.pipeline(transaction=False)
+    for message_id, message in enumerate(messages, start=1):
+        p.hset("message", message_id, json.dumps(message))
+    p.execute()
+    memory["legacy_json"] = r.memory_usage("message", samples=0) / len(messages)
+
+    for name in codecs:
+        codec = get_codec(name)
+        r.flushdb()
+        p = r.pipeline(transaction=False)
+        for message_id, message in enumerate(messages, start=1):
+            bucket = f"message:{message_id // MESSAGE_BUCKET_SIZE}"
+            p.hset(bucket, message_id, codec.tag + codec.encode(message))
+        p.execute()
+        total = sum(r.memory_usage(key, samples=0) for key in r.scan_iter("message:*"))
+        memory[name] = total / len(messages)
+    r.flushdb()
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--redis-url", default=None)
+    args = parser.parse_args()
+
+    messages = generate_messages(args.messages)
+    codecs = [name for name in CODECS if name != "msgpack" or msgpack is not None]
+
+    results = {"legacy_json": benchmark_legacy_json(messages)}
+    for name in codecs:
+        results[name] = benchmark_codec(name, messages)
+
+    if args.redis_url:
+        memory = measure_redis_memory(args.redis_url, messages, codecs)
+        for name, bytes_per_message in memory.items():
+            results[name]["redis_bytes_per_message"] = bytes_per_message
+
+    print(f"{'scheme':<12} {'bytes/msg':>10} {'encode us':>10} {'decode us':>10} {'redis bytes/msg':>16}")
+    for name, result in results.items():
+        print(
+            f"{name:<12} {result['bytes_per_message']:>10.1f} {result['encode_us']:>10.2f} "
+            f"{result['decode_us']:>10.2f} {result.get('redis_bytes_per_message', float('nan')):>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
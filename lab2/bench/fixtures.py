@@ -0,0 +1,154 @@
+"""
+Redis backends for running the domain functions outside of the app, with every round-trip counted.
+
+    with redis_backend("fakeredis") as r:       # in-memory, no server needed (pip install fakeredis)
+    with redis_backend("redis-server") as r:    # a throwaway local redis-server on a free port
+    with redis_backend("redis://host:6379/15") as r:  # an existing server, the database is flushed
+
+Clients count round-trips and commands in their RoundTripCounter (r.round_trips), including the
+binary client the message payloads are read through, since it reuses the connection class.
+"""
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from redis import Redis
+
+from domain import message
+from domain.config import create_redis
+from domain.db import seed_db
+from domain.read_cache import caches
+from domain.redis_structures import REGULAR_USERS_SET
+from domain.spam import get_spam_classifier
+
+
+class RoundTripCounter:
+    def __init__(self):
+        self.round_trips = 0
+        self.commands = 0
+
+    def reset(self) -> None:
+        self.round_trips = 0
+        self.commands = 0
+
+
+def count_round_trips(r: Redis) -> RoundTripCounter:
+    """
+    Make connections of "r" count what they send. Every send is one round-trip: a single command,
+    a pipeline or a MULTI. Handshakes of new connections aren't counted.
+    Has to be called before "r" opens its first connection.
+    """
+    counter = RoundTripCounter()
+    base = r.connection_pool.connection_class
+
+    class CountingConnection(base):
+        _in_handshake = False
+
+        def on_connect(self, *args, **kwargs):
+            self._in_handshake = True
+            try:
+                return super().on_connect(*args, **kwargs)
+            finally:
+                self._in_handshake = False
+
+        def send_packed_command(self, command, check_health=True):
+            if not self._in_handshake:
+                counter.round_trips += 1
+            return super().send_packed_command(command, check_health)
+
+        def send_command(self, *args, **kwargs):
+            if not self._in_handshake:
+                counter.commands += 1
+            return super().send_command(*args, **kwargs)
+
+        def pack_commands(self, commands):
+            commands = list(commands)
+            counter.commands += len(commands)
+            return super().pack_commands(commands)
+
+    r.connection_pool.connection_class = CountingConnection
+    r.round_trips = counter
+    return counter
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def local_redis_server() -> Iterator[str]:
+    """ Run a redis-server without persistence on a free port, yield its URL. """
+    if shutil.which("redis-server") is None:
+        raise RuntimeError("redis-server isn't installed")
+    port = get_free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        server = subprocess.Popen(
+            ["redis-server", "--port", str(port), "--dir", directory]
+            + ["--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            url = f"redis://127.0.0.1:{port}/0"
+            client = Redis.from_url(url)
+            for _ in range(100):
+                try:
+                    client.ping()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            yield url
+        finally:
+            server.terminate()
+            server.wait()
+
+
+@contextmanager
+def redis_backend(name: str) -> Iterator[Redis]:
+    """ Yield a seeded, round-trip counting client of "fakeredis", "redis-server" or a Redis URL. """
+    if name == "fakeredis":
+        import fakeredis
+
+        r = fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        count_round_trips(r)
+        seed_db(r)
+        yield r
+    elif name == "redis-server":
+        with local_redis_server() as url:
+            r = create_redis(url)
+            count_round_trips(r)
+            seed_db(r)
+            yield r
+    else:
+        r = create_redis(name)
+        count_round_trips(r)
+        r.flushdb()
+        seed_db(r)
+        try:
+            yield r
+        finally:
+            r.flushdb()
+
+
+def use_deterministic_spam_check(spam_percent: int = 50) -> None:
+    """ Make spam checks instant and repeatable. """
+    message.spam_classifier = get_spam_classifier("deterministic")
+    message.spam_classifier.spam_percent = spam_percent
+
+
+def add_users(r: Redis, count: int) -> List[str]:
+    users = [f"user{index}" for index in range(count)]
+    r.sadd(REGULAR_USERS_SET, *users)
+    return users
+
+
+def clear_local_caches() -> None:
+    """ Drop the in-process read and verdict caches, so reads hit Redis. """
+    for cache in caches.values():
+        cache.clear()
+    message.verdict_cache.clear()
@@ -0,0 +1,288 @@
+"""
+Push traffic through the messaging API and measure throughput, latency percentiles and queue drain time.
+
+    # against a running app (its Redis must already know the users, see --redis-url)
+    python -m bench.loadgen --url http://localhost:5000 --duration 30 --concurrency 16
+    # in-process app, listeners and Redis, e.g. for CI
+    python -m bench.loadgen --fakeredis --users 50 --rate 200 --read-ratio 0.8
+
+Results are written to a JSON file (--output) so runs can be compared across changes.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+READ_ENDPOINTS = [
+    "/inbound-messages",
+    "/user-stats",
+    "/spammer-stats",
+    "/chatter-stats",
+    "/online-users",
+]
+# Gauge families that add up to the number of messages still waiting for delivery
+BACKLOG_GAUGES = [
+    "message_queue_length",
+    "message_queue_processing_length",
+]
+
+
+class HttpClient:
+    """ Calls the API of a running app. """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, str]:
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read().decode()
+
+
+class FlaskClient:
+    """ Calls the API of an app running in this process. """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, str]:
+        # Test clients aren't thread-safe, so every call gets its own
+        response = self.app.test_client().open(path, method=method, json=body)
+        return response.status_code, response.get_data(as_text=True)
+
+
+def start_in_process_app(users: List[str], spam_backend: Optional[str]):
+    """ Import the app against fakeredis, seed the users and start the listeners. """
+    from unittest import mock
+
+    import fakeredis
+
+    server = fakeredis.FakeServer()
+    with mock.patch(
+        "domain.config.create_redis",
+        lambda *args, **kwargs: fakeredis.FakeRedis(server=server, decode_responses=True),
+    ):
+        import app
+
+    from domain import message
+    from domain.db import seed_db, start_listeners
+    from domain.redis_structures import REGULAR_USERS_SET
+    from domain.spam import get_spam_classifier
+
+    if spam_backend:
+        message.spam_classifier = get_spam_classifier(spam_backend)
+    seed_db(app.r)
+    app.r.sadd(REGULAR_USERS_SET, *users)
+    start_listeners(app.r)
+    return app
+
+
+def stop_in_process_app(app):
+    from domain.redis_structures import EVENT_JOURNAL_CHANNEL, MESSAGE_QUEUE_CHANNEL
+
+    app.r.publish(EVENT_JOURNAL_CHANNEL, "KILL")
+    app.r.publish(MESSAGE_QUEUE_CHANNEL, "KILL")
+
+
+def fetch_backlog(client) -> int:
+    """ Get the number of undelivered messages from the /metrics endpoint. """
+    _, metrics = client.request("GET", "/metrics")
+    backlog = 0
+    for line in metrics.splitlines():
+        series, _, value = line.rpartition(" ")
+        if series.split("{", 1)[0] in BACKLOG_GAUGES:
+            backlog += int(float(value))
+    return backlog
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarise_latencies(latencies: List[float]) -> dict:
+    latencies = sorted(latencies)
+    return dict(
+        count=len(latencies),
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p90_ms=percentile(latencies, 0.9) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        max_ms=(latencies[-1] if latencies else 0.0) * 1000,
+    )
+
+
+class LoadWorker(threading.Thread):
+    def __init__(self, client, users: List[str], args, deadline: float, seed: int):
+        super().__init__(daemon=True)
+        self.client = client
+        self.users = users
+        self.args = args
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        # Each worker takes an equal share of the target request rate
+        self.interval = args.concurrency / args.rate if args.rate else 0.0
+
+    def next_request(self) -> Tuple[str, str, Optional[dict]]:
+        username = self.random.choice(self.users)
+        if self.random.random() < self.args.read_ratio:
+            endpoint = self.random.choice(READ_ENDPOINTS)
+            return "GET", f"{endpoint}?username={username}", None
+        body = dict(
+            sender=username,
+            recipient=self.random.choice(self.users),
+            content=f"message {self.random.randint(0, self.args.distinct_contents)}",
+        )
+        return "POST", "/message", body
+
+    def run(self):
+        next_at = time.perf_counter()
+        while time.perf_counter() < self.deadline:
+            if self.interval:
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_at += self.interval
+            method, path, body = self.next_request()
+            endpoint = path.split("?", 1)[0]
+            started_at = time.perf_counter()
+            status, _ = self.client.request(method, path, body)
+            self.latencies.setdefault(endpoint, []).append(time.perf_counter() - started_at)
+            if status >= 400:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+def wait_for_drain(client, timeout: float) -> Optional[float]:
+    """ Wait until every queued message is processed, return how long it took or None on timeout. """
+    started_at = time.perf_counter()
+    while time.perf_counter() - started_at < timeout:
+        if fetch_backlog(client) == 0:
+            return time.perf_counter() - started_at
+        time.sleep(0.1)
+    return None
+
+
+def run(args) -> dict:
+    if args.fakeredis:
+        users = [f"user{index}" for index in range(args.users)]
+        app = start_in_process_app(users, args.spam_backend)
+        client = FlaskClient(app.app)
+    else:
+        from domain.db import ADMIN_USERS, REGULAR_USERS
+
+        users = REGULAR_USERS + ADMIN_USERS
+        if args.redis_url:
+            from redis import Redis
+
+            from domain.redis_structures import REGULAR_USERS_SET
+
+            users = [f"user{index}" for index in range(args.users)]
+            Redis.from_url(args.redis_url).sadd(REGULAR_USERS_SET, *users)
+        client = HttpClient(args.url)
+
+    try:
+        for username in users:
+            client.request("POST", "/login", dict(username=username))
+
+        started_at = time.perf_counter()
+        deadline = started_at + args.duration
+        workers = [
+            LoadWorker(client, users, args, deadline, seed=args.seed + index)
+            for index in range(args.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started_at
+
+        backlog = fetch_backlog(client)
+        drain_time = wait_for_drain(client, args.drain_timeout)
+    finally:
+        if args.fakeredis:
+            stop_in_process_app(app)
+
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    for worker in workers:
+        for endpoint, values in worker.latencies.items():
+            latencies.setdefault(endpoint, []).extend(values)
+        for endpoint, count in worker.errors.items():
+            errors[endpoint] = errors.get(endpoint, 0) + count
+    total_requests = sum(len(values) for values in latencies.values())
+
+    return dict(
+        config=dict(
+            target="fakeredis" if args.fakeredis else args.url,
+            users=len(users),
+            duration=args.duration,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            read_ratio=args.read_ratio,
+            distinct_contents=args.distinct_contents,
+            spam_backend=args.spam_backend,
+        ),
+        requests=total_requests,
+        throughput_rps=total_requests / elapsed,
+        errors=errors,
+        latency=summarise_latencies(
+            [value for values in latencies.values() for value in values]
+        ),
+        latency_by_endpoint={
+            endpoint: summarise_latencies(values)
+            for endpoint, values in sorted(latencies.items())
+        },
+        backlog_after_load=backlog,
+        queue_drain_seconds=drain_time,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="Base URL of a running app")
+    target.add_argument("--fakeredis", action="store_true", help="Run the app in-process against fakeredis")
+    parser.add_argument("--redis-url", help="Seed --users into the Redis of the app under --url")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0.0, help="Target requests per second, 0 for unthrottled")
+    parser.add_argument("--read-ratio", type=float, default=0.8, help="Share of read requests")
+    parser.add_argument("--distinct-contents", type=int, default=1000, help="How many distinct message contents to send")
+    parser.add_argument("--spam-backend", default=None, help="Spam backend of the in-process app")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=422)
+    parser.add_argument("--output", default="loadgen_results.json")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    latency = results["latency"]
+    print(
+        f"{results['requests']} requests, {results['throughput_rps']:.1f} req/s, "
+        f"p50 {latency['p50_ms']:.1f} ms, p99 {latency['p99_ms']:.1f} ms, "
+        f"queue drained in {results['queue_drain_seconds']} s"
+    )
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Count Redis round-trips, commands and wall time per call of the domain functions, and fail on regressions.
+
+    python -m bench.roundtrip_benchmark                          # fakeredis, compared to the baseline
+    python -m bench.roundtrip_benchmark --backend redis-server   # a throwaway local redis-server
+    python -m bench.roundtrip_benchmark --update-baseline        # after an intended change
+
+Exits with 1 when an operation needs more round-trips or commands than in --baseline, or, with --max-slowdown,
+when it got that many times slower. Round-trips and commands don't depend on the backend, wall times do.
+Spam checks are deterministic and the in-process caches are cleared before every call, so the counts are stable.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from redis import Redis
+
+from bench.fixtures import (
+    add_users,
+    clear_local_caches,
+    redis_backend,
+    use_deterministic_spam_check,
+)
+from domain import message, rate_limit
+from domain.archive import message_archive
+from domain.exceptions import RateLimitException
+from domain.user import login_user, logout_user
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "roundtrip_baseline.json")
+
+
+class Scenario:
+    """ State shared by the operations of a run. """
+
+    def __init__(self, r: Redis, users: List[str], seed: int):
+        self.r = r
+        self.users = users
+        self.random = random.Random(seed)
+        self.iteration = 0
+        self.message_ids: List[int] = []
+
+    def random_message(self) -> message.RawMessage:
+        return dict(
+            sender=self.random.choice(self.users),
+            recipient=self.random.choice(self.users),
+            content=f"message {self.random.randint(0, 1000)}",
+        )
+
+
+def login(scenario: Scenario):
+    login_user(scenario.r, scenario.users[scenario.iteration])
+
+
+def logout(scenario: Scenario):
+    logout_user(scenario.r, scenario.users[scenario.iteration])
+
+
+def admit(scenario: Scenario):
+    try:
+        rate_limit.admit_message(scenario.r, scenario.random.choice(scenario.users))
+    except RateLimitException:
+        pass
+
+
+def create(scenario: Scenario):
+    scenario.message_ids.append(
+        message.create_message(scenario.r, scenario.random_message())
+    )
+
+
+def process_batch(scenario: Scenario):
+    message.process_enqueued_messages(scenario.r, message.SPAM_CHECK_BATCH_SIZE)
+
+
+def fetch_messages(scenario: Scenario):
+    message.fetch_messages(scenario.r, scenario.random.sample(scenario.message_ids, 50))
+
+
+def load_inbox(scenario: Scenario):
+    message.load_user_inbound_messages(scenario.r, scenario.random.choice(scenario.users))
+
+
+def load_stats(scenario: Scenario):
+    message.load_messaging_stats_for_user(
+        scenario.r, scenario.random.choice(scenario.users)
+    )
+
+
+def archive(scenario: Scenario):
+    message.archive_finished_messages(scenario.r, -1, batch_size=10)
+
+
+# Run in this order, each one "--iterations" times
+OPERATIONS: Dict[str, Callable[[Scenario], None]] = {
+    "login_user": login,
+    "admit_message": admit,
+    "create_message": create,
+    "process_enqueued_messages": process_batch,
+    "fetch_messages": fetch_messages,
+    "load_user_inbound_messages": load_inbox,
+    "load_messaging_stats_for_user": load_stats,
+    "fetch_most_spamming_users": lambda scenario: message.fetch_most_spamming_users(scenario.r),
+    "fetch_highest_activity_stats": lambda scenario: message.fetch_highest_activity_stats(scenario.r),
+    "fetch_online_users": lambda scenario: message.fetch_online_users(scenario.r),
+    "fetch_pipeline_gauges": lambda scenario: message.fetch_pipeline_gauges(scenario.r),
+    "archive_finished_messages": archive,
+    "logout_user": logout,
+}
+
+
+def prepare(scenario: Scenario, iterations: int) -> None:
+    """ Queue enough messages for every process_enqueued_messages call to get a full batch. """
+    for _ in range(iterations * message.SPAM_CHECK_BATCH_SIZE):
+        scenario.message_ids.append(
+            message.create_message(scenario.r, scenario.random_message())
+        )
+
+
+def run(backend: str, iterations: int, seed: int) -> Dict[str, dict]:
+    use_deterministic_spam_check()
+    # Cached cluster-wide readings would make the counts depend on timing
+    rate_limit.queue_depth.interval = float("inf")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, redis_backend(backend) as r:
+        message_archive.path = os.path.join(directory, "archive.sqlite3")
+        counter = r.round_trips
+        scenario = Scenario(r, add_users(r, max(iterations, 10)), seed)
+        prepare(scenario, iterations)
+
+        for name, operation in OPERATIONS.items():
+            round_trips = commands = 0
+            durations = []
+            for scenario.iteration in range(iterations):
+                clear_local_caches()
+                counter.reset()
+                started_at = time.perf_counter()
+                operation(scenario)
+                durations.append(time.perf_counter() - started_at)
+                round_trips += counter.round_trips
+                commands += counter.commands
+            durations.sort()
+            results[name] = dict(
+                round_trips=round_trips / iterations,
+                commands=commands / iterations,
+                wall_ms=durations[len(durations) // 2] * 1000,
+            )
+    return results
+
+
+def find_regressions(
+    results: Dict[str, dict], baseline: Dict[str, dict], max_slowdown: float
+) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for key in ("round_trips", "commands"):
+            if result[key] > expected[key] + 1e-9:
+                regressions.append(f"{name}: {key} {expected[key]:g} -> {result[key]:g}")
+        if max_slowdown and result["wall_ms"] > expected["wall_ms"] * max_slowdown:
+            regressions.append(
+                f"{name}: wall time {expected['wall_ms']:.3f} -> {result['wall_ms']:.3f} ms"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--backend", default="fakeredis", help='"fakeredis", "redis-server" or a Redis URL (flushed)'
+    )
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=422)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--max-slowdown", type=float, default=0, help="Also fail when wall time grew by this factor, 0 to skip"
+    )
+    args = parser.parse_args()
+
+    results = run(args.backend, args.iterations, args.seed)
+    print(f"{'operation':<32} {'round-trips':>12} {'commands':>10} {'p50 ms':>9}")
+    for name, result in results.items():
+        print(
+            f"{name:<32} {result['round_trips']:>12.2f} {result['commands']:>10.2f} "
+            f"{result['wall_ms']:>9.3f}"
+        )
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = find_regressions(results, baseline, args.max_slowdown)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
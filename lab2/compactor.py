@@ -0,0 +1,50 @@
+"""
+Background job moving old delivered/spam messages from Redis to the on-disk archive (LAB2_ARCHIVE_PATH),
+which keeps the Redis memory footprint bounded. Reads fall through to the archive transparently.
+
+    python3 compactor.py --older-than-days 30 --interval 3600
+"""
+import argparse
+import signal
+import threading
+
+from domain.archive import message_archive
+from domain.config import add_redis_arguments, create_redis_from_args
+from domain.message import archive_finished_messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old messages out of Redis.")
+    parser.add_argument("--older-than-days", type=float, default=30)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--interval", type=float, default=0, help="Seconds between runs, 0 to run once"
+    )
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+    if message_archive.path is None:
+        parser.error(
+            "Set LAB2_ARCHIVE_PATH to a file on storage shared with every app process"
+        )
+
+    r = create_redis_from_args(args)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+
+    while True:
+        archived = 0
+        while not stopped.is_set():
+            batch = archive_finished_messages(
+                r, args.older_than_days * 24 * 3600, args.batch_size
+            )
+            if not batch:
+                break
+            archived += batch
+        print(f"Archived {archived} messages")
+        if not args.interval or stopped.wait(args.interval):
+            break
+
+
+if __name__ == "__main__":
+    main()
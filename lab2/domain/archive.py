@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    content TEXT NOT NULL,
+    status TEXT NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_recipient ON messages (recipient, status);
+CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (sender, status);
+"""
+
+# (id, sender, recipient, content, status, finished_at)
+ArchivedMessage = Tuple[int, str, str, str, str, float]
+
+
+class MessageArchive:
+    """
+    Append-only on-disk store of finished (delivered or spam) messages moved out of Redis.
+    Backed by SQLite, with indexes on the id, the recipient and the sender.
+    Without a path nothing can be archived, and reads only see Redis.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._local = threading.local()
+
+    def exists(self) -> bool:
+        """ Reads skip the archive until something was archived. """
+        return self.path is not None and os.path.exists(self.path)
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.path is None:
+                raise RuntimeError("Set LAB2_ARCHIVE_PATH to archive messages")
+            connection = sqlite3.connect(self.path)
+            # WAL lets readers in other processes work while the compactor appends
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def append(self, messages: Iterable[ArchivedMessage]) -> None:
+        connection = self._connection()
+        with connection:
+            # Re-archiving after an interrupted compaction keeps a single copy
+            connection.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", messages
+            )
+
+    def fetch_messages(self, message_ids: Iterable[int]) -> Dict[int, dict]:
+        message_ids = list(message_ids)
+        if not message_ids or not self.exists():
+            return {}
+        placeholders = ",".join("?" * len(message_ids))
+        rows = self._connection().execute(
+            f"SELECT id, sender, recipient, content FROM messages WHERE id IN ({placeholders})",
+            message_ids,
+        )
+        return {
+            message_id: dict(sender=sender, recipient=recipient, content=content)
+            for message_id, sender, recipient, content in rows
+        }
+
+    def fetch_inbound_messages(self, username: str, status: str) -> List[dict]:
+        if not self.exists():
+            return []
+        rows = self._connection().execute(
+            "SELECT id, sender, recipient, content FROM messages "
+            "WHERE recipient = ? AND status = ? ORDER BY id",
+            (username, status),
+        )
+        return [
+            dict(sender=sender, recipient=recipient, content=content, id=message_id)
+            for message_id, sender, recipient, content in rows
+        ]
+
+    def count_outbound_messages(self, username: str) -> Dict[str, int]:
+        """ Get the number of archived messages sent by the user per status. """
+        if not self.exists():
+            return {}
+        rows = self._connection().execute(
+            "SELECT status, COUNT(*) FROM messages WHERE sender = ? GROUP BY status",
+            (username,),
+        )
+        return dict(rows.fetchall())
+
+
+# The SQLite file, on storage shared by the compactor and every app replica. There's no default, a relative
+# path would give every replica an archive of its own.
+ARCHIVE_PATH = os.environ.get("LAB2_ARCHIVE_PATH")
+
+message_archive = MessageArchive(ARCHIVE_PATH)
@@ -0,0 +1,171 @@
+import json
+import os
+import struct
+from abc import abstractmethod
+from typing import Dict
+from weakref import WeakKeyDictionary
+
+from redis import BlockingConnectionPool, Redis, RedisCluster
+
+try:
+    import msgpack
+except ImportError:  # msgpack is an optional dependency
+    msgpack = None
+
+
+class MessageCodec:
+    """ Turns a message into bytes stored in Redis and back. """
+
+    # A single byte prepended to every payload, so stored messages stay readable after the codec is switched.
+    tag: bytes
+
+    @abstractmethod
+    def encode(self, message: dict) -> bytes:
+        ...
+
+    @abstractmethod
+    def decode(self, data: bytes) -> dict:
+        ...
+
+
+class JsonMessageCodec(MessageCodec):
+    """ The original scheme: a JSON object per message. """
+
+    tag = b"j"
+
+    def encode(self, message: dict) -> bytes:
+        return json.dumps(message, separators=(",", ":")).encode()
+
+    def decode(self, data: bytes) -> dict:
+        return json.loads(data)
+
+
+class MsgpackMessageCodec(MessageCodec):
+    """ msgpack array of [sender, recipient, content]. Requires the 'msgpack' package. """
+
+    tag = b"m"
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("The 'msgpack' codec requires the msgpack package")
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(
+            [message["sender"], message["recipient"], message["content"]]
+        )
+
+    def decode(self, data: bytes) -> dict:
+        sender, recipient, content = msgpack.unpackb(data)
+        return dict(sender=sender, recipient=recipient, content=content)
+
+
+class StructMessageCodec(MessageCodec):
+    """
+    Fixed layout: a header with the byte lengths of sender, recipient and content,
+    followed by the three utf-8 strings.
+    """
+
+    tag = b"s"
+    header = struct.Struct("!HHI")
+
+    def encode(self, message: dict) -> bytes:
+        sender = message["sender"].encode()
+        recipient = message["recipient"].encode()
+        content = message["content"].encode()
+        return (
+            self.header.pack(len(sender), len(recipient), len(content))
+            + sender
+            + recipient
+            + content
+        )
+
+    def decode(self, data: bytes) -> dict:
+        sender_len, recipient_len, content_len = self.header.unpack_from(data)
+        offset = self.header.size
+        sender = data[offset : offset + sender_len].decode()
+        offset += sender_len
+        recipient = data[offset : offset + recipient_len].decode()
+        offset += recipient_len
+        content = data[offset : offset + content_len].decode()
+        return dict(sender=sender, recipient=recipient, content=content)
+
+
+CODECS = {
+    "json": JsonMessageCodec,
+    "msgpack": MsgpackMessageCodec,
+    "struct": StructMessageCodec,
+}
+
+_codecs_by_tag: Dict[bytes, MessageCodec] = {}
+
+
+def get_codec(name: str) -> MessageCodec:
+    if name not in CODECS:
+        raise ValueError(f"Unknown message codec '{name}', choose from {list(CODECS)}")
+    codec = CODECS[name]()
+    _codecs_by_tag[codec.tag] = codec
+    return codec
+
+
+# The codec used for newly written messages
+message_codec: MessageCodec = get_codec(os.environ.get("LAB2_MESSAGE_CODEC", "struct"))
+
+
+def set_message_codec(name: str) -> None:
+    global message_codec
+    message_codec = get_codec(name)
+
+
+def encode_message(message: dict) -> bytes:
+    return message_codec.tag + message_codec.encode(message)
+
+
+def decode_message(data: bytes) -> dict:
+    tag, payload = data[:1], data[1:]
+    codec = _codecs_by_tag.get(tag)
+    if codec is None:
+        names = [name for name, codec_class in CODECS.items() if codec_class.tag == tag]
+        if not names:
+            raise ValueError(f"Unknown message codec tag {tag!r}")
+        codec = get_codec(names[0])
+    return codec.decode(payload)
+
+
+_raw_clients = WeakKeyDictionary()
+
+
+def get_raw_client(r: Redis) -> Redis:
+    """
+    Get a client with the same connection settings as "r" that doesn't decode responses.
+    Encoded messages are binary, so they have to be read through it.
+    """
+    if isinstance(r, RedisCluster):
+        client = _raw_clients.get(r.nodes_manager)
+        if client is None:
+            # Same credentials, TLS and pool settings, the new client connects with its own on_connect
+            kwargs = dict(r.nodes_manager.connection_kwargs, decode_responses=False)
+            kwargs.pop("redis_connect_func", None)
+            # Parsed from the URL, always 0 on a cluster and refused as an argument
+            kwargs.pop("db", None)
+            node = r.get_default_node()
+            client = RedisCluster(host=node.host, port=node.port, **kwargs)
+            _raw_clients[r.nodes_manager] = client
+        return client
+
+    pool = r.connection_pool
+    client = _raw_clients.get(pool)
+    if client is None:
+        kwargs = dict(pool.connection_kwargs, decode_responses=False)
+        if isinstance(pool, BlockingConnectionPool):
+            # How long to wait for a free connection, it isn't a connection setting
+            kwargs["timeout"] = pool.timeout
+        client = Redis(
+            # Same pool type, e.g. blocking when the connection limit is reached
+            connection_pool=type(pool)(
+                connection_class=pool.connection_class,
+                max_connections=pool.max_connections,
+                **kwargs,
+            )
+        )
+        _raw_clients[pool] = client
+    return client
@@ -0,0 +1,79 @@
+import argparse
+import os
+from typing import Dict, Optional
+from weakref import WeakKeyDictionary
+
+from redis import BlockingConnectionPool, Redis, RedisCluster
+from redis.commands.core import Script
+
+# Every process of a deployment (app replicas, workers, listeners, the compactor) points at the same Redis
+REDIS_URL = os.environ.get("LAB2_REDIS_URL", "redis://127.0.0.1:6379/0")
+# Connections per process. Pub/sub listeners and blocked workers hold one each, request threads share the rest.
+REDIS_MAX_CONNECTIONS = int(os.environ.get("LAB2_REDIS_MAX_CONNECTIONS", 50))
+# How long a thread waits for a free connection before the command fails
+REDIS_POOL_TIMEOUT = float(os.environ.get("LAB2_REDIS_POOL_TIMEOUT", 5))
+# Treat LAB2_REDIS_URL as a node of a Redis Cluster
+REDIS_CLUSTER = os.environ.get("LAB2_REDIS_CLUSTER", "") == "1"
+
+
+def create_redis(
+    url: Optional[str] = None,
+    max_connections: Optional[int] = None,
+    cluster: Optional[bool] = None,
+) -> Redis:
+    """ Create a client with a bounded connection pool, settings default to the LAB2_REDIS_* variables. """
+    if cluster is None:
+        cluster = REDIS_CLUSTER
+    if cluster:
+        # Discovers the other nodes, with a pool of "max_connections" per node
+        return RedisCluster.from_url(
+            url or REDIS_URL,
+            max_connections=max_connections or REDIS_MAX_CONNECTIONS,
+            decode_responses=True,
+        )
+    pool = BlockingConnectionPool.from_url(
+        url or REDIS_URL,
+        max_connections=max_connections or REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        decode_responses=True,
+    )
+    return Redis(connection_pool=pool)
+
+
+def add_redis_arguments(parser: argparse.ArgumentParser) -> None:
+    """ Let a command line override the Redis settings, see create_redis_from_args. """
+    parser.add_argument(
+        "--redis-url", default=REDIS_URL, help="Defaults to LAB2_REDIS_URL"
+    )
+    parser.add_argument(
+        "--redis-max-connections",
+        type=int,
+        default=REDIS_MAX_CONNECTIONS,
+        help="Defaults to LAB2_REDIS_MAX_CONNECTIONS",
+    )
+    parser.add_argument(
+        "--redis-cluster",
+        action="store_true",
+        default=REDIS_CLUSTER,
+        help="--redis-url is a Redis Cluster node, defaults to LAB2_REDIS_CLUSTER",
+    )
+
+
+def create_redis_from_args(args: argparse.Namespace) -> Redis:
+    return create_redis(args.redis_url, args.redis_max_connections, args.redis_cluster)
+
+
+def is_cluster(r: Redis) -> bool:
+    """ Cluster clients can't run MULTI or scripts over keys of several slots. """
+    return isinstance(r, RedisCluster)
+
+
+_scripts: "WeakKeyDictionary[Redis, Dict[str, Script]]" = WeakKeyDictionary()
+
+
+def get_script(r: Redis, script: str) -> Script:
+    """ Register a Lua script with the client once, instead of hashing it again for every call. """
+    scripts = _scripts.setdefault(r, {})
+    if script not in scripts:
+        scripts[script] = r.register_script(script)
+    return scripts[script]
@@ -1,9 +1,14 @@
+import threading
 from functools import wraps
+from typing import List
+
 from flask_smorest import abort
 from flask import request
 from redis import Redis
 
+from domain.message import train_spam_classifier
 from domain.pub_sub_listeners import EventJournalListener, MessageQueueListener
+from domain.reliable_queue import LeaseReaper
 from domain.user import REGULAR_USERS_SET, ADMIN_USERS_SET
 
 REGULAR_USERS = ["Alice", "Malory"]
@@ -11,12 +16,17 @@ ADMIN_USERS = ["flain1", "Ilya"]
 
 
 def seed_db(r: Redis):
+    """ Add the default users. Safe to run any number of times, e.g. by every replica on boot. """
     r.sadd(REGULAR_USERS_SET, *REGULAR_USERS)
     r.sadd(ADMIN_USERS_SET, *ADMIN_USERS)
 
 
-def start_listeners(r: Redis):
+def start_listeners(r: Redis) -> List[threading.Thread]:
+    train_spam_classifier(r)
     pubsub_listener = EventJournalListener(r)
     message_queue_listener = MessageQueueListener(r)
+    lease_reaper = LeaseReaper(r)
     pubsub_listener.start()
     message_queue_listener.start()
+    lease_reaper.start()
+    return [pubsub_listener, message_queue_listener, lease_reaper]
@@ -19,3 +19,47 @@ class AlreadyLoggedInException(UsernameException):
 class NotLoggedInException(UsernameException):
     def __str__(self):
         return f"User {self.username} isn't logged in."
+
+
+class RateLimitException(Exception):
+    """ The message can't be accepted now, the client should retry after "retry_after" seconds. """
+
+    retry_after: int
+
+    def __init__(self, retry_after: int):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+class SenderRateLimitedException(RateLimitException):
+    username: str
+
+    def __init__(self, username, retry_after: int):
+        super().__init__(retry_after)
+        self.username = username
+
+    def __str__(self):
+        return f"User {self.username} is sending messages too fast, retry in {self.retry_after} seconds."
+
+
+class QueueOverloadedException(RateLimitException):
+    def __str__(self):
+        return f"Too many messages are waiting for delivery, retry in {self.retry_after} seconds."
+
+
+class MessageNotFoundException(Exception):
+    """ Messages that are neither in Redis nor in the archive this process reads. """
+
+    message_ids: list
+    archive_path: str
+
+    def __init__(self, message_ids, archive_path):
+        super().__init__()
+        self.message_ids = message_ids
+        self.archive_path = archive_path
+
+    def __str__(self):
+        return (
+            f"Couldn't find messages {self.message_ids} in Redis nor in the archive at {self.archive_path}, "
+            f"LAB2_ARCHIVE_PATH must point every process to the same shared archive."
+        )
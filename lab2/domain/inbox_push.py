@@ -0,0 +1,107 @@
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from redis.client import Pipeline, Redis
+
+from domain.redis_structures import INBOX_DELIVERY_CHANNEL
+from domain.user_keys import get_inbox_deliveries_stream_name
+
+# Long-poll requests wait at most this long for new messages
+MAX_WAIT_SECONDS = float(os.environ.get("LAB2_MAX_WAIT_SECONDS", 60))
+# Idle event streams get a comment this often, so proxies don't close them
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("LAB2_SSE_HEARTBEAT_SECONDS", 15))
+# Deliveries kept per user to resume from, a client further behind misses the trimmed ones
+MAX_DELIVERY_LOG_LENGTH = int(os.environ.get("LAB2_INBOX_DELIVERY_LOG_LENGTH", 1000))
+# Stream entry id of a delivery, "0" for the start of the log
+DELIVERY_ID_PATTERN = re.compile(r"\d+(-\d+)?")
+
+
+class InboxWaiters:
+    """
+    Lets request threads wait for deliveries to a user without a Redis connection of their own.
+    A single InboxDeliveryListener per process wakes them, so idle clients only cost a parked thread.
+    Deliveries are only counted for users watched by a request, so nothing is kept for the others.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # username -> (deliveries seen by this process, condition of the user's waiters, requests watching the user)
+        self._versions: Dict[str, int] = {}
+        self._conditions: Dict[str, threading.Condition] = {}
+        self._watching: Dict[str, int] = {}
+
+    @contextmanager
+    def watch(self, username: str) -> Iterator[None]:
+        """ Count deliveries to the user while in the block, call version() and wait() inside it. """
+        with self._lock:
+            self._watching[username] = self._watching.get(username, 0) + 1
+            self._conditions.setdefault(username, threading.Condition(self._lock))
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._watching[username] -= 1
+                if not self._watching[username]:
+                    del self._watching[username]
+                    del self._conditions[username]
+                    self._versions.pop(username, None)
+
+    def version(self, username: str) -> int:
+        """ Take before reading the inbox, then wait() for a version after it. """
+        with self._lock:
+            return self._versions.get(username, 0)
+
+    def wait(self, username: str, version: int, timeout: float) -> int:
+        """ Block until a delivery to the watched user newer than "version", return the current version. """
+        with self._lock:
+            self._conditions[username].wait_for(
+                lambda: self._versions.get(username, 0) != version, timeout
+            )
+            return self._versions.get(username, 0)
+
+    def notify(self, username: str) -> None:
+        with self._lock:
+            # Nobody reads the inbox of an unwatched user, so there's nobody to wake
+            if username not in self._watching:
+                return
+            self._versions[username] = self._versions.get(username, 0) + 1
+            self._conditions[username].notify_all()
+
+    def count(self) -> int:
+        """ Get the number of requests of this process waiting for deliveries. """
+        with self._lock:
+            return sum(self._watching.values())
+
+
+inbox_waiters = InboxWaiters()
+
+
+def notify_inbox_delivery(p: Pipeline, recipients: Iterable[str]) -> None:
+    """ Queue on "p" the notifications waking the recipients' waiting requests in every process. """
+    for recipient in set(recipients):
+        p.publish(INBOX_DELIVERY_CHANNEL, recipient)
+
+
+
+def record_inbox_delivery(p: Pipeline, recipient: str, message_id: int) -> None:
+    """ Queue on "p" an entry of the recipient's delivery log, its id is the cursor push requests resume from. """
+    p.xadd(
+        get_inbox_deliveries_stream_name(recipient),
+        {"id": message_id},
+        maxlen=MAX_DELIVERY_LOG_LENGTH,
+        approximate=True,
+    )
+
+
+def fetch_inbox_deliveries(
+    r: Redis, username: str, after: str
+) -> List[Tuple[str, int]]:
+    """ Get (delivery id, message id) pairs of deliveries to the user after the "after" delivery id, oldest first. """
+    streams = r.xread({get_inbox_deliveries_stream_name(username): after})
+    if not streams:
+        return []
+    _, entries = streams[0]
+    return [(delivery_id, int(fields["id"])) for delivery_id, fields in entries]
@@ -1,40 +1,76 @@
-import json
-from enum import Enum, unique
-from typing import TypedDict, List, Dict
+from typing import TypedDict, List, Dict, Iterable
 
-from redis.client import Pipeline, Redis
+from redis.client import Redis
+import os
 import random
-from time import sleep
+import time
 
+from domain.codec import encode_message, decode_message, get_raw_client
+from domain.config import is_cluster
+from domain.metrics import increment_counters, observe
 from domain.redis_structures import (
     MESSAGE_QUEUE_CHANNEL,
-    MESSAGE_QUEUE,
-    ENQUEUED_MESSAGES_SET,
     MESSAGE_HASH,
+    MESSAGE_BUCKET_SIZE,
+    MESSAGE_ENQUEUED_AT_HASH,
     MESSAGE_INDEX,
-    OUTBOUND_MESSAGES_SET,
-    BEING_SPAM_CHECKED_MESSAGES_SET,
-    SPAM_MESSAGES_SET,
     EVENT_JOURNAL_CHANNEL,
     USERS_BY_SPAM_MESSAGES_SORTED_SET,
-    DELIVERED_MESSAGES_SET,
     USERS_BY_DELIVERED_MESSAGES_SORTED_SET,
-    INBOUND_MESSAGES_SET,
+    REGULAR_USERS_SET,
+    ADMIN_USERS_SET,
     ONLINE_USERS_SET,
     EVENT_JOURNAL_LIST,
+    MESSAGE_PROCESSING_LIST,
+    DEAD_LETTER_LIST,
+    FINISHED_MESSAGES_SORTED_SET,
+    MESSAGE_STATUS_COUNTS_HASH,
 )
+from domain.archive import message_archive
+from domain.exceptions import MessageNotFoundException
+from domain.inbox_push import (
+    MAX_WAIT_SECONDS,
+    fetch_inbox_deliveries,
+    inbox_waiters,
+    notify_inbox_delivery,
+    record_inbox_delivery,
+)
+from domain.read_cache import caches, invalidate_user_caches
+from domain.reliable_queue import (
+    QueueLane,
+    ClaimedMessage,
+    LANES,
+    get_sender_lane,
+    enqueue_message,
+    claim_messages,
+    ack_messages,
+    fetch_lane_lengths,
+)
+from domain.spam import SpamClassifier, get_spam_classifier
+from domain.user_keys import (
+    MessageDeliveryStatus,
+    OUTBOUND_STATUSES,
+    change_status_count,
+    get_inbound_messages_set_name,
+    get_outbound_messages_set_name,
+    set_outbound_message_status,
+)
+from domain.verdict_cache import VerdictCache, get_content_hash
 
 
 random.seed(422)
 
-
-@unique
-class MessageDeliveryStatus(Enum):
-    queued = "queued"
-    checking_for_spam = "checking_for_spam"
-    blocked_for_spam = "blocked_for_spam"
-    sent = "sent"
-    delivered = "delivered"
+# Spam check backend: "simulated" (sleep and a coin flip) or "naive_bayes"
+spam_classifier: SpamClassifier = get_spam_classifier(
+    os.environ.get("LAB2_SPAM_BACKEND", "simulated")
+)
+# How many queued messages a worker takes for a single spam check
+SPAM_CHECK_BATCH_SIZE = int(os.environ.get("LAB2_SPAM_CHECK_BATCH_SIZE", 32))
+# Verdicts of recently checked contents, repeated messages skip the spam check
+verdict_cache = VerdictCache(
+    max_size=int(os.environ.get("LAB2_VERDICT_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("LAB2_VERDICT_CACHE_TTL", 3600)),
+)
 
 
 class RawMessage(TypedDict):
@@ -53,6 +89,14 @@ class Message(RawMessage):
     id: int
 
 
+class DeliveredMessage(Message):
+    """
+    Message with the id of its delivery to the recipient, which push requests resume from.
+    """
+
+    delivery_id: str
+
+
 class UserMessagingStats(TypedDict):
     """
     Stats representing suer's messaging activity.
@@ -67,90 +111,263 @@ class UserMessagingStats(TypedDict):
 def create_message(r, message: RawMessage) -> int:
     """ Create a new message in Redis Hash and enqueue it for spam detection an eventual delivery. """
 
-    def create_msg_transaction(p: Pipeline):
-        current_id = p.get(MESSAGE_INDEX)
-        new_id = (
-            int(current_id) + 1 if current_id else 1
-        )  # If id doesn't exist in redis, set it to 1
-        p.multi()
-        # Increment the message_id and use it to create a new message
-        p.incr(MESSAGE_INDEX, 1)
-        p.hset(MESSAGE_HASH, new_id, json.dumps(message))
-        # Mark the message as enqueued
-        p.sadd(ENQUEUED_MESSAGES_SET, new_id)
-        # Push to the queue for processing
-        p.rpush(MESSAGE_QUEUE, new_id)
-        # Add the message to the sender's outbound list
-        p.sadd(get_outbound_messages_list_name(message["sender"]), new_id)
-        # Notify the listener that it should call a worker to process a new message in the queue
-        p.publish(MESSAGE_QUEUE_CHANNEL, new_id)
-
-    # More on Redis transactions here: https://github.com/andymccurdy/redis-py/#pipelines
-    message_id: int = r.transaction(create_msg_transaction, MESSAGE_INDEX)[0]
-    return message_id
-
-
-def process_enqueued_message(r: Redis) -> None:
+    lane: QueueLane = get_sender_lane(r, message["sender"])
+    # Increment the message_id and use it to create a new message. If we die before the message is written,
+    # the id is just skipped.
+    new_id: int = r.incr(MESSAGE_INDEX)
+
+    # A single MULTI on one node, so a worker never claims a message that isn't written yet.
+    # The message, its sender and its lane live in different Redis Cluster slots, so there's no MULTI there.
+    p = r.pipeline(transaction=not is_cluster(r))
+    p.hset(get_message_bucket_name(new_id), new_id, encode_message(message))
+    # Remember when the message was enqueued to measure its delivery latency
+    p.hset(get_message_enqueued_at_name(new_id), new_id, time.time())
+    # Mark the message as enqueued in the sender's outbound messages
+    p.sadd(
+        get_outbound_messages_set_name(message["sender"], MessageDeliveryStatus.queued),
+        new_id,
+    )
+    change_status_count(p, MessageDeliveryStatus.queued, 1)
+    if is_cluster(r):
+        # Cluster pipelines write to all nodes at once, the message must exist before a worker can claim it
+        p.execute()
+        p = r.pipeline(transaction=False)
+    # Push to the sender's queue lane for processing
+    enqueue_message(p, new_id, lane, message["sender"])
+    # Notify the listener that it should call a worker to process a new message in the queue
+    p.publish(MESSAGE_QUEUE_CHANNEL, new_id)
+    invalidate_user_caches(p, "user_stats", [message["sender"]])
+    p.execute()
+    return new_id
+
+
+def process_enqueued_message(r: Redis) -> int:
     """ Pop the message from the top of the queue, check it for spam and deliver to the recipient. """
-    message_id = int(r.lpop(MESSAGE_QUEUE))
-    message: RawMessage = json.loads(r.hget(MESSAGE_HASH, message_id))
-    # Mark the message as being checked for spam
-    r.smove(ENQUEUED_MESSAGES_SET, BEING_SPAM_CHECKED_MESSAGES_SET, message_id)
-
-    is_spam: bool = spam_check()
-
-    if is_spam:
-        # Mark the message as spam in Redis
-        r.smove(BEING_SPAM_CHECKED_MESSAGES_SET, SPAM_MESSAGES_SET, message_id)
-        # Make a record about spam in the event_journal
-        r.publish(
-            EVENT_JOURNAL_CHANNEL,
-            f"SPAM: message with id {message_id} by {message['sender']}",
+    return process_enqueued_messages(r, 1)
+
+
+def process_enqueued_messages(r: Redis, count: int = SPAM_CHECK_BATCH_SIZE) -> int:
+    """
+    Take up to "count" messages from the queue lanes, check them for spam in a single batch
+    and deliver the legitimate ones to their recipients. Returns the number of processed messages.
+    """
+    # Lease the messages and mark them as being checked for spam.
+    # If this worker dies, the reaper puts them back to the queue once the lease expires.
+    claimed: List[ClaimedMessage] = claim_messages(r, count)
+    process_claimed_messages(r, claimed)
+    return len(claimed)
+
+
+def process_claimed_messages(r: Redis, claimed: List[ClaimedMessage]) -> None:
+    """ Check the messages leased by this worker for spam and deliver the legitimate ones. """
+    if not claimed:
+        return
+    message_ids: List[int] = [message.id for message in claimed]
+
+    messages: List[RawMessage] = fetch_messages(r, message_ids)
+    p = r.pipeline(transaction=False)
+    for message_id in message_ids:
+        p.hget(get_message_enqueued_at_name(message_id), message_id)
+    for message_id, message in zip(message_ids, messages):
+        set_outbound_message_status(
+            p, message["sender"], message_id, MessageDeliveryStatus.checking_for_spam
         )
-        # Increment sender's score for spam messages
-        r.zincrby(USERS_BY_SPAM_MESSAGES_SORTED_SET, 1, message["sender"])
-    else:
-        # Mark the message as inbound for the recipient
-        r.sadd(get_inbound_messages_list_name(message["recipient"]), message_id)
-        # Mark the message as delivered
-        r.smove(BEING_SPAM_CHECKED_MESSAGES_SET, DELIVERED_MESSAGES_SET, message_id)
-        # Increment sender's score for sent messages
-        r.zincrby(USERS_BY_DELIVERED_MESSAGES_SORTED_SET, 1, message["sender"])
+    invalidate_user_caches(p, "user_stats", [message["sender"] for message in messages])
+    enqueued_at: List[str] = p.execute()[: len(message_ids)]
+
+    spam_check_started_at = time.perf_counter()
+    verdicts: List[bool] = cached_spam_check(
+        r, [message["content"] for message in messages]
+    )
+    spam_check_duration = time.perf_counter() - spam_check_started_at
+
+    # Results and the lease release are applied in a single MULTI, so a message is either finished or requeued.
+    # On Redis Cluster the pipeline isn't a MULTI, see the lease release below.
+    p = r.pipeline()
+    delivery_latencies: Dict[QueueLane, List[float]] = {}
+    now = time.time()
+    for (message_id, lane, _), message, is_spam, timestamp in zip(
+        claimed, messages, verdicts, enqueued_at
+    ):
+        p.hdel(get_message_enqueued_at_name(message_id), message_id)
+        if is_spam:
+            # Mark the message as spam in Redis
+            set_outbound_message_status(
+                p, message["sender"], message_id, MessageDeliveryStatus.blocked_for_spam
+            )
+            # Make a record about spam in the event_journal
+            p.publish(
+                EVENT_JOURNAL_CHANNEL,
+                f"SPAM: message with id {message_id} by {message['sender']}",
+            )
+            # Increment sender's score for spam messages
+            p.zincrby(USERS_BY_SPAM_MESSAGES_SORTED_SET, 1, message["sender"])
+        else:
+            # Mark the message as inbound for the recipient
+            p.sadd(get_inbound_messages_set_name(message["recipient"]), message_id)
+            # Log the delivery for the recipient's push requests
+            record_inbox_delivery(p, message["recipient"], message_id)
+            # Mark the message as delivered
+            set_outbound_message_status(
+                p, message["sender"], message_id, MessageDeliveryStatus.delivered
+            )
+            # Increment sender's score for sent messages
+            p.zincrby(USERS_BY_DELIVERED_MESSAGES_SORTED_SET, 1, message["sender"])
+            if timestamp is not None:
+                delivery_latencies.setdefault(lane, []).append(now - float(timestamp))
+    invalidate_user_caches(p, "user_stats", [message["sender"] for message in messages])
+    recipients: List[str] = [
+        message["recipient"]
+        for message, is_spam in zip(messages, verdicts)
+        if not is_spam
+    ]
+    invalidate_user_caches(p, "inbox", recipients)
+    notify_inbox_delivery(p, recipients)
+    # Remember when the messages were finished, to archive them once they get old
+    p.zadd(FINISHED_MESSAGES_SORTED_SET, {message_id: now for message_id in message_ids})
+    observe(p, "spam_check_duration_seconds", [spam_check_duration])
+    for lane, latencies in delivery_latencies.items():
+        observe(
+            p,
+            "message_delivery_latency_seconds",
+            latencies,
+            labels=dict(lane=lane.value),
+        )
+    increment_counters(
+        p,
+        {
+            'messages_processed_total{verdict="spam"}': sum(verdicts),
+            'messages_processed_total{verdict="delivered"}': len(verdicts) - sum(verdicts),
+        },
+    )
+    if is_cluster(r):
+        # Cluster pipelines write to all nodes at once, so the leases are only released once the results
+        # are written. Dying in between redelivers the messages, like any expired lease.
+        p.execute()
+        p = r.pipeline()
+    # Counts the messages in their new statuses, unless their leases expired and they were claimed again
+    ack_messages(
+        p,
+        claimed,
+        [
+            MessageDeliveryStatus.blocked_for_spam
+            if is_spam
+            else MessageDeliveryStatus.delivered
+            for is_spam in verdicts
+        ],
+    )
+    p.execute()
+
+
+def train_spam_classifier(r: Redis) -> None:
+    """ Fit the spam classifier on messages that were already marked as spam or delivered. """
+    p = r.pipeline(transaction=False)
+    p.smembers(REGULAR_USERS_SET)
+    p.smembers(ADMIN_USERS_SET)
+    usernames = set().union(*p.execute())
+
+    p = r.pipeline(transaction=False)
+    for username in usernames:
+        p.smembers(
+            get_outbound_messages_set_name(username, MessageDeliveryStatus.blocked_for_spam)
+        )
+        p.smembers(
+            get_outbound_messages_set_name(username, MessageDeliveryStatus.delivered)
+        )
+    results = p.execute()
+    spam_ids = [int(message_id) for ids in results[::2] for message_id in ids]
+    delivered_ids = [int(message_id) for ids in results[1::2] for message_id in ids]
+    if not spam_ids and not delivered_ids:
+        return
+    messages = fetch_messages(r, spam_ids + delivered_ids)
+    spam_classifier.fit(
+        [message["content"] for message in messages],
+        [True] * len(spam_ids) + [False] * len(delivered_ids),
+    )
 
 
 def fetch_user_inbound_messages(r: Redis, username: str) -> List[Message]:
+    """ Get messages received by the user with "username", served from the read cache when possible. """
+    return caches["inbox"].get_or_load(
+        username, lambda: load_user_inbound_messages(r, username)
+    )
+
+
+def wait_for_inbound_messages(
+    r: Redis, username: str, after: str, timeout: float
+) -> List[DeliveredMessage]:
+    """
+    Get messages delivered to the user after the "after" delivery id, in delivery order,
+    waiting up to "timeout" seconds for a delivery when there are none yet.
+    Lanes, concurrent workers and requeues deliver messages out of id order, so message ids can't be the cursor.
+    """
+    deadline = time.monotonic() + min(timeout, MAX_WAIT_SECONDS)
+    with inbox_waiters.watch(username):
+        while True:
+            # A delivery between reading the log and waiting changes the version, so it's never missed
+            version = inbox_waiters.version(username)
+            deliveries = fetch_inbox_deliveries(r, username, after)
+            remaining = deadline - time.monotonic()
+            if deliveries or remaining <= 0:
+                break
+            inbox_waiters.wait(username, version, remaining)
+
+    messages = fetch_messages(r, [message_id for _, message_id in deliveries])
+    return [
+        dict(id=message_id, delivery_id=delivery_id, **message)
+        for (delivery_id, message_id), message in zip(deliveries, messages)
+    ]
+
+
+def load_user_inbound_messages(r: Redis, username: str) -> List[Message]:
     """ Get messages received by the user with "username" """
-    inbound_message_ids = r.sinter(
-        get_inbound_messages_list_name(username), DELIVERED_MESSAGES_SET
+    inbound_message_ids = r.smembers(get_inbound_messages_set_name(username))
+    # Older messages were moved from Redis to the archive
+    messages_with_ids: List[Message] = message_archive.fetch_inbound_messages(
+        username, MessageDeliveryStatus.delivered.value
     )
     if not inbound_message_ids:
-        return []
-
-    inbound_messages = r.hmget(MESSAGE_HASH, *inbound_message_ids)
-    messages_with_ids: List[Message] = []
+        return messages_with_ids
+
+    archived_ids = {message["id"] for message in messages_with_ids}
+    inbound_message_ids = [
+        int(message_id)
+        for message_id in inbound_message_ids
+        if int(message_id) not in archived_ids
+    ]
+    inbound_messages = fetch_messages(r, inbound_message_ids)
     for message_id, message in zip(inbound_message_ids, inbound_messages):
-        message = json.loads(message)
-        message["id"] = int(message_id)
+        message["id"] = message_id
         messages_with_ids.append(message)
 
     return messages_with_ids
 
 
 def fetch_messaging_stats_for_user(r: Redis, username: str) -> UserMessagingStats:
-    """ View how many of user's messages are at the moment enqueued/being spam checked/marked as spam/delivered. """
-    delivered_messages_count = len(
-        r.sinter(get_outbound_messages_list_name(username), DELIVERED_MESSAGES_SET)
+    """ View user's messaging stats, served from the read cache when possible. """
+    return caches["user_stats"].get_or_load(
+        username, lambda: load_messaging_stats_for_user(r, username)
     )
-    enqueued_messages_count = len(
-        r.sinter(get_outbound_messages_list_name(username), ENQUEUED_MESSAGES_SET)
-    )
-    marked_as_spam_count = len(
-        r.sinter(get_outbound_messages_list_name(username), SPAM_MESSAGES_SET)
+
+
+def load_messaging_stats_for_user(r: Redis, username: str) -> UserMessagingStats:
+    """ View how many of user's messages are at the moment enqueued/being spam checked/marked as spam/delivered. """
+    # The status sets of a user share a Redis Cluster slot, so this is a single round-trip to a single node
+    p = r.pipeline(transaction=False)
+    for status in OUTBOUND_STATUSES:
+        p.scard(get_outbound_messages_set_name(username, status))
+    counts: Dict[MessageDeliveryStatus, int] = dict(zip(OUTBOUND_STATUSES, p.execute()))
+    delivered_messages_count = counts[MessageDeliveryStatus.delivered]
+    enqueued_messages_count = counts[MessageDeliveryStatus.queued]
+    marked_as_spam_count = counts[MessageDeliveryStatus.blocked_for_spam]
+    being_spam_checked_count = counts[MessageDeliveryStatus.checking_for_spam]
+
+    archived_counts = message_archive.count_outbound_messages(username)
+    delivered_messages_count += archived_counts.get(
+        MessageDeliveryStatus.delivered.value, 0
     )
-    being_spam_checked_count = len(
-        r.sinter(
-            get_outbound_messages_list_name(username), BEING_SPAM_CHECKED_MESSAGES_SET
-        )
+    marked_as_spam_count += archived_counts.get(
+        MessageDeliveryStatus.blocked_for_spam.value, 0
     )
 
     return dict(
@@ -161,6 +378,96 @@ def fetch_messaging_stats_for_user(r: Redis, username: str) -> UserMessagingStat
     )
 
 
+def archive_finished_messages(
+    r: Redis, older_than_seconds: float, batch_size: int = 1000
+) -> int:
+    """
+    Move a batch of messages delivered or marked as spam more than "older_than_seconds" ago
+    from Redis to the on-disk archive. Returns the number of archived messages.
+    """
+    finished = r.zrangebyscore(
+        FINISHED_MESSAGES_SORTED_SET,
+        "-inf",
+        time.time() - older_than_seconds,
+        start=0,
+        num=batch_size,
+        withscores=True,
+    )
+    if not finished:
+        return 0
+    message_ids = [int(message_id) for message_id, _ in finished]
+    messages = fetch_messages(r, message_ids)
+    p = r.pipeline(transaction=False)
+    for message_id, message in zip(message_ids, messages):
+        p.sismember(
+            get_outbound_messages_set_name(
+                message["sender"], MessageDeliveryStatus.blocked_for_spam
+            ),
+            message_id,
+        )
+    is_spam = p.execute()
+
+    # Write to the archive first: if we die before cleaning Redis up, the next run archives the messages again
+    message_archive.append(
+        (
+            message_id,
+            message["sender"],
+            message["recipient"],
+            message["content"],
+            (
+                MessageDeliveryStatus.blocked_for_spam
+                if spam
+                else MessageDeliveryStatus.delivered
+            ).value,
+            finished_at,
+        )
+        for message_id, message, spam, (_, finished_at) in zip(
+            message_ids, messages, is_spam, finished
+        )
+    )
+
+    p = r.pipeline()
+    for message_id, message in zip(message_ids, messages):
+        p.hdel(get_message_bucket_name(message_id), message_id)
+        for status in (
+            MessageDeliveryStatus.blocked_for_spam,
+            MessageDeliveryStatus.delivered,
+        ):
+            p.srem(get_outbound_messages_set_name(message["sender"], status), message_id)
+        p.srem(get_inbound_messages_set_name(message["recipient"]), message_id)
+    change_status_count(p, MessageDeliveryStatus.blocked_for_spam, -sum(is_spam))
+    change_status_count(
+        p, MessageDeliveryStatus.delivered, -(len(message_ids) - sum(is_spam))
+    )
+    p.zrem(FINISHED_MESSAGES_SORTED_SET, *message_ids)
+    p.execute()
+    return len(message_ids)
+
+
+def fetch_pipeline_gauges(r: Redis) -> Dict[str, int]:
+    """ Get the queue lengths and the number of messages in each delivery status. """
+    p = r.pipeline(transaction=False)
+    fetch_lane_lengths(p)
+    p.llen(MESSAGE_PROCESSING_LIST)
+    p.llen(DEAD_LETTER_LIST)
+    p.hgetall(MESSAGE_STATUS_COUNTS_HASH)
+    results = p.execute()
+    lane_lengths = results[: len(LANES)]
+    processing_length, dead_letter_length, status_counts = results[len(LANES) :]
+
+    gauges = {
+        "message_queue_processing_length": processing_length,
+        "message_queue_dead_letter_length": dead_letter_length,
+    }
+    for lane, length in zip(LANES, lane_lengths):
+        gauges[f'message_queue_length{{lane="{lane.value}"}}'] = length
+    for status in OUTBOUND_STATUSES:
+        gauges[f'messages{{status="{status.value}"}}'] = int(
+            status_counts.get(status.value, 0)
+        )
+    return gauges
+
+
 def fetch_most_spamming_users(r: Redis) -> List[Dict[str, int]]:
     """ Get most spammy users in a descending order. """
     spammers = r.zrange(USERS_BY_SPAM_MESSAGES_SORTED_SET, 0, -1, withscores=True)
@@ -188,15 +495,73 @@ def fetch_online_users(r: Redis) -> List[str]:
     return online_users
 
 
-def get_outbound_messages_list_name(sender: str):
-    return f"{OUTBOUND_MESSAGES_SET}:{sender}"
+def fetch_message(r: Redis, message_id: int) -> RawMessage:
+    """ Get a single message by its id. """
+    return fetch_messages(r, [message_id])[0]
+
+
+def fetch_messages(r: Redis, message_ids: Iterable[int]) -> List[RawMessage]:
+    """ Get messages by ids in one round-trip, with a single HMGET per bucket. """
+    message_ids = list(message_ids)
+    ids_by_bucket: Dict[str, List[int]] = {}
+    for message_id in message_ids:
+        ids_by_bucket.setdefault(get_message_bucket_name(message_id), []).append(
+            message_id
+        )
+
+    p = get_raw_client(r).pipeline(transaction=False)
+    for bucket, bucket_ids in ids_by_bucket.items():
+        p.hmget(bucket, *bucket_ids)
+    messages_by_id: Dict[int, RawMessage] = {}
+    archived_ids: List[int] = []
+    for bucket_ids, encoded in zip(ids_by_bucket.values(), p.execute()):
+        for message_id, data in zip(bucket_ids, encoded):
+            if data is None:
+                archived_ids.append(message_id)
+            else:
+                messages_by_id[message_id] = decode_message(data)
+    # Messages missing from Redis were moved to the archive
+    messages_by_id.update(message_archive.fetch_messages(archived_ids))
+    if len(messages_by_id) < len(set(message_ids)):
+        # Archived to a file this process doesn't read, rather than a KeyError below
+        raise MessageNotFoundException(
+            [
+                message_id
+                for message_id in archived_ids
+                if message_id not in messages_by_id
+            ],
+            message_archive.path,
+        )
+
+    return [messages_by_id[message_id] for message_id in message_ids]
+
+
+def get_message_bucket_name(message_id: int) -> str:
+    return f"{MESSAGE_HASH}:{{{int(message_id) // MESSAGE_BUCKET_SIZE}}}"
+
+
+def get_message_enqueued_at_name(message_id: int) -> str:
+    # Same hash tag as the message bucket, so both are on the same Redis Cluster node
+    return f"{MESSAGE_ENQUEUED_AT_HASH}:{{{int(message_id) // MESSAGE_BUCKET_SIZE}}}"
+
+
+def cached_spam_check(r: Redis, contents: List[str]) -> List[bool]:
+    """ Check a batch of message contents for spam, only classifying contents without a cached verdict. """
+    content_hashes = [get_content_hash(content) for content in contents]
+    verdicts_by_hash: Dict[str, bool] = verdict_cache.get_many(r, set(content_hashes))
 
+    unchecked: Dict[str, str] = {}
+    for content_hash, content in zip(content_hashes, contents):
+        if content_hash not in verdicts_by_hash:
+            unchecked[content_hash] = content
+    if unchecked:
+        fresh_verdicts = dict(zip(unchecked, spam_check(list(unchecked.values()))))
+        verdict_cache.set_many(r, fresh_verdicts)
+        verdicts_by_hash.update(fresh_verdicts)
 
-def get_inbound_messages_list_name(recipient: str):
-    return f"{INBOUND_MESSAGES_SET}:{recipient}"
+    return [verdicts_by_hash[content_hash] for content_hash in content_hashes]
 
 
-def spam_check() -> bool:
-    """ Imitate a spam check. """
-    sleep(random.randrange(1, 3))
-    return random.choice([True, False])
+def spam_check(contents: List[str]) -> List[bool]:
+    """ Check a batch of message contents for spam with the configured backend. """
+    return spam_classifier.classify(contents)
@@ -0,0 +1,216 @@
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Union
+
+from redis.client import Pipeline, Redis
+
+from domain.redis_structures import (
+    METRICS_COUNTERS_HASH,
+    METRICS_HISTOGRAM_HASH,
+    METRICS_HISTOGRAMS_SET,
+)
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# How often a MetricsFlusher writes the observations buffered in the process to Redis
+METRICS_FLUSH_INTERVAL_SECONDS = float(
+    os.environ.get("LAB2_METRICS_FLUSH_INTERVAL_SECONDS", 1)
+)
+
+
+def format_series(name: str, labels: Optional[Dict[str, str]] = None) -> str:
+    """ Render a series name in the Prometheus format, e.g. 'messages{status="queued"}'. """
+    if not labels:
+        return name
+    rendered_labels = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    return f"{name}{{{rendered_labels}}}"
+
+
+def get_histogram_hash_name(series: str) -> str:
+    return f"{METRICS_HISTOGRAM_HASH}:{series}"
+
+
+def increment_counters(r: Union[Redis, Pipeline], counters: Dict[str, int]) -> None:
+    """
+    Add to counters kept in Redis, so every process contributes to the same totals.
+    When given a pipeline, the increments are only queued on it.
+    """
+    counters = {name: value for name, value in counters.items() if value}
+    if not counters:
+        return
+    p = r if isinstance(r, Pipeline) else r.pipeline(transaction=False)
+    for name, value in counters.items():
+        p.hincrby(METRICS_COUNTERS_HASH, name, value)
+    if p is not r:
+        p.execute()
+
+
+def observe(
+    r: Union[Redis, Pipeline],
+    name: str,
+    values: Sequence[float],
+    labels: Optional[Dict[str, str]] = None,
+    buckets: Sequence[float] = DEFAULT_BUCKETS,
+) -> None:
+    """
+    Record observations in a histogram kept in Redis.
+    When given a pipeline, the updates are only queued on it.
+    """
+    if not values:
+        return
+    p = r if isinstance(r, Pipeline) else r.pipeline(transaction=False)
+    _add_to_histogram(p, format_series(name, labels), _count_observations(values, buckets))
+    if p is not r:
+        p.execute()
+
+
+def _count_observations(
+    values: Sequence[float], buckets: Sequence[float]
+) -> Dict[str, float]:
+    """ Observations per bucket upper bound, plus their "count" and "sum". """
+    observations: Dict[str, float] = {}
+    for value in values:
+        bound = next((str(bound) for bound in buckets if value <= bound), "+Inf")
+        observations[bound] = observations.get(bound, 0) + 1
+    observations["count"] = len(values)
+    observations["sum"] = sum(values)
+    return observations
+
+
+def _add_to_histogram(p: Pipeline, series: str, observations: Dict[str, float]) -> None:
+    histogram = get_histogram_hash_name(series)
+    p.sadd(METRICS_HISTOGRAMS_SET, series)
+    for bound, count in observations.items():
+        if bound == "sum":
+            p.hincrbyfloat(histogram, bound, count)
+        else:
+            p.hincrby(histogram, bound, count)
+
+
+class MetricsBuffer:
+    """
+    Histogram observations of this process, added to the ones in Redis by flush() instead of on every
+    observation, so e.g. timing a request doesn't cost it a round-trip.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[str, float]] = {}
+
+    def observe(
+        self,
+        name: str,
+        values: Sequence[float],
+        labels: Optional[Dict[str, str]] = None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        if not values:
+            return
+        series = format_series(name, labels)
+        observations = _count_observations(values, buckets)
+        with self._lock:
+            histogram = self._histograms.setdefault(series, {})
+            for bound, count in observations.items():
+                histogram[bound] = histogram.get(bound, 0) + count
+
+    def flush(self, r: Redis) -> None:
+        """ Add the buffered observations to Redis in a single round-trip. """
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        if not histograms:
+            return
+        p = r.pipeline(transaction=False)
+        for series, observations in histograms.items():
+            _add_to_histogram(p, series, observations)
+        p.execute()
+
+
+class MetricsFlusher(threading.Thread):
+    """ Periodically flush a MetricsBuffer. Observations of the last interval are lost if the process dies. """
+
+    def __init__(
+        self,
+        r: Redis,
+        buffer: MetricsBuffer,
+        interval: float = METRICS_FLUSH_INTERVAL_SECONDS,
+    ):
+        super().__init__(daemon=True)
+        self.redis = r
+        self.buffer = buffer
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.buffer.flush(self.redis)
+            except Exception as e:
+                print(self, f"dropped buffered metrics after {e!r}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+def fetch_counters(r: Redis) -> Dict[str, int]:
+    return {
+        name: int(value) for name, value in r.hgetall(METRICS_COUNTERS_HASH).items()
+    }
+
+
+def _get_family(series: str) -> str:
+    return series.split("{", 1)[0]
+
+
+def _add_label(series: str, suffix: str, key: str, value: str) -> str:
+    """ Turn 'name{a="b"}' into 'name<suffix>{a="b",key="value"}'. """
+    family, _, labels = series.partition("{")
+    labels = labels.rstrip("}")
+    labels = f'{labels},{key}="{value}"' if labels else f'{key}="{value}"'
+    return f"{family}{suffix}{{{labels}}}"
+
+
+def render_metrics(
+    r: Redis, gauges: Dict[str, float], local_counters: Optional[Dict[str, int]] = None
+) -> str:
+    """
+    Render gauges, counters and histograms in the Prometheus text exposition format.
+    "local_counters" are counters of this process only, rendered next to the ones kept in Redis.
+    """
+    lines: List[str] = []
+
+    def render_family(series_values: Dict[str, float], metric_type: str):
+        described = set()
+        for series, value in sorted(series_values.items()):
+            family = _get_family(series)
+            if family not in described:
+                lines.append(f"# TYPE {family} {metric_type}")
+                described.add(family)
+            lines.append(f"{series} {value}")
+
+    render_family(gauges, "gauge")
+    render_family({**fetch_counters(r), **(local_counters or {})}, "counter")
+
+    histogram_series = sorted(r.smembers(METRICS_HISTOGRAMS_SET))
+    p = r.pipeline(transaction=False)
+    for series in histogram_series:
+        p.hgetall(get_histogram_hash_name(series))
+    described = set()
+    for series, histogram in zip(histogram_series, p.execute()):
+        family = _get_family(series)
+        if family not in described:
+            lines.append(f"# TYPE {family} histogram")
+            described.add(family)
+        bounds = {str(bound) for bound in DEFAULT_BUCKETS}
+        bounds.update(bound for bound in histogram if bound not in ("count", "sum", "+Inf"))
+        cumulative = 0
+        for bound in sorted(bounds, key=float):
+            cumulative += int(histogram.get(bound, 0))
+            lines.append(f"{_add_label(series, '_bucket', 'le', bound)} {cumulative}")
+        lines.append(
+            f"{_add_label(series, '_bucket', 'le', '+Inf')} {int(histogram.get('count', 0))}"
+        )
+        family_labels = series[len(family) :]
+        lines.append(f"{family}_sum{family_labels} {float(histogram.get('sum', 0))}")
+        lines.append(f"{family}_count{family_labels} {int(histogram.get('count', 0))}")
+
+    return "\n".join(lines) + "\n"
@@ -5,15 +5,15 @@ from abc import abstractmethod
 
 from redis import Redis
 
-from domain.message import MESSAGE_QUEUE, RawMessage, process_enqueued_message
+from domain.message import RawMessage, process_enqueued_messages
+from domain.inbox_push import inbox_waiters
+from domain.read_cache import caches, handle_invalidation
 from domain.redis_structures import (
+    CACHE_INVALIDATION_CHANNEL,
+    INBOX_DELIVERY_CHANNEL,
     EVENT_JOURNAL_CHANNEL,
     MESSAGE_QUEUE_CHANNEL,
     MESSAGE_HASH,
-    ENQUEUED_MESSAGES_SET,
-    SPAM_MESSAGES_SET,
-    BEING_SPAM_CHECKED_MESSAGES_SET,
-    DELIVERED_MESSAGES_SET,
     USERS_BY_DELIVERED_MESSAGES_SORTED_SET,
     USERS_BY_SPAM_MESSAGES_SORTED_SET,
     EVENT_JOURNAL_LIST,
@@ -39,6 +39,10 @@ class PubSubListener(threading.Thread):
             else:
                 self.work(item)
 
+    def stop(self):
+        """ Stop this listener only, publishing "KILL" would stop the listeners of every process. """
+        self.pubsub.unsubscribe()
+
 
 class EventJournalListener(PubSubListener):
     """ Record such events: user logins/logouts, message spam checks. """
@@ -57,8 +61,8 @@ class EventJournalListener(PubSubListener):
 
 class MessageQueueListener(PubSubListener):
     """
-    When a message gets enqueued, fetch it with LPOP and check for spam.
-    Then send it to the inbound/outbound user inboxes.
+    When a message gets enqueued, fetch a batch of queued messages and check them for spam.
+    Then send them to the inbound/outbound user inboxes.
     """
 
     def __init__(self, r: Redis):
@@ -68,4 +72,38 @@ class MessageQueueListener(PubSubListener):
     def work(self, item):
         if item["type"] != "message":
             return
-        process_enqueued_message(self.redis)
+        # A batch may drain messages announced by later notifications, those find the queue empty
+        process_enqueued_messages(self.redis)
+
+
+class CacheInvalidationListener(PubSubListener):
+    """ Drop read cache entries of this process that another process invalidated. """
+
+    def __init__(self, r: Redis):
+        super().__init__(r)
+        self.daemon = True
+        self.pubsub.subscribe([CACHE_INVALIDATION_CHANNEL])
+
+    def work(self, item):
+        if item["type"] != "message":
+            return
+        handle_invalidation(item["data"])
+
+
+class InboxDeliveryListener(PubSubListener):
+    """
+    Wake the push requests of this process waiting for deliveries to the published user.
+    One subscription serves every waiting client of the process.
+    """
+
+    def __init__(self, r: Redis):
+        super().__init__(r)
+        self.daemon = True
+        self.pubsub.subscribe([INBOX_DELIVERY_CHANNEL])
+
+    def work(self, item):
+        if item["type"] != "message":
+            return
+        # The cache invalidation may arrive later, woken requests must not read a stale inbox
+        caches["inbox"].invalidate(item["data"])
+        inbox_waiters.notify(item["data"])
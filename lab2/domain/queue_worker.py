@@ -0,0 +1,53 @@
+import threading
+
+from redis import Redis
+
+from domain.message import SPAM_CHECK_BATCH_SIZE, process_claimed_messages
+from domain.reliable_queue import claim_messages_blocking
+
+# A failing worker waits this long before its next claim, doubling up to MAX_BACKOFF_SECONDS while it keeps failing
+MIN_BACKOFF_SECONDS = 0.1
+MAX_BACKOFF_SECONDS = 30
+
+
+class QueueWorker(threading.Thread):
+    """
+    Block on the message queue and process up to "batch_size" messages per round-trip.
+    Doesn't depend on pub/sub notifications, so any number of workers can run on any machine.
+    """
+
+    def __init__(
+        self,
+        r: Redis,
+        batch_size: int = SPAM_CHECK_BATCH_SIZE,
+        block_timeout: float = 1.0,
+    ):
+        super().__init__()
+        self.redis = r
+        self.batch_size = batch_size
+        # Bounds how long a stop request waits for an idle worker to notice it
+        self.block_timeout = block_timeout
+        self.stopped = threading.Event()
+        self.processed = 0
+
+    def run(self):
+        backoff = MIN_BACKOFF_SECONDS
+        while not self.stopped.is_set():
+            try:
+                claimed = claim_messages_blocking(
+                    self.redis, self.batch_size, self.block_timeout
+                )
+                # A claimed batch is always finished, even if a stop was requested meanwhile
+                process_claimed_messages(self.redis, claimed)
+            except Exception as e:
+                # E.g. Redis being unreachable. Messages of a failed batch stay leased, the reaper requeues them.
+                print(self, f"failed with {e!r}, retrying in {backoff} seconds")
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_SECONDS)
+                continue
+            backoff = MIN_BACKOFF_SECONDS
+            self.processed += len(claimed)
+        print(self, f"stopped after processing {self.processed} messages")
+
+    def stop(self):
+        self.stopped.set()
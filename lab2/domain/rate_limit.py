@@ -0,0 +1,134 @@
+import math
+import os
+import threading
+import time
+import uuid
+
+from redis import Redis
+
+from domain.config import get_script, is_cluster
+from domain.exceptions import QueueOverloadedException, SenderRateLimitedException
+from domain.reliable_queue import MIN_CHECKED_MESSAGES, fetch_lane_lengths
+from domain.redis_structures import (
+    RATE_LIMIT_SORTED_SET,
+    USERS_BY_SPAM_MESSAGES_SORTED_SET,
+    USERS_BY_DELIVERED_MESSAGES_SORTED_SET,
+)
+from domain.user_keys import get_user_tag
+
+# Messages a sender with a clean history may send per window
+RATE_LIMIT = int(os.environ.get("LAB2_RATE_LIMIT", 20))
+RATE_LIMIT_WINDOW_SECONDS = float(os.environ.get("LAB2_RATE_LIMIT_WINDOW_SECONDS", 10))
+# Even the worst spammers may send this many messages per window
+MIN_RATE_LIMIT = int(os.environ.get("LAB2_MIN_RATE_LIMIT", 1))
+# New messages are refused while the queue lanes together are longer than this
+MAX_QUEUE_DEPTH = int(os.environ.get("LAB2_MAX_QUEUE_DEPTH", 10000))
+QUEUE_RETRY_AFTER_SECONDS = int(os.environ.get("LAB2_QUEUE_RETRY_AFTER_SECONDS", 5))
+# The queue depth is the same for all senders, so a process re-reads it at most this often
+QUEUE_DEPTH_CHECK_INTERVAL_SECONDS = float(
+    os.environ.get("LAB2_QUEUE_DEPTH_CHECK_INTERVAL_SECONDS", 0.5)
+)
+
+# Returns {0, 0} when the message is admitted and {1, retry_after_ms} when the sender is over its limit.
+# The sender's limit shrinks with the share of its checked messages that were spam, by the ARGV[7] sender's scores
+# in the KEYS[2] spam and KEYS[3] delivered sorted sets. Archiving doesn't lower the scores, so it doesn't clear
+# a spammer's history. On Redis Cluster the scores are in other slots than the window, so they're passed as
+# ARGV[8] and ARGV[9] instead.
+ADMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local spam, delivered
+if #KEYS == 3 then
+    spam = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[7]) or 0)
+    delivered = tonumber(redis.call('ZSCORE', KEYS[3], ARGV[7]) or 0)
+else
+    spam, delivered = tonumber(ARGV[8]), tonumber(ARGV[9])
+end
+if spam + delivered >= tonumber(ARGV[5]) then
+    limit = math.max(tonumber(ARGV[4]), math.floor(limit * delivered / (spam + delivered)))
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if #oldest == 0 then
+        -- A limit of 0 refuses messages with an empty window, retry after a whole window
+        return {1, math.ceil(window * 1000)}
+    end
+    return {1, math.ceil((tonumber(oldest[2]) + window - now) * 1000)}
+end
+redis.call('ZADD', KEYS[1], now, ARGV[6])
+redis.call('PEXPIRE', KEYS[1], math.ceil(window * 1000))
+return {0, 0}
+"""
+
+
+class QueueDepthCheck:
+    """
+    Total length of the queue lanes, re-read at most every "interval" seconds.
+    Refusing messages under overload doesn't need an exact depth, so most requests skip the round-trip.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._depth = 0
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def get(self, r: Redis) -> int:
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.interval:
+                return self._depth
+        p = r.pipeline(transaction=False)
+        fetch_lane_lengths(p)
+        depth = sum(p.execute())
+        with self._lock:
+            self._depth, self._checked_at = depth, time.monotonic()
+        return depth
+
+
+queue_depth = QueueDepthCheck(QUEUE_DEPTH_CHECK_INTERVAL_SECONDS)
+
+
+def get_rate_limit_set_name(username: str) -> str:
+    return f"{RATE_LIMIT_SORTED_SET}:{get_user_tag(username)}"
+
+
+def admit_message(r: Redis, sender: str) -> None:
+    """
+    Count a message against the sender's sliding-window rate limit, in a single round-trip on a single node.
+    Raises a RateLimitException when the queue is too long or the sender is over its limit.
+    """
+    if queue_depth.get(r) >= MAX_QUEUE_DEPTH:
+        raise QueueOverloadedException(QUEUE_RETRY_AFTER_SECONDS)
+
+    keys = [get_rate_limit_set_name(sender)]
+    scores = []
+    if is_cluster(r):
+        p = r.pipeline(transaction=False)
+        p.zscore(USERS_BY_SPAM_MESSAGES_SORTED_SET, sender)
+        p.zscore(USERS_BY_DELIVERED_MESSAGES_SORTED_SET, sender)
+        scores = [score or 0 for score in p.execute()]
+    else:
+        keys += [
+            USERS_BY_SPAM_MESSAGES_SORTED_SET,
+            USERS_BY_DELIVERED_MESSAGES_SORTED_SET,
+        ]
+
+    admit = get_script(r, ADMIT_SCRIPT)
+    verdict, retry_after_ms = admit(
+        keys=keys,
+        args=[
+            time.time(),
+            RATE_LIMIT_WINDOW_SECONDS,
+            RATE_LIMIT,
+            MIN_RATE_LIMIT,
+            MIN_CHECKED_MESSAGES,
+            uuid.uuid4().hex,
+            sender,
+            *scores,
+        ],
+    )
+    if verdict == 1:
+        raise SenderRateLimitedException(sender, math.ceil(retry_after_ms / 1000))
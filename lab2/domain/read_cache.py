@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable
+
+from redis.client import Pipeline
+
+from domain.redis_structures import CACHE_INVALIDATION_CHANNEL
+
+
+class TTLCache:
+    """ Thread-safe in-process LRU cache whose entries also expire after "ttl" seconds. """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Loads in progress per key, and how many times such keys were invalidated meanwhile.
+        # Only keys being loaded are tracked, so an invalidation doesn't discard the loads of other keys.
+        self._loading: Dict[Hashable, int] = {}
+        self._invalidations: Dict[Hashable, int] = {}
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            self._loading[key] = self._loading.get(key, 0) + 1
+            invalidations = self._invalidations.get(key, 0)
+
+        try:
+            value = load()
+        except Exception:
+            with self._lock:
+                self._finish_load(key)
+            raise
+        with self._lock:
+            # Don't store a value that might have been loaded before an invalidation of its key arrived
+            if self._finish_load(key) == invalidations:
+                self._entries[key] = (value, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def _finish_load(self, key: Hashable) -> int:
+        """ Stop tracking a load of "key" and get the key's invalidations. Call with the lock held. """
+        invalidations = self._invalidations.get(key, 0)
+        self._loading[key] -= 1
+        if not self._loading[key]:
+            del self._loading[key]
+            self._invalidations.pop(key, None)
+        return invalidations
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._loading:
+                self._invalidations[key] = self._invalidations.get(key, 0) + 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            for key in self._loading:
+                self._invalidations[key] = self._invalidations.get(key, 0) + 1
+
+
+CACHE_SIZE = int(os.environ.get("LAB2_READ_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("LAB2_READ_CACHE_TTL", 5))
+
+# Per-user caches of the polled read endpoints, keyed by username
+caches: Dict[str, TTLCache] = {
+    "user_stats": TTLCache(CACHE_SIZE, CACHE_TTL),
+    "inbox": TTLCache(CACHE_SIZE, CACHE_TTL),
+}
+
+
+def invalidate_user_caches(p: Pipeline, cache_name: str, usernames: Iterable[str]) -> None:
+    """
+    Drop cached entries of the users in this process right away, and queue on "p" a notification
+    for the other processes, whose CacheInvalidationListener drops theirs.
+    """
+    for username in set(usernames):
+        caches[cache_name].invalidate(username)
+        p.publish(CACHE_INVALIDATION_CHANNEL, f"{cache_name}:{username}")
+
+
+def handle_invalidation(data: str) -> None:
+    cache_name, _, username = data.partition(":")
+    if cache_name in caches:
+        caches[cache_name].invalidate(username)
+
+
+def fetch_read_cache_counters() -> Dict[str, int]:
+    """ Get hits and misses of the read caches in this process. """
+    counters = {}
+    for cache_name, cache in caches.items():
+        counters[f'read_cache_hits_total{{cache="{cache_name}"}}'] = cache.hits
+        counters[f'read_cache_misses_total{{cache="{cache_name}"}}'] = cache.misses
+    return counters
@@ -1,3 +1,6 @@
+# Keys holding one user's data carry the username as a hash tag, e.g. "inbound_messages:{Alice}", so on
+# Redis Cluster they live in the same slot and can be read or changed together. Queue keys share the
+# "{message_queue}" tag, so the queue scripts can run on a cluster as well.
 # ------- USERS -------
 REGULAR_USERS_SET = "regular_users"
 ADMIN_USERS_SET = "admin_users"
@@ -5,26 +8,50 @@ ONLINE_USERS_SET = "online_users"
 # ------- MESSAGES -------
 # Stores the id of the latest sent message. Used to generate new ids.
 MESSAGE_INDEX = "message_index"
-# List with message ids for in-order spam-checks and delivery
-MESSAGE_QUEUE = "message_queue"
-# Pairs username->[received_message_ids]
+# Prefix of "{message_queue}:lane:<lane>" lists with message ids for in-order spam-checks and delivery.
+# Workers take from the lanes by weight, so trusted senders don't wait behind spam bursts.
+MESSAGE_QUEUE = "{message_queue}"
+# Pairs message_id->"<index_of_its_lane>:<sender>"
+MESSAGE_LANES_HASH = "{message_queue}:lane_of"
+# List that gets an item for every enqueued message, workers block on it while the lanes are empty
+QUEUE_DOORBELL_LIST = "{message_queue}:doorbell"
+# Position of the next claim in the weighted lane schedule
+QUEUE_SCHEDULE_POSITION = "{message_queue}:schedule_position"
+# List with ids of messages taken from the lanes by workers and not yet processed
+MESSAGE_PROCESSING_LIST = "{message_queue}:processing"
+# Pairs message_id->lease_deadline for messages in MESSAGE_PROCESSING_LIST. Expired leases get requeued.
+MESSAGE_LEASES_SORTED_SET = "{message_queue}:leases"
+# Pairs message_id->delivery_attempts
+MESSAGE_ATTEMPTS_HASH = "{message_queue}:attempts"
+# Pairs message_id->lease_token of the message's current claim, only that claim can release the lease
+MESSAGE_LEASE_TOKENS_HASH = "{message_queue}:lease_tokens"
+# List with ids of messages that failed processing too many times
+DEAD_LETTER_LIST = "{message_queue}:dead_letter"
+# Pairs status->number_of_messages over all users. Moved by the queue scripts when messages are claimed, requeued
+# or released, otherwise in the same pipelines as the outbound status sets.
+MESSAGE_STATUS_COUNTS_HASH = "{message_queue}:status_counts"
+# Prefix of "inbound_messages:{<username>}" sets with ids of messages delivered to the user
 INBOUND_MESSAGES_SET = "inbound_messages"
-# Pairs username->[sent_message_ids]
+# Prefix of "inbox_deliveries:{<username>}" streams with an entry per message delivered to the user, in delivery order.
+# Messages aren't delivered in id order, so push requests resume from the ids of these entries.
+INBOX_DELIVERIES_STREAM = "inbox_deliveries"
+# Prefix of "outbound_messages:{<username>}:<status>" sets with ids of the user's sent messages in each delivery status
 OUTBOUND_MESSAGES_SET = "outbound_messages"
-# Pairs message_id->message_object
+# Prefix of the hashes with pairs message_id->encoded_message_object.
+# Messages are spread over "message:{<id // MESSAGE_BUCKET_SIZE>}" buckets, keeping each hash small enough
+# for Redis to store it as a listpack (see hash-max-listpack-entries/hash-max-listpack-value).
 MESSAGE_HASH = "message"
-# Stores ids of enqueued messages foe easy lookup
-ENQUEUED_MESSAGES_SET = "messages:enqueued"
-# Stores ids of messages marked as spam
-SPAM_MESSAGES_SET = "messages:spam"
-# Stores ids of messages that are to be spam checked
-BEING_SPAM_CHECKED_MESSAGES_SET = "messages:checking_spam"
-# Stores ids of messages that were delivered
-DELIVERED_MESSAGES_SET = "messages:delivered"
+MESSAGE_BUCKET_SIZE = 100
+# Prefix of the hashes with pairs message_id->enqueue_timestamp, bucketed (and slotted) like MESSAGE_HASH
+MESSAGE_ENQUEUED_AT_HASH = "message_enqueued_at"
+# Pairs message_id->timestamp for delivered and spam messages. Old ones get moved to the on-disk archive.
+FINISHED_MESSAGES_SORTED_SET = "messages:finished"
 # Keep track of users sending most messages
 USERS_BY_DELIVERED_MESSAGES_SORTED_SET = "users_by_delivered_msg"
 # Keep track of users who spam the most
 USERS_BY_SPAM_MESSAGES_SORTED_SET = "users_by_spam_msg"
+# Prefix of "rate_limit:{<username>}" sorted sets with the timestamps of the user's recently sent messages
+RATE_LIMIT_SORTED_SET = "rate_limit"
 # ------- PUB/SUB -------
 # Used to log user's sign-in/sign-out and results of spam-checks
 EVENT_JOURNAL_CHANNEL = "event_journal"
@@ -32,3 +59,17 @@ EVENT_JOURNAL_CHANNEL = "event_journal"
 EVENT_JOURNAL_LIST = "events"
 # Before messages are delivered they're put into a queue for processing
 MESSAGE_QUEUE_CHANNEL = "message_queue"
+# Tells every process to drop "<cache_name>:<username>" from its read caches
+CACHE_INVALIDATION_CHANNEL = "cache_invalidation"
+# Tells every process that messages were delivered to the published username, waking its push requests
+INBOX_DELIVERY_CHANNEL = "inbox_delivery"
+# ------- CACHES -------
+# Prefix of "spam_verdict:<content_hash>" keys holding "1"/"0" spam verdicts shared by all workers
+SPAM_VERDICT_CACHE = "spam_verdict"
+# ------- METRICS -------
+# Pairs metric_name->value for counters shared by all processes
+METRICS_COUNTERS_HASH = "metrics:counters"
+# Prefix of "metrics:histogram:<series>" hashes with pairs bucket_upper_bound->observations, plus "sum" and "count"
+METRICS_HISTOGRAM_HASH = "metrics:histogram"
+# Stores the series names of all recorded histograms
+METRICS_HISTOGRAMS_SET = "metrics:histograms"
@@ -0,0 +1,407 @@
+import os
+import threading
+from enum import Enum, unique
+from typing import List, NamedTuple, Tuple
+
+from redis.client import Pipeline, Redis
+
+from domain.config import get_script
+from domain.read_cache import invalidate_user_caches
+from domain.redis_structures import (
+    MESSAGE_QUEUE,
+    MESSAGE_QUEUE_CHANNEL,
+    MESSAGE_LANES_HASH,
+    QUEUE_DOORBELL_LIST,
+    QUEUE_SCHEDULE_POSITION,
+    MESSAGE_PROCESSING_LIST,
+    MESSAGE_LEASES_SORTED_SET,
+    MESSAGE_ATTEMPTS_HASH,
+    DEAD_LETTER_LIST,
+    MESSAGE_STATUS_COUNTS_HASH,
+    MESSAGE_LEASE_TOKENS_HASH,
+    ADMIN_USERS_SET,
+    USERS_BY_SPAM_MESSAGES_SORTED_SET,
+    USERS_BY_DELIVERED_MESSAGES_SORTED_SET,
+)
+from domain.user_keys import (
+    MessageDeliveryStatus,
+    change_status_count,
+    get_outbound_messages_set_name,
+    set_outbound_message_status,
+)
+
+# How long a worker may hold a message before it's handed to another worker
+LEASE_SECONDS = float(os.environ.get("LAB2_LEASE_SECONDS", 10))
+# After this many expired leases a message goes to the dead-letter list
+MAX_DELIVERY_ATTEMPTS = int(os.environ.get("LAB2_MAX_DELIVERY_ATTEMPTS", 5))
+# How often the reaper looks for expired leases
+REAPER_INTERVAL_SECONDS = float(os.environ.get("LAB2_REAPER_INTERVAL_SECONDS", 1))
+# The doorbell only has to wake idle workers, so it's trimmed to this many items
+MAX_DOORBELL_LENGTH = 1000
+
+
+@unique
+class QueueLane(Enum):
+    """ Queue lanes from the highest priority to the lowest. """
+
+    admin = "admin"
+    trusted = "trusted"
+    regular = "regular"
+    suspect = "suspect"
+
+
+# While all lanes are busy, 8 of every 15 claimed messages come from the admin lane, 4 from the trusted one, etc.
+LANE_WEIGHTS = {
+    QueueLane.admin: 8,
+    QueueLane.trusted: 4,
+    QueueLane.regular: 2,
+    QueueLane.suspect: 1,
+}
+# Senders are only judged by their spam ratio once they have this many checked messages
+MIN_CHECKED_MESSAGES = 10
+# Senders with at most this share of spam are trusted
+TRUSTED_MAX_SPAM_RATIO = 0.1
+# Senders with at least this share of spam are suspected of spamming
+SUSPECT_MIN_SPAM_RATIO = 0.5
+
+LANES = list(QueueLane)
+
+
+class ClaimedMessage(NamedTuple):
+    id: int
+    lane: QueueLane
+    # Identifies this claim of the message, so a worker whose lease expired can't release a later claim
+    lease_token: str
+
+
+def get_lane_queue_name(lane: QueueLane) -> str:
+    return f"{MESSAGE_QUEUE}:lane:{lane.value}"
+
+
+def get_lane_schedule() -> List[int]:
+    """
+    Interleave lane indexes by weight (smooth weighted round-robin), e.g. [0, 1, 0, 2, 0, 1, 0, ...].
+    Workers walk the schedule, so lower lanes get their share without waiting for a whole round of higher ones.
+    """
+    weights = [LANE_WEIGHTS[lane] for lane in LANES]
+    current = [0] * len(weights)
+    schedule = []
+    for _ in range(sum(weights)):
+        current = [value + weight for value, weight in zip(current, weights)]
+        lane_index = current.index(max(current))
+        current[lane_index] -= sum(weights)
+        schedule.append(lane_index)
+    return schedule
+
+
+# Fixed keys, followed by one key per lane in LANES order.
+# All of them share the "{message_queue}" hash tag, so the scripts also run on Redis Cluster.
+QUEUE_KEYS = [
+    MESSAGE_PROCESSING_LIST,
+    MESSAGE_LEASES_SORTED_SET,
+    MESSAGE_ATTEMPTS_HASH,
+    MESSAGE_LANES_HASH,
+    QUEUE_DOORBELL_LIST,
+    QUEUE_SCHEDULE_POSITION,
+    DEAD_LETTER_LIST,
+    MESSAGE_STATUS_COUNTS_HASH,
+    MESSAGE_LEASE_TOKENS_HASH,
+] + [get_lane_queue_name(lane) for lane in LANES]
+
+# Move up to ARGV[1] ids from the lanes to the processing list and lease them for ARGV[2] seconds.
+# Lease deadlines are in the Redis server's time, so workers' clocks don't have to agree.
+# Lanes take turns in the order of the ARGV[3] schedule,
+# an empty lane passes its turn to the highest priority lane that has messages.
+# Claimed messages are counted as ARGV[5] instead of ARGV[4] right away, though workers move them between the
+# senders' status sets after the claim.
+# Every claim gets a lease token of the claim time and the attempt number, a later claim of the same message
+# has a later time or a higher attempt.
+# Returns a flat list of claimed ids, their lane indexes and lease tokens.
+CLAIM_SCRIPT = """
+local schedule = {}
+for lane in string.gmatch(ARGV[3], '%d+') do
+    schedule[#schedule + 1] = tonumber(lane) + 1
+end
+local lanes = #KEYS - 9
+local time = redis.call('TIME')
+local deadline = tonumber(time[1]) + tonumber(time[2]) / 1000000 + tonumber(ARGV[2])
+local position = tonumber(redis.call('GET', KEYS[6]) or 0)
+local claimed = {}
+while #claimed < 3 * tonumber(ARGV[1]) do
+    local message_id = false
+    local lane = schedule[position % #schedule + 1]
+    for candidate = 0, lanes do
+        if candidate > 0 then
+            lane = candidate
+        end
+        message_id = redis.call('LMOVE', KEYS[9 + lane], KEYS[1], 'LEFT', 'RIGHT')
+        if message_id then
+            break
+        end
+    end
+    if not message_id then
+        break
+    end
+    position = position + 1
+    redis.call('ZADD', KEYS[2], deadline, message_id)
+    local attempt = redis.call('HINCRBY', KEYS[3], message_id, 1)
+    local lease_token = time[1] .. '.' .. time[2] .. ':' .. attempt
+    redis.call('HSET', KEYS[9], message_id, lease_token)
+    claimed[#claimed + 1] = message_id
+    claimed[#claimed + 1] = lane - 1
+    claimed[#claimed + 1] = lease_token
+end
+redis.call('SET', KEYS[6], position % #schedule)
+redis.call('LTRIM', KEYS[5], #claimed / 3, -1)
+if #claimed > 0 then
+    redis.call('HINCRBY', KEYS[8], ARGV[4], -#claimed / 3)
+    redis.call('HINCRBY', KEYS[8], ARGV[5], #claimed / 3)
+end
+return claimed
+"""
+
+# Take up to ARGV[1] leases that expired by the Redis server's time and put their messages back at the front of
+# their lanes, or into the dead-letter list once they were attempted ARGV[2] times.
+# The messages stop being counted as ARGV[6], the requeued ones are counted as ARGV[5] again.
+# Returns flat lists of requeued and of dead-lettered ids with their senders.
+REAP_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+local requeued = {}
+local dead = {}
+-- Walk backwards, so LPUSH keeps the messages in their original order
+for i = #expired, 1, -1 do
+    local message_id = expired[i]
+    redis.call('ZREM', KEYS[2], message_id)
+    redis.call('LREM', KEYS[1], 1, message_id)
+    redis.call('HDEL', KEYS[9], message_id)
+    local lane, sender = string.match(redis.call('HGET', KEYS[4], message_id) or '', '^(%d+):(.*)$')
+    if tonumber(redis.call('HGET', KEYS[3], message_id) or 0) >= tonumber(ARGV[2]) then
+        redis.call('HDEL', KEYS[3], message_id)
+        redis.call('RPUSH', KEYS[7], message_id)
+        dead[#dead + 1] = message_id
+        dead[#dead + 1] = sender or ''
+    else
+        redis.call('LPUSH', KEYS[10 + tonumber(lane or ARGV[4])], message_id)
+        redis.call('RPUSH', KEYS[5], 1)
+        redis.call('PUBLISH', ARGV[3], message_id)
+        requeued[#requeued + 1] = message_id
+        requeued[#requeued + 1] = sender or ''
+    end
+end
+if #expired > 0 then
+    redis.call('HINCRBY', KEYS[8], ARGV[6], -#expired)
+    redis.call('HINCRBY', KEYS[8], ARGV[5], #requeued / 2)
+end
+return {requeued, dead}
+"""
+
+# Release the leases of the (message id, lease token, status) triplets from ARGV[2] on, counting each message
+# as its status instead of ARGV[1]. Leases whose token changed expired and belong to a later claim, so they stay
+# with it, and the message isn't counted twice.
+# Returns the number of released leases.
+ACK_SCRIPT = """
+local acked = 0
+for i = 2, #ARGV, 3 do
+    local message_id = ARGV[i]
+    if redis.call('HGET', KEYS[9], message_id) == ARGV[i + 1] then
+        redis.call('LREM', KEYS[1], 1, message_id)
+        redis.call('ZREM', KEYS[2], message_id)
+        redis.call('HDEL', KEYS[3], message_id)
+        redis.call('HDEL', KEYS[4], message_id)
+        redis.call('HDEL', KEYS[9], message_id)
+        redis.call('HINCRBY', KEYS[8], ARGV[1], -1)
+        redis.call('HINCRBY', KEYS[8], ARGV[i + 2], 1)
+        acked = acked + 1
+    end
+end
+return acked
+"""
+
+
+def get_sender_lane(r: Redis, sender: str) -> QueueLane:
+    """ Admins get the top lane, other senders are placed by the share of their checked messages that were spam. """
+    p = r.pipeline(transaction=False)
+    p.sismember(ADMIN_USERS_SET, sender)
+    p.zscore(USERS_BY_SPAM_MESSAGES_SORTED_SET, sender)
+    p.zscore(USERS_BY_DELIVERED_MESSAGES_SORTED_SET, sender)
+    is_admin, spam, delivered = p.execute()
+    if is_admin:
+        return QueueLane.admin
+
+    spam, delivered = spam or 0, delivered or 0
+    if spam + delivered < MIN_CHECKED_MESSAGES:
+        return QueueLane.regular
+    spam_ratio = spam / (spam + delivered)
+    if spam_ratio <= TRUSTED_MAX_SPAM_RATIO:
+        return QueueLane.trusted
+    if spam_ratio >= SUSPECT_MIN_SPAM_RATIO:
+        return QueueLane.suspect
+    return QueueLane.regular
+
+
+def enqueue_message(p: Pipeline, message_id: int, lane: QueueLane, sender: str) -> None:
+    """ Queue on "p" the commands pushing the message to the end of its lane and waking up a worker. """
+    p.rpush(get_lane_queue_name(lane), message_id)
+    # The reaper needs the sender to put the message back into its "queued" set
+    p.hset(MESSAGE_LANES_HASH, message_id, f"{LANES.index(lane)}:{sender}")
+    p.rpush(QUEUE_DOORBELL_LIST, 1)
+    p.ltrim(QUEUE_DOORBELL_LIST, -MAX_DOORBELL_LENGTH, -1)
+
+
+def claim_messages(
+    r: Redis, count: int, lease_seconds: float = LEASE_SECONDS
+) -> List[ClaimedMessage]:
+    """ Atomically take up to "count" messages from the lanes by weight, leasing them to the caller. """
+    claim = get_script(r, CLAIM_SCRIPT)
+    claimed = claim(
+        keys=QUEUE_KEYS,
+        args=[
+            count,
+            lease_seconds,
+            ",".join(str(lane_index) for lane_index in get_lane_schedule()),
+            MessageDeliveryStatus.queued.value,
+            MessageDeliveryStatus.checking_for_spam.value,
+        ],
+    )
+    return [
+        ClaimedMessage(int(message_id), LANES[int(lane_index)], lease_token)
+        for message_id, lane_index, lease_token in zip(
+            claimed[::3], claimed[1::3], claimed[2::3]
+        )
+    ]
+
+
+def claim_messages_blocking(
+    r: Redis, count: int, timeout: float, lease_seconds: float = LEASE_SECONDS
+) -> List[ClaimedMessage]:
+    """
+    Like claim_messages, but wait up to "timeout" seconds for a message when all lanes are empty.
+    Returns an empty list on timeout.
+    """
+    claimed = claim_messages(r, count, lease_seconds)
+    if not claimed and r.blpop([QUEUE_DOORBELL_LIST], timeout) is not None:
+        claimed = claim_messages(r, count, lease_seconds)
+    return claimed
+
+
+def ack_messages(
+    p: Pipeline,
+    claimed: List[ClaimedMessage],
+    statuses: List[MessageDeliveryStatus],
+) -> None:
+    """
+    Queue on "p" the release of processed messages that are still leased by this claim, counting them
+    in their new statuses. Put it in the same MULTI as the results.
+    """
+    args = [MessageDeliveryStatus.checking_for_spam.value]
+    for message, status in zip(claimed, statuses):
+        args += [message.id, message.lease_token, status.value]
+    # EVAL rather than the registered script: a pipeline with scripts checks SCRIPT EXISTS in a round-trip of its own
+    p.eval(ACK_SCRIPT, len(QUEUE_KEYS), *QUEUE_KEYS, *args)
+
+
+def reap_expired_leases(r: Redis, batch_size: int = 100) -> Tuple[int, int]:
+    """
+    Requeue messages whose worker didn't finish them in time, e.g. because it crashed.
+    Returns how many messages were requeued and how many went to the dead-letter list.
+    """
+    reap = get_script(r, REAP_SCRIPT)
+    requeued, dead = reap(
+        keys=QUEUE_KEYS,
+        args=[
+            batch_size,
+            MAX_DELIVERY_ATTEMPTS,
+            MESSAGE_QUEUE_CHANNEL,
+            LANES.index(QueueLane.regular),
+            MessageDeliveryStatus.queued.value,
+            MessageDeliveryStatus.checking_for_spam.value,
+        ],
+    )
+    if not requeued and not dead:
+        return 0, 0
+
+    # Status sets live in the senders' slots, so they're updated outside of the script
+    p = r.pipeline(transaction=False)
+    for message_id, sender in zip(requeued[::2], requeued[1::2]):
+        if sender:
+            set_outbound_message_status(
+                p, sender, message_id, MessageDeliveryStatus.queued
+            )
+    for message_id, sender in zip(dead[::2], dead[1::2]):
+        if sender:
+            for status in (
+                MessageDeliveryStatus.queued,
+                MessageDeliveryStatus.checking_for_spam,
+            ):
+                p.srem(get_outbound_messages_set_name(sender, status), message_id)
+    # Cached stats of the senders still count the messages as being checked
+    invalidate_user_caches(
+        p, "user_stats", [sender for sender in requeued[1::2] + dead[1::2] if sender]
+    )
+    p.execute()
+    return len(requeued) // 2, len(dead) // 2
+
+
+def fetch_lane_lengths(p: Pipeline) -> None:
+    """ Queue on "p" the LLEN of every lane, in LANES order. """
+    for lane in LANES:
+        p.llen(get_lane_queue_name(lane))
+
+
+def get_message_lane(r: Redis, message_id: int) -> Tuple[QueueLane, str]:
+    """
+    Get the lane and the sender a message was enqueued with.
+    Without a record of them, like the reaper, fall back to the regular lane and an empty sender.
+    """
+    lane_of = r.hget(MESSAGE_LANES_HASH, message_id)
+    if lane_of is None:
+        return QueueLane.regular, ""
+    lane_index, _, sender = lane_of.partition(":")
+    return LANES[int(lane_index)], sender
+
+
+def fetch_dead_letters(r: Redis) -> List[int]:
+    """ Get ids of messages that failed processing too many times. """
+    return [int(message_id) for message_id in r.lrange(DEAD_LETTER_LIST, 0, -1)]
+
+
+def requeue_dead_letters(r: Redis) -> int:
+    """ Give every dead-lettered message another round of attempts in its lane. """
+    requeued = 0
+    while True:
+        message_id = r.lpop(DEAD_LETTER_LIST)
+        if message_id is None:
+            return requeued
+        lane, sender = get_message_lane(r, message_id)
+        p = r.pipeline()
+        enqueue_message(p, message_id, lane, sender)
+        if sender:
+            set_outbound_message_status(
+                p, sender, message_id, MessageDeliveryStatus.queued
+            )
+        change_status_count(p, MessageDeliveryStatus.queued, 1)
+        p.publish(MESSAGE_QUEUE_CHANNEL, message_id)
+        p.execute()
+        requeued += 1
+
+
+class LeaseReaper(threading.Thread):
+    """ Periodically requeue expired leases. Any number of reapers can run, the reap script is atomic. """
+
+    def __init__(self, r: Redis, interval: float = REAPER_INTERVAL_SECONDS):
+        super().__init__(daemon=True)
+        self.redis = r
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            requeued, dead = reap_expired_leases(self.redis)
+            while requeued or dead:
+                print(self, f"requeued {requeued}, dead-lettered {dead} messages")
+                requeued, dead = reap_expired_leases(self.redis)
+
+    def stop(self):
+        self.stopped.set()
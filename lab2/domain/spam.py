@@ -0,0 +1,115 @@
+import random
+import re
+import zlib
+from abc import abstractmethod
+from time import sleep
+from typing import List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by the naive Bayes backend
+    np = None
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class SpamClassifier:
+    """ Gives a spam verdict for each message content in a batch. """
+
+    @abstractmethod
+    def classify(self, contents: Sequence[str]) -> List[bool]:
+        ...
+
+    def fit(self, contents: Sequence[str], labels: Sequence[bool]) -> None:
+        """ Learn from already labelled messages. Backends that can't learn ignore it. """
+
+
+class SimulatedSpamClassifier(SpamClassifier):
+    """ Imitate a spam check: sleep 1-2 seconds per batch and flip a coin per message. """
+
+    def classify(self, contents: Sequence[str]) -> List[bool]:
+        if not contents:
+            return []
+        sleep(random.randrange(1, 3))
+        return [random.choice([True, False]) for _ in contents]
+
+
+class DeterministicSpamClassifier(SpamClassifier):
+    """
+    Instant, repeatable verdicts for tests and benchmarks: a content is spam
+    when its checksum falls into the first "spam_percent" of 100 buckets.
+    """
+
+    def __init__(self, spam_percent: int = 50):
+        self.spam_percent = spam_percent
+
+    def classify(self, contents: Sequence[str]) -> List[bool]:
+        return [
+            zlib.crc32(content.encode()) % 100 < self.spam_percent for content in contents
+        ]
+
+
+class NaiveBayesSpamClassifier(SpamClassifier):
+    """
+    Multinomial naive Bayes over hashed word tokens.
+    A whole batch is scored with a couple of vectorised NumPy operations.
+    """
+
+    def __init__(self, n_features: int = 2 ** 18, alpha: float = 1.0):
+        if np is None:
+            raise RuntimeError("The 'naive_bayes' spam backend requires the numpy package")
+        self.n_features = n_features
+        self.alpha = alpha
+        # Row 0 counts tokens of legitimate messages, row 1 of spam messages
+        self.token_counts = np.zeros((2, n_features))
+        self.class_counts = np.zeros(2)
+        self._update_log_probabilities()
+
+    def _hash_tokens(self, contents: Sequence[str]):
+        """ Get (message index, token bucket) pairs for every token in the batch. """
+        rows: List[int] = []
+        columns: List[int] = []
+        for row, content in enumerate(contents):
+            for token in TOKEN_PATTERN.findall(content.lower()):
+                rows.append(row)
+                columns.append(zlib.crc32(token.encode()) % self.n_features)
+        return np.array(rows, dtype=np.intp), np.array(columns, dtype=np.intp)
+
+    def _update_log_probabilities(self):
+        self.log_prior = np.log(self.class_counts + self.alpha) - np.log(
+            self.class_counts.sum() + 2 * self.alpha
+        )
+        self.log_likelihood = np.log(self.token_counts + self.alpha) - np.log(
+            self.token_counts.sum(axis=1, keepdims=True) + self.alpha * self.n_features
+        )
+
+    def fit(self, contents: Sequence[str], labels: Sequence[bool]) -> None:
+        labels = np.asarray(labels, dtype=np.intp)
+        rows, columns = self._hash_tokens(contents)
+        np.add.at(self.token_counts, (labels[rows], columns), 1)
+        self.class_counts += np.bincount(labels, minlength=2)
+        self._update_log_probabilities()
+
+    def classify(self, contents: Sequence[str]) -> List[bool]:
+        if not contents:
+            return []
+        rows, columns = self._hash_tokens(contents)
+        scores = np.tile(self.log_prior, (len(contents), 1))
+        np.add.at(scores, rows, self.log_likelihood[:, columns].T)
+        return [bool(is_spam) for is_spam in scores[:, 1] > scores[:, 0]]
+
+
+SPAM_CLASSIFIERS = {
+    "simulated": SimulatedSpamClassifier,
+    "deterministic": DeterministicSpamClassifier,
+    "naive_bayes": NaiveBayesSpamClassifier,
+}
+
+
+def get_spam_classifier(name: str) -> SpamClassifier:
+    if name not in SPAM_CLASSIFIERS:
+        raise ValueError(
+            f"Unknown spam backend '{name}', choose from {list(SPAM_CLASSIFIERS)}"
+        )
+    return SPAM_CLASSIFIERS[name]()
@@ -13,11 +13,19 @@ from domain.redis_structures import (
 )
 
 
+def user_exists(r: Redis, username: str) -> bool:
+    """ Check both user sets, without a SUNION their Redis Cluster slots may differ. """
+    p = r.pipeline(transaction=False)
+    p.sismember(REGULAR_USERS_SET, username)
+    p.sismember(ADMIN_USERS_SET, username)
+    return any(p.execute())
+
+
 def login_user(r: Redis, username: str) -> None:
     """Notify subscribers about the 'login' event.
     Make the user appear online, adding him to the "online" Redis set.
     """
-    if username not in r.sunion(REGULAR_USERS_SET, ADMIN_USERS_SET):
+    if not user_exists(r, username):
         raise UsernameNotFoundException(username)
     elif r.sismember(ONLINE_USERS_SET, username):
         raise AlreadyLoggedInException(username)
@@ -30,7 +38,7 @@ def logout_user(r: Redis, username: str) -> None:
     """Notify subscribers about the 'logout' event.
     Make the user appear offline, removing him from the "online" Redis set.
     """
-    if username not in r.sunion(REGULAR_USERS_SET, ADMIN_USERS_SET):
+    if not user_exists(r, username):
         raise UsernameNotFoundException(username)
     elif not r.sismember(ONLINE_USERS_SET, username):
         raise NotLoggedInException(username)
@@ -0,0 +1,66 @@
+from enum import Enum, unique
+
+from redis.client import Pipeline
+
+from domain.redis_structures import (
+    INBOUND_MESSAGES_SET,
+    INBOX_DELIVERIES_STREAM,
+    MESSAGE_STATUS_COUNTS_HASH,
+    OUTBOUND_MESSAGES_SET,
+)
+
+
+@unique
+class MessageDeliveryStatus(Enum):
+    queued = "queued"
+    checking_for_spam = "checking_for_spam"
+    blocked_for_spam = "blocked_for_spam"
+    sent = "sent"
+    delivered = "delivered"
+
+
+# Statuses that have a set of the sender's messages
+OUTBOUND_STATUSES = [
+    MessageDeliveryStatus.queued,
+    MessageDeliveryStatus.checking_for_spam,
+    MessageDeliveryStatus.blocked_for_spam,
+    MessageDeliveryStatus.delivered,
+]
+
+
+def get_user_tag(username: str) -> str:
+    """ Hash tag putting all keys of the user into the same Redis Cluster slot. """
+    return f"{{{username}}}"
+
+
+def get_outbound_messages_set_name(sender: str, status: MessageDeliveryStatus) -> str:
+    return f"{OUTBOUND_MESSAGES_SET}:{get_user_tag(sender)}:{status.value}"
+
+
+def get_inbound_messages_set_name(recipient: str) -> str:
+    return f"{INBOUND_MESSAGES_SET}:{get_user_tag(recipient)}"
+
+
+def get_inbox_deliveries_stream_name(recipient: str) -> str:
+    return f"{INBOX_DELIVERIES_STREAM}:{get_user_tag(recipient)}"
+
+
+def set_outbound_message_status(
+    p: Pipeline, sender: str, message_id: int, status: MessageDeliveryStatus
+) -> None:
+    """
+    Queue on "p" the commands moving the message to the sender's set of "status".
+    It's removed from all the other sets rather than SMOVEd, so a status set concurrently,
+    e.g. by the lease reaper, can't leave the message in two sets.
+    Callers move the global counts with change_status_count, once per batch.
+    """
+    for other_status in OUTBOUND_STATUSES:
+        if other_status != status:
+            p.srem(get_outbound_messages_set_name(sender, other_status), message_id)
+    p.sadd(get_outbound_messages_set_name(sender, status), message_id)
+
+
+def change_status_count(p: Pipeline, status: MessageDeliveryStatus, amount: int) -> None:
+    """ Queue on "p" a change of the global number of messages in "status", exported as a gauge. """
+    if amount:
+        p.hincrby(MESSAGE_STATUS_COUNTS_HASH, status.value, amount)
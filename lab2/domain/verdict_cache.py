@@ -0,0 +1,116 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from redis import Redis
+
+from domain.metrics import increment_counters
+from domain.redis_structures import SPAM_VERDICT_CACHE
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def get_content_hash(content: str) -> str:
+    """ Hash the content normalised for case and whitespace, so trivial variations share a verdict. """
+    normalised = WHITESPACE_PATTERN.sub(" ", content).strip().lower()
+    return hashlib.blake2b(normalised.encode(), digest_size=16).hexdigest()
+
+
+def get_verdict_key_name(content_hash: str) -> str:
+    return f"{SPAM_VERDICT_CACHE}:{content_hash}"
+
+
+class VerdictCache:
+    """
+    Spam verdicts keyed by content hash: a small in-process LRU in front of
+    Redis keys with a TTL, which are shared by all workers.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: int = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_local(self, content_hash: str) -> Optional[bool]:
+        with self._lock:
+            entry = self._local.get(content_hash)
+            if entry is None:
+                return None
+            verdict, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._local[content_hash]
+                return None
+            self._local.move_to_end(content_hash)
+            return verdict
+
+    def _set_local(
+        self, content_hash: str, verdict: bool, ttl: Optional[float] = None
+    ) -> None:
+        """ Keep the verdict for "ttl" seconds, the cache's TTL by default. """
+        with self._lock:
+            self._local[content_hash] = (
+                verdict,
+                time.monotonic() + (self.ttl if ttl is None else ttl),
+            )
+            self._local.move_to_end(content_hash)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def clear(self) -> None:
+        """ Drop the verdicts of this process, the ones in Redis stay. """
+        with self._lock:
+            self._local.clear()
+
+    def get_many(self, r: Redis, content_hashes: Iterable[str]) -> Dict[str, bool]:
+        """ Get the cached verdicts, missing hashes are left out of the result. """
+        verdicts: Dict[str, bool] = {}
+        remote_hashes = []
+        for content_hash in content_hashes:
+            verdict = self._get_local(content_hash)
+            if verdict is None:
+                remote_hashes.append(content_hash)
+            else:
+                verdicts[content_hash] = verdict
+        local_hits = len(verdicts)
+
+        remote_hits = 0
+        if remote_hashes:
+            # GETs rather than an MGET: verdict keys are spread over all Redis Cluster slots.
+            # A verdict from Redis is only kept locally for as long as its key lives.
+            p = r.pipeline(transaction=False)
+            for content_hash in remote_hashes:
+                p.get(get_verdict_key_name(content_hash))
+                p.pttl(get_verdict_key_name(content_hash))
+            results = p.execute()
+            for content_hash, verdict, ttl_ms in zip(
+                remote_hashes, results[::2], results[1::2]
+            ):
+                if verdict is not None:
+                    verdicts[content_hash] = verdict == "1"
+                    self._set_local(
+                        content_hash,
+                        verdicts[content_hash],
+                        ttl_ms / 1000 if ttl_ms >= 0 else None,
+                    )
+                    remote_hits += 1
+
+        increment_counters(
+            r,
+            {
+                'spam_verdict_cache_hits_total{layer="local"}': local_hits,
+                'spam_verdict_cache_hits_total{layer="redis"}': remote_hits,
+                "spam_verdict_cache_misses_total": len(remote_hashes) - remote_hits,
+            },
+        )
+        return verdicts
+
+    def set_many(self, r: Redis, verdicts: Dict[str, bool]) -> None:
+        p = r.pipeline(transaction=False)
+        for content_hash, verdict in verdicts.items():
+            self._set_local(content_hash, verdict)
+            p.set(get_verdict_key_name(content_hash), int(verdict), ex=self.ttl)
+        p.execute()
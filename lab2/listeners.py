@@ -0,0 +1,36 @@
+"""
+Pub/sub driven processing outside of the HTTP app: records the event journal, processes queued messages
+as they're announced and requeues expired leases. Run it next to any number of app replicas:
+
+    python3 listeners.py --redis-url redis://redis:6379/0
+"""
+import argparse
+import signal
+
+from domain.config import add_redis_arguments, create_redis_from_args
+from domain.db import seed_db, start_listeners
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the event journal and message queue listeners.")
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    r = create_redis_from_args(args)
+    seed_db(r)
+    listeners = start_listeners(r)
+
+    def shutdown(signum, frame):
+        print(f"Got signal {signum}, stopping listeners")
+        for listener in listeners:
+            listener.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for listener in listeners:
+        listener.join()
+
+
+if __name__ == "__main__":
+    main()
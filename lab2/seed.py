@@ -0,0 +1,27 @@
+"""
+Add the default users to Redis. Idempotent, so it's safe to run on every deploy:
+
+    python3 seed.py --redis-url redis://redis:6379/0
+    # wipe everything first, e.g. to reset a development database
+    python3 seed.py --flush
+"""
+import argparse
+
+from domain.config import add_redis_arguments, create_redis_from_args
+from domain.db import seed_db
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed Redis with the default users.")
+    add_redis_arguments(parser)
+    parser.add_argument("--flush", action="store_true", help="Delete all data in Redis first")
+    args = parser.parse_args()
+
+    r = create_redis_from_args(args)
+    if args.flush:
+        r.flushall()
+    seed_db(r)
+
+
+if __name__ == "__main__":
+    main()
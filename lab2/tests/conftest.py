@@ -0,0 +1,35 @@
+import pytest
+
+from bench.fixtures import add_users, clear_local_caches, redis_backend
+from domain import message
+from domain.archive import MessageArchive
+from domain.spam import get_spam_classifier
+
+
+@pytest.fixture
+def r():
+    """ A seeded fakeredis client, with empty in-process caches. """
+    clear_local_caches()
+    with redis_backend("fakeredis") as client:
+        yield client
+    clear_local_caches()
+
+
+@pytest.fixture
+def users(r):
+    return add_users(r, 3)
+
+
+@pytest.fixture(autouse=True)
+def archive(tmp_path, monkeypatch):
+    """ An archive of its own per test, instead of archive.sqlite3 in the working directory. """
+    archive = MessageArchive(str(tmp_path / "archive.sqlite3"))
+    monkeypatch.setattr(message, "message_archive", archive)
+    return archive
+
+
+@pytest.fixture(autouse=True)
+def deterministic_spam_check(monkeypatch):
+    monkeypatch.setattr(
+        message, "spam_classifier", get_spam_classifier("deterministic")
+    )
@@ -0,0 +1,66 @@
+import pytest
+
+from domain import message
+from domain.archive import MessageArchive
+from domain.exceptions import MessageNotFoundException
+from domain.message import (
+    archive_finished_messages,
+    create_message,
+    fetch_messages,
+    fetch_messaging_stats_for_user,
+    fetch_pipeline_gauges,
+    fetch_user_inbound_messages,
+    process_enqueued_messages,
+)
+from domain.read_cache import caches
+
+
+def send_and_process(r, sender, recipient, count):
+    message_ids = [
+        create_message(r, dict(sender=sender, recipient=recipient, content=f"message {i}"))
+        for i in range(count)
+    ]
+    process_enqueued_messages(r, count)
+    return message_ids
+
+
+def test_archived_messages_are_read_from_the_archive(r, users, archive):
+    message_ids = send_and_process(r, users[0], users[1], 10)
+    messages = fetch_messages(r, message_ids)
+    inbox = fetch_user_inbound_messages(r, users[1])
+    stats = fetch_messaging_stats_for_user(r, users[0])
+
+    assert archive_finished_messages(r, older_than_seconds=-1) == 10
+    assert archive.exists()
+    for cache in caches.values():
+        cache.clear()
+    assert fetch_messages(r, message_ids) == messages
+    assert sorted(fetch_user_inbound_messages(r, users[1]), key=lambda m: m["id"]) == sorted(
+        inbox, key=lambda m: m["id"]
+    )
+    assert fetch_messaging_stats_for_user(r, users[0]) == stats
+
+
+def test_recent_messages_stay_in_redis(r, users, archive):
+    send_and_process(r, users[0], users[1], 3)
+    assert archive_finished_messages(r, older_than_seconds=3600) == 0
+    assert not archive.exists()
+
+
+def test_archived_messages_leave_the_status_gauges(r, users):
+    send_and_process(r, users[0], users[1], 6)
+    archive_finished_messages(r, older_than_seconds=-1)
+    gauges = fetch_pipeline_gauges(r)
+    assert gauges['messages{status="delivered"}'] == 0
+    assert gauges['messages{status="blocked_for_spam"}'] == 0
+
+
+def test_messages_archived_elsewhere_fail_loudly(r, users, tmp_path, monkeypatch):
+    message_ids = send_and_process(r, users[0], users[1], 2)
+    archive_finished_messages(r, older_than_seconds=-1)
+    # A replica that doesn't see the compactor's archive
+    elsewhere = MessageArchive(str(tmp_path / "elsewhere.sqlite3"))
+    monkeypatch.setattr(message, "message_archive", elsewhere)
+    with pytest.raises(MessageNotFoundException) as missing:
+        fetch_messages(r, message_ids)
+    assert missing.value.message_ids == message_ids
@@ -0,0 +1,39 @@
+import pytest
+
+from domain import codec
+from domain.codec import CODECS, decode_message, encode_message, get_codec
+from domain.message import create_message, fetch_messages
+
+MESSAGE = dict(sender="Alice", recipient="Малорі", content="Привіт 👋\n" * 3)
+
+
+@pytest.mark.parametrize("name", CODECS)
+def test_round_trip(name):
+    message_codec = get_codec(name)
+    assert message_codec.decode(message_codec.encode(MESSAGE)) == MESSAGE
+
+
+@pytest.mark.parametrize("name", CODECS)
+def test_messages_stay_readable_after_switching_codecs(name, monkeypatch):
+    monkeypatch.setattr(codec, "message_codec", get_codec(name))
+    data = encode_message(MESSAGE)
+    monkeypatch.setattr(codec, "message_codec", get_codec("json"))
+    assert decode_message(data) == MESSAGE
+
+
+def test_unknown_tag():
+    with pytest.raises(ValueError):
+        decode_message(b"?" + b"{}")
+
+
+def test_messages_are_stored_encoded(r, users):
+    message_ids = [
+        create_message(r, dict(sender=users[0], recipient=users[1], content=str(i)))
+        for i in range(3)
+    ]
+    assert [message["content"] for message in fetch_messages(r, message_ids)] == [
+        "0",
+        "1",
+        "2",
+    ]
+    assert codec.get_raw_client(r) is codec.get_raw_client(r)
@@ -0,0 +1,40 @@
+import pytest
+
+from domain import message
+from domain.message import (
+    create_message,
+    process_enqueued_messages,
+    wait_for_inbound_messages,
+)
+from domain.redis_structures import ADMIN_USERS_SET
+
+
+@pytest.fixture(autouse=True)
+def no_spam():
+    message.spam_classifier.spam_percent = 0
+
+
+def test_messages_delivered_out_of_id_order_are_pushed(r, users):
+    r.sadd(ADMIN_USERS_SET, users[2])
+    regular_id = create_message(
+        r, dict(sender=users[0], recipient=users[1], content="regular")
+    )
+    admin_id = create_message(
+        r, dict(sender=users[2], recipient=users[1], content="admin")
+    )
+
+    # The admin lane goes first, so the higher id is delivered first
+    assert process_enqueued_messages(r, 1) == 1
+    (first,) = wait_for_inbound_messages(r, users[1], "0", 0)
+    assert first["id"] == admin_id
+
+    assert process_enqueued_messages(r, 1) == 1
+    (second,) = wait_for_inbound_messages(r, users[1], first["delivery_id"], 0)
+    assert second["id"] == regular_id
+    assert second["content"] == "regular"
+    assert wait_for_inbound_messages(r, users[1], second["delivery_id"], 0) == []
+
+
+def test_waiting_returns_nothing_without_deliveries(r, users):
+    create_message(r, dict(sender=users[0], recipient=users[1], content="hi"))
+    assert wait_for_inbound_messages(r, users[1], "0", 0) == []
@@ -0,0 +1,49 @@
+from redis.crc import key_slot
+
+from domain.message import get_message_bucket_name, get_message_enqueued_at_name
+from domain.rate_limit import get_rate_limit_set_name
+from domain.reliable_queue import QUEUE_KEYS
+from domain.user_keys import (
+    OUTBOUND_STATUSES,
+    get_inbound_messages_set_name,
+    get_inbox_deliveries_stream_name,
+    get_outbound_messages_set_name,
+)
+
+
+def get_slots(keys):
+    return {key_slot(key.encode()) for key in keys}
+
+
+def test_queue_scripts_touch_a_single_slot():
+    assert len(get_slots(QUEUE_KEYS)) == 1
+
+
+def test_keys_of_a_user_share_a_slot():
+    for username in ["Alice", "bob:{x}", "ünïcode"]:
+        keys = [
+            get_inbound_messages_set_name(username),
+            get_inbox_deliveries_stream_name(username),
+            get_rate_limit_set_name(username),
+        ] + [
+            get_outbound_messages_set_name(username, status)
+            for status in OUTBOUND_STATUSES
+        ]
+        assert len(get_slots(keys)) == 1
+
+
+def test_a_message_and_its_enqueue_time_share_a_slot():
+    for message_id in [1, 99, 100, 12345]:
+        assert (
+            len(
+                get_slots(
+                    [
+                        get_message_bucket_name(message_id),
+                        get_message_enqueued_at_name(message_id),
+                    ]
+                )
+            )
+            == 1
+        )
+    # Buckets spread over the slots
+    assert len(get_slots(get_message_bucket_name(i * 100) for i in range(50))) > 1
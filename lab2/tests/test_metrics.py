@@ -0,0 +1,34 @@
+from domain.metrics import MetricsBuffer, render_metrics
+
+
+def test_buffered_timings_are_rendered_after_a_flush(r):
+    buffer = MetricsBuffer()
+    labels = dict(route="/message", method="POST", status=200)
+    buffer.observe("http_request_duration_seconds", [0.003, 0.02], labels=labels)
+    buffer.observe("http_request_duration_seconds", [0.02, 7], labels=labels)
+    assert "http_request_duration_seconds" not in render_metrics(r, {})
+
+    r.round_trips.reset()
+    buffer.flush(r)
+    assert r.round_trips.round_trips == 1
+    # Nothing left to flush
+    buffer.flush(r)
+    assert r.round_trips.round_trips == 1
+
+    lines = render_metrics(r, {"inbox_waiting_requests": 0}).splitlines()
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+    series = 'http_request_duration_seconds_bucket{route="/message",method="POST",status="200",le="%s"}'
+    for bound, cumulative in [
+        ("0.005", 1),
+        ("0.01", 1),
+        ("0.025", 3),
+        ("5", 3),
+        ("10", 4),
+        ("+Inf", 4),
+    ]:
+        assert f"{series % bound} {cumulative}" in lines
+    assert (
+        'http_request_duration_seconds_count{route="/message",method="POST",status="200"} 4'
+        in lines
+    )
+    assert "inbox_waiting_requests 0" in lines
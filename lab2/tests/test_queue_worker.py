@@ -0,0 +1,55 @@
+import time
+
+from domain import queue_worker
+from domain.message import create_message
+from domain.queue_worker import QueueWorker
+from domain.redis_structures import MESSAGE_PROCESSING_LIST
+
+
+def run_until(worker, processed, timeout=5):
+    worker.start()
+    deadline = time.monotonic() + timeout
+    while worker.processed < processed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    worker.stop()
+    worker.join(timeout)
+    assert not worker.is_alive()
+
+
+def test_worker_processes_the_queue_in_batches(r, users, monkeypatch):
+    batches = []
+    process = queue_worker.process_claimed_messages
+
+    def record_batch(r, claimed):
+        batches.append(len(claimed))
+        process(r, claimed)
+
+    monkeypatch.setattr(queue_worker, "process_claimed_messages", record_batch)
+    for i in range(5):
+        create_message(r, dict(sender=users[0], recipient=users[1], content=f"hi {i}"))
+
+    worker = QueueWorker(r, batch_size=2, block_timeout=0.05)
+    run_until(worker, 5)
+    assert worker.processed == 5
+    assert [size for size in batches if size] == [2, 2, 1]
+    assert r.llen(MESSAGE_PROCESSING_LIST) == 0
+
+
+def test_worker_keeps_running_after_a_failure(r, users, monkeypatch):
+    monkeypatch.setattr(queue_worker, "MIN_BACKOFF_SECONDS", 0.01)
+    claim = queue_worker.claim_messages_blocking
+    failures = []
+
+    def fail_once(*args):
+        if not failures:
+            failures.append(1)
+            raise ConnectionError("Redis went away")
+        return claim(*args)
+
+    monkeypatch.setattr(queue_worker, "claim_messages_blocking", fail_once)
+    create_message(r, dict(sender=users[0], recipient=users[1], content="hi"))
+
+    worker = QueueWorker(r, batch_size=2, block_timeout=0.05)
+    run_until(worker, 1)
+    assert failures == [1]
+    assert worker.processed == 1
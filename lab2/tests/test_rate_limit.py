@@ -0,0 +1,70 @@
+import pytest
+
+from domain import message, rate_limit
+from domain.exceptions import QueueOverloadedException, SenderRateLimitedException
+from domain.message import (
+    archive_finished_messages,
+    create_message,
+    process_enqueued_messages,
+)
+from domain.rate_limit import QueueDepthCheck, admit_message
+from domain.redis_structures import USERS_BY_SPAM_MESSAGES_SORTED_SET
+
+
+@pytest.fixture(autouse=True)
+def small_limit(monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT", 3)
+    monkeypatch.setattr(rate_limit, "MIN_RATE_LIMIT", 1)
+    # Re-read the queue depth on every check
+    monkeypatch.setattr(rate_limit, "queue_depth", QueueDepthCheck(0))
+
+
+def test_sender_over_the_limit_is_refused(r, users):
+    for _ in range(3):
+        admit_message(r, users[0])
+    with pytest.raises(SenderRateLimitedException) as refused:
+        admit_message(r, users[0])
+    assert 0 < refused.value.retry_after <= rate_limit.RATE_LIMIT_WINDOW_SECONDS
+    # Other senders have windows of their own
+    admit_message(r, users[1])
+
+
+def test_zero_limit_refuses_everything(r, users, monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT", 0)
+    monkeypatch.setattr(rate_limit, "MIN_RATE_LIMIT", 0)
+    with pytest.raises(SenderRateLimitedException) as refused:
+        admit_message(r, users[0])
+    assert refused.value.retry_after == rate_limit.RATE_LIMIT_WINDOW_SECONDS
+
+
+def test_spammers_get_a_lower_limit(r, users):
+    r.zadd(
+        USERS_BY_SPAM_MESSAGES_SORTED_SET, {users[0]: rate_limit.MIN_CHECKED_MESSAGES}
+    )
+    admit_message(r, users[0])
+    with pytest.raises(SenderRateLimitedException):
+        admit_message(r, users[0])
+
+
+def test_archiving_keeps_the_spam_history(r, users):
+    message.spam_classifier.spam_percent = 100
+    for i in range(rate_limit.MIN_CHECKED_MESSAGES):
+        create_message(r, dict(sender=users[0], recipient=users[1], content=f"buy {i}"))
+    process_enqueued_messages(r, rate_limit.MIN_CHECKED_MESSAGES)
+    assert (
+        archive_finished_messages(r, older_than_seconds=-1)
+        == rate_limit.MIN_CHECKED_MESSAGES
+    )
+
+    admit_message(r, users[0])
+    with pytest.raises(SenderRateLimitedException):
+        admit_message(r, users[0])
+
+
+def test_deep_queue_refuses_messages(r, users, monkeypatch):
+    monkeypatch.setattr(rate_limit, "MAX_QUEUE_DEPTH", 2)
+    for _ in range(2):
+        admit_message(r, users[0])
+        create_message(r, dict(sender=users[0], recipient=users[1], content="hi"))
+    with pytest.raises(QueueOverloadedException):
+        admit_message(r, users[1])
@@ -0,0 +1,62 @@
+import threading
+
+from domain.message import create_message, fetch_messaging_stats_for_user
+from domain.read_cache import TTLCache
+from domain.reliable_queue import claim_messages, reap_expired_leases
+from domain.user_keys import MessageDeliveryStatus, set_outbound_message_status
+
+
+def load_while(cache, key, during):
+    """ Load "key" with "during" called in the middle of the load, return what the cache holds afterwards. """
+    loading = threading.Event()
+    loaded = threading.Event()
+
+    def load():
+        loading.set()
+        loaded.wait()
+        return "stale"
+
+    thread = threading.Thread(target=cache.get_or_load, args=(key, load))
+    thread.start()
+    loading.wait()
+    during()
+    loaded.set()
+    thread.join()
+    return cache.get_or_load(key, lambda: "fresh")
+
+
+def test_hits_and_misses():
+    cache = TTLCache(max_size=2, ttl=60)
+    assert cache.get_or_load("a", lambda: 1) == 1
+    assert cache.get_or_load("a", lambda: 2) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TTLCache(max_size=2, ttl=60)
+    for key in "abc":
+        cache.get_or_load(key, lambda: key)
+    assert cache.get_or_load("a", lambda: "reloaded") == "reloaded"
+
+
+def test_invalidation_during_a_load_discards_it():
+    cache = TTLCache(max_size=10, ttl=60)
+    assert load_while(cache, "a", lambda: cache.invalidate("a")) == "fresh"
+
+
+def test_invalidation_of_another_key_keeps_the_load():
+    cache = TTLCache(max_size=10, ttl=60)
+    assert load_while(cache, "a", lambda: cache.invalidate("b")) == "stale"
+    assert not cache._invalidations and not cache._loading
+
+
+def test_reaped_messages_refresh_the_senders_stats(r, users):
+    create_message(r, dict(sender=users[0], recipient=users[1], content="hi"))
+    claim_messages(r, 1, lease_seconds=-1)
+    # What the worker does with the claimed message before it dies
+    set_outbound_message_status(r, users[0], 1, MessageDeliveryStatus.checking_for_spam)
+    assert fetch_messaging_stats_for_user(r, users[0])["being_spam_checked"] == 1
+
+    assert reap_expired_leases(r) == (1, 0)
+    stats = fetch_messaging_stats_for_user(r, users[0])
+    assert (stats["enqueued"], stats["being_spam_checked"]) == (1, 0)
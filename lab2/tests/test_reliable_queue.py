@@ -0,0 +1,160 @@
+import pytest
+
+from domain import reliable_queue
+from domain.message import (
+    create_message,
+    fetch_pipeline_gauges,
+    process_claimed_messages,
+    process_enqueued_messages,
+)
+from domain.redis_structures import (
+    ADMIN_USERS_SET,
+    MESSAGE_LEASES_SORTED_SET,
+    MESSAGE_PROCESSING_LIST,
+)
+from domain.reliable_queue import (
+    QueueLane,
+    claim_messages,
+    fetch_dead_letters,
+    reap_expired_leases,
+    requeue_dead_letters,
+)
+from domain.user_keys import (
+    OUTBOUND_STATUSES,
+    MessageDeliveryStatus,
+    get_outbound_messages_set_name,
+)
+
+
+def send(r, sender, recipient, count=1):
+    return [
+        create_message(r, dict(sender=sender, recipient=recipient, content=f"hi {i}"))
+        for i in range(count)
+    ]
+
+
+def get_status(r, sender, message_id):
+    return [
+        status
+        for status in OUTBOUND_STATUSES
+        if r.sismember(get_outbound_messages_set_name(sender, status), message_id)
+    ]
+
+
+def test_claim_leases_messages_in_order(r, users):
+    message_ids = send(r, users[0], users[1], 3)
+    claimed = claim_messages(r, 2)
+    assert [message.id for message in claimed] == message_ids[:2]
+    assert {message.lane for message in claimed} == {QueueLane.regular}
+    assert r.lrange(MESSAGE_PROCESSING_LIST, 0, -1) == [str(i) for i in message_ids[:2]]
+    assert r.zcard(MESSAGE_LEASES_SORTED_SET) == 2
+
+
+def test_admin_lane_goes_first(r, users):
+    r.sadd(ADMIN_USERS_SET, users[2])
+    regular_ids = send(r, users[0], users[1], 2)
+    admin_ids = send(r, users[2], users[1], 2)
+    claimed = claim_messages(r, 4)
+    assert [message.id for message in claimed][:2] == admin_ids
+    assert sorted(message.id for message in claimed) == sorted(regular_ids + admin_ids)
+
+
+def test_processing_acks_messages(r, users):
+    message_ids = send(r, users[0], users[1], 4)
+    assert process_enqueued_messages(r, 10) == 4
+    assert r.llen(MESSAGE_PROCESSING_LIST) == 0
+    assert r.zcard(MESSAGE_LEASES_SORTED_SET) == 0
+    for message_id in message_ids:
+        assert get_status(r, users[0], message_id) in (
+            [MessageDeliveryStatus.blocked_for_spam],
+            [MessageDeliveryStatus.delivered],
+        )
+    assert reap_expired_leases(r) == (0, 0)
+
+
+def test_expired_leases_are_requeued(r, users):
+    message_ids = send(r, users[0], users[1], 2)
+    claimed = claim_messages(r, 2, lease_seconds=-1)
+    assert reap_expired_leases(r) == (2, 0)
+    assert r.llen(MESSAGE_PROCESSING_LIST) == 0
+    for message_id in message_ids:
+        assert get_status(r, users[0], message_id) == [MessageDeliveryStatus.queued]
+    # Back at the front of the lane, in their original order
+    reclaimed = claim_messages(r, 2)
+    assert [message[:2] for message in reclaimed] == [message[:2] for message in claimed]
+    assert {message.lease_token for message in reclaimed}.isdisjoint(
+        message.lease_token for message in claimed
+    )
+
+
+def test_leases_that_did_not_expire_stay(r, users):
+    send(r, users[0], users[1])
+    claim_messages(r, 1, lease_seconds=60)
+    assert reap_expired_leases(r) == (0, 0)
+    assert r.llen(MESSAGE_PROCESSING_LIST) == 1
+
+
+def test_failing_messages_are_dead_lettered(r, users, monkeypatch):
+    monkeypatch.setattr(reliable_queue, "MAX_DELIVERY_ATTEMPTS", 2)
+    (message_id,) = send(r, users[0], users[1])
+    claim_messages(r, 1, lease_seconds=-1)
+    assert reap_expired_leases(r) == (1, 0)
+    claim_messages(r, 1, lease_seconds=-1)
+    assert reap_expired_leases(r) == (0, 1)
+    assert fetch_dead_letters(r) == [message_id]
+    assert get_status(r, users[0], message_id) == []
+
+    assert requeue_dead_letters(r) == 1
+    assert fetch_dead_letters(r) == []
+    assert get_status(r, users[0], message_id) == [MessageDeliveryStatus.queued]
+    assert [message.id for message in claim_messages(r, 1)] == [message_id]
+
+
+def test_dead_letters_without_a_lane_go_to_the_regular_lane(r, users):
+    r.rpush(reliable_queue.DEAD_LETTER_LIST, 42)
+    assert requeue_dead_letters(r) == 1
+    (claimed,) = claim_messages(r, 1)
+    assert (claimed.id, claimed.lane) == (42, QueueLane.regular)
+
+
+def test_late_ack_leaves_the_new_claim_alone(r, users):
+    (message_id,) = send(r, users[0], users[1])
+    expired = claim_messages(r, 1, lease_seconds=-1)
+    assert reap_expired_leases(r) == (1, 0)
+    reclaimed = claim_messages(r, 1, lease_seconds=60)
+
+    # The first worker finishes after its lease expired
+    process_claimed_messages(r, expired)
+    assert r.lrange(MESSAGE_PROCESSING_LIST, 0, -1) == [str(message_id)]
+    assert r.zscore(MESSAGE_LEASES_SORTED_SET, message_id) is not None
+    assert fetch_pipeline_gauges(r)['messages{status="checking_for_spam"}'] == 1
+
+    process_claimed_messages(r, reclaimed)
+    assert r.llen(MESSAGE_PROCESSING_LIST) == 0
+    assert r.zcard(MESSAGE_LEASES_SORTED_SET) == 0
+    gauges = fetch_pipeline_gauges(r)
+    assert gauges['messages{status="checking_for_spam"}'] == 0
+    assert (
+        gauges['messages{status="delivered"}']
+        + gauges['messages{status="blocked_for_spam"}']
+        == 1
+    )
+
+
+@pytest.mark.parametrize("lease_seconds", [60, -1])
+def test_status_gauges_follow_the_messages(r, users, lease_seconds):
+    send(r, users[0], users[1], 5)
+    process_claimed_messages(r, claim_messages(r, 2))
+    claimed = claim_messages(r, 2, lease_seconds=lease_seconds)
+    gauges = fetch_pipeline_gauges(r)
+    assert gauges['messages{status="queued"}'] == 1
+    assert gauges['messages{status="checking_for_spam"}'] == 2
+
+    # The worker finishes its batch, or dies and the reaper requeues it
+    if lease_seconds > 0:
+        process_claimed_messages(r, claimed)
+    assert reap_expired_leases(r) == ((2, 0) if lease_seconds < 0 else (0, 0))
+    gauges = fetch_pipeline_gauges(r)
+    for status in OUTBOUND_STATUSES:
+        in_sets = r.scard(get_outbound_messages_set_name(users[0], status))
+        assert gauges[f'messages{{status="{status.value}"}}'] == in_sets
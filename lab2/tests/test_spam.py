@@ -0,0 +1,46 @@
+import pytest
+
+from domain import message
+from domain.message import (
+    create_message,
+    process_enqueued_messages,
+    train_spam_classifier,
+)
+from domain.spam import get_spam_classifier
+
+SPAM = ["buy cheap pills now", "cheap pills, buy now!!", "win money now, buy"]
+HAM = ["see you at lunch", "lunch at noon?", "meeting notes attached"]
+
+
+def test_unknown_backend_is_refused():
+    with pytest.raises(ValueError):
+        get_spam_classifier("oracle")
+
+
+def test_naive_bayes_learns_from_labelled_messages():
+    pytest.importorskip("numpy")
+    classifier = get_spam_classifier("naive_bayes")
+    classifier.fit(SPAM + HAM, [True] * len(SPAM) + [False] * len(HAM))
+    assert classifier.classify(["buy pills now", "lunch meeting at noon"]) == [
+        True,
+        False,
+    ]
+    assert classifier.classify([]) == []
+
+
+def test_naive_bayes_is_trained_on_checked_messages(r, users, monkeypatch):
+    pytest.importorskip("numpy")
+    contents = SPAM + HAM
+    monkeypatch.setattr(
+        message.spam_classifier, "classify", lambda batch: [c in SPAM for c in batch]
+    )
+    for content in contents:
+        create_message(r, dict(sender=users[0], recipient=users[1], content=content))
+    assert process_enqueued_messages(r, len(contents)) == len(contents)
+
+    monkeypatch.setattr(message, "spam_classifier", get_spam_classifier("naive_bayes"))
+    train_spam_classifier(r)
+    assert message.spam_check(["cheap money now", "notes from the meeting"]) == [
+        True,
+        False,
+    ]
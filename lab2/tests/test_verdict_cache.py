@@ -0,0 +1,52 @@
+import time
+
+from domain import message
+from domain.message import cached_spam_check
+from domain.verdict_cache import VerdictCache, get_content_hash, get_verdict_key_name
+
+
+class CountingClassifier:
+    def __init__(self):
+        self.checked = []
+
+    def classify(self, contents):
+        self.checked += contents
+        return ["spam" in content.lower() for content in contents]
+
+
+def test_trivial_variations_share_a_hash():
+    assert get_content_hash("Buy  NOW\n") == get_content_hash("buy now")
+    assert get_content_hash("buy now") != get_content_hash("buy later")
+
+
+def test_only_new_contents_are_checked(r, monkeypatch):
+    classifier = CountingClassifier()
+    monkeypatch.setattr(message, "spam_classifier", classifier)
+    assert cached_spam_check(r, ["spam offer", "hello", "Spam  offer"]) == [
+        True,
+        False,
+        True,
+    ]
+    assert cached_spam_check(r, ["hello", "new spam"]) == [False, True]
+    # A single check per distinct normalised content
+    assert len(classifier.checked) == 3
+    assert classifier.checked.count("hello") == 1
+
+
+def test_verdicts_are_shared_through_redis(r):
+    content_hash = get_content_hash("hello")
+    VerdictCache().set_many(r, {content_hash: False})
+    # Another process, with an empty local cache
+    assert VerdictCache().get_many(r, [content_hash]) == {content_hash: False}
+
+
+def test_verdicts_from_redis_expire_with_their_key(r):
+    content_hash = get_content_hash("hello")
+    VerdictCache(ttl=3600).set_many(r, {content_hash: True})
+    r.pexpire(get_verdict_key_name(content_hash), 50)
+    cache = VerdictCache(ttl=3600)
+    assert cache.get_many(r, [content_hash]) == {content_hash: True}
+
+    time.sleep(0.1)
+    # The local copy got the key's remaining lifetime, not the cache's TTL
+    assert cache.get_many(r, [content_hash]) == {}
@@ -0,0 +1,49 @@
+"""
+Standalone queue worker, run as many as needed on any machine next to the Flask app:
+
+    python3 worker.py --threads 4 --batch-size 32
+"""
+import argparse
+import signal
+
+from domain.config import add_redis_arguments, create_redis_from_args
+from domain.message import SPAM_CHECK_BATCH_SIZE, train_spam_classifier
+from domain.queue_worker import QueueWorker
+from domain.reliable_queue import LeaseReaper
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spam-check and deliver queued messages.")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=SPAM_CHECK_BATCH_SIZE)
+    parser.add_argument("--block-timeout", type=float, default=1.0)
+    add_redis_arguments(parser)
+    args = parser.parse_args()
+
+    r = create_redis_from_args(args)
+    train_spam_classifier(r)
+
+    workers = [
+        QueueWorker(r, batch_size=args.batch_size, block_timeout=args.block_timeout)
+        for _ in range(args.threads)
+    ]
+    lease_reaper = LeaseReaper(r)
+
+    def shutdown(signum, frame):
+        print(f"Got signal {signum}, finishing in-flight messages")
+        for worker in workers:
+            worker.stop()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    lease_reaper.start()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    lease_reaper.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ from random import randint, choice
 from threading import Thread
 
 from controller.Controller import Tags
-from servers.neo4j_server.Neo4jServer import Neo4jServer
 from servers.redis_server.RedisServer import RedisServer
 from faker import Faker
 
@@ -13,7 +12,7 @@ class EmulationController(Thread):
     def __init__(self, username, users_list, users_count, loop_count):
         Thread.__init__(self)
         self.__loop_count = loop_count
-        self.__server = RedisServer(Neo4jServer())
+        self.__server = RedisServer()
         self.__users_list = users_list
         self.__users_count = users_count
         self.__server.registration(username)
@@ -0,0 +1,173 @@
+import os
+import time
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+from servers.neo4j_server.Neo4jDriver import SharedDriver
+
+# Users and relations are never deleted, so their counts tell whether the snapshot is stale. New messages only
+# change the weights of the relations, counting them would export the snapshot again on nearly every query.
+GRAPH_VERSION_QUERY = "RETURN COUNT { ()-[:messages]->() } AS relations, COUNT { (:user) } AS users"
+USERS_QUERY = "MATCH (u:user) RETURN u.redis_id AS redis_id, u.name AS name ORDER BY u.redis_id"
+RELATIONS_QUERY = ("MATCH (a:user)-[r:messages]->(b:user) "
+                   "RETURN a.redis_id AS sender_id, b.redis_id AS consumer_id, r.total AS total")
+
+# The longest way shortest_way looks for, in relations
+MAX_WAY_LENGTH = 10
+# BFS trees kept for shortest ways, by the graph and the user they start from
+BFS_TREES_CACHE_SIZE = 128
+# How old the numbers of messages on relations may be for n-long relations, in seconds
+MAX_WEIGHTS_AGE = float(os.environ.get("LAB3_GRAPH_MAX_WEIGHTS_AGE", 5))
+
+
+class GraphSnapshot(object):
+    # The users and their relations in CSR arrays: the relations of user i are at positions offsets[i] to
+    # offsets[i + 1] of neighbors, relation_ids and weights. Relations are undirected, a relation between two
+    # users is at both of them, weights are the numbers of messages.
+
+    def __init__(self, names: list, relations: list):
+        self.names = names
+        self.indexes = {name: index for index, name in enumerate(names)}
+        self.relations_count = len(relations)
+        degrees = [0] * (len(names) + 1)
+        for sender, consumer, _ in relations:
+            degrees[sender] += 1
+            if consumer != sender:
+                degrees[consumer] += 1
+        self.offsets = array("l", [0] * (len(names) + 1))
+        for index in range(len(names)):
+            self.offsets[index + 1] = self.offsets[index] + degrees[index]
+        size = self.offsets[len(names)]
+        self.neighbors = array("l", [0] * size)
+        self.relation_ids = array("l", [0] * size)
+        self.weights = array("l", [0] * size)
+        positions = list(self.offsets[:-1])
+        for relation_id, (sender, consumer, weight) in enumerate(relations):
+            for user, neighbor in ((sender, consumer), (consumer, sender))[:1 if sender == consumer else 2]:
+                position = positions[user]
+                self.neighbors[position] = neighbor
+                self.relation_ids[position] = relation_id
+                self.weights[position] = weight
+                positions[user] += 1
+
+    def get_reached_with_weight(self, source, n) -> set:
+        # Users at the end of a way from "source" with exactly "n" messages on it. Like the Cypher (u1)-[*]-(u2)
+        # a way goes through a relation at most once, so this is a DFS over trails marking the relations in use.
+        # Every relation has a message at least, so a trail is cut as soon as its weight passes "n".
+        offsets, neighbors, relation_ids, weights = self.offsets, self.neighbors, self.relation_ids, self.weights
+        used = bytearray(self.relations_count)
+        reached = set()
+        # Frames are [user, weight of the trail to it, next position to try], taken the relations of the trail
+        stack = [[source, 0, offsets[source]]]
+        taken = []
+        while stack:
+            frame = stack[-1]
+            user, weight, position = frame
+            if position == offsets[user + 1]:
+                stack.pop()
+                if taken:
+                    used[taken.pop()] = 0
+                continue
+            frame[2] = position + 1
+            relation = relation_ids[position]
+            total = weight + weights[position]
+            if used[relation] or total > n:
+                continue
+            neighbor = neighbors[position]
+            if total == n:
+                reached.add(neighbor)
+            used[relation] = 1
+            taken.append(relation)
+            stack.append([neighbor, total, offsets[neighbor]])
+        reached.discard(source)
+        return reached
+
+    def get_bfs_tree(self, source) -> array:
+        # parents[i] is the user before i on a shortest way from "source", -1 for users not reached
+        parents = array("l", [-1] * len(self.names))
+        parents[source] = source
+        level = [source]
+        for _ in range(MAX_WAY_LENGTH):
+            next_level = []
+            for user in level:
+                for position in range(self.offsets[user], self.offsets[user + 1]):
+                    neighbor = self.neighbors[position]
+                    if parents[neighbor] == -1:
+                        parents[neighbor] = user
+                        next_level.append(neighbor)
+            if not next_level:
+                break
+            level = next_level
+        return parents
+
+
+class GraphAnalytics(object):
+    # Answers path queries from a snapshot of the user graph exported from Neo4j, instead of enumerating
+    # paths in the database. The snapshot is exported again when new users or relations arrive, and for
+    # n-long relations when its numbers of messages are older than MAX_WEIGHTS_AGE.
+
+    def __init__(self, driver: SharedDriver):
+        self.__driver = driver
+        self.__lock = Lock()
+        self.__version = None
+        self.__exported_at = 0.0
+        self.__snapshot = None
+        self.__bfs_trees = OrderedDict()
+
+    def __get_snapshot(self, max_weights_age=None) -> GraphSnapshot:
+        with self.__lock:
+            with self.__driver.session() as session:
+                version = tuple(session.run(GRAPH_VERSION_QUERY).single())
+                stale_weights = (max_weights_age is not None and
+                                 time.monotonic() - self.__exported_at > max_weights_age)
+                if version != self.__version or stale_weights:
+                    exported_at = time.monotonic()
+                    users = list(session.run(USERS_QUERY))
+                    indexes = {user["redis_id"]: index for index, user in enumerate(users)}
+                    relations = [(indexes[relation["sender_id"]], indexes[relation["consumer_id"]], relation["total"])
+                                 for relation in session.run(RELATIONS_QUERY)]
+                    if version != self.__version:
+                        self.__bfs_trees.clear()
+                    self.__snapshot = GraphSnapshot([user["name"] for user in users], relations)
+                    self.__version = version
+                    self.__exported_at = exported_at
+            return self.__snapshot
+
+    def __get_bfs_tree(self, snapshot: GraphSnapshot, source) -> array:
+        # Users and relations are only added, so their numbers tell graphs apart
+        key = (len(snapshot.names), snapshot.relations_count, source)
+        with self.__lock:
+            parents = self.__bfs_trees.pop(key, None)
+            if parents is None:
+                parents = snapshot.get_bfs_tree(source)
+            self.__bfs_trees[key] = parents
+            while len(self.__bfs_trees) > BFS_TREES_CACHE_SIZE:
+                self.__bfs_trees.popitem(last=False)
+            return parents
+
+    def get_users_with_n_long_relations(self, n) -> list:
+        snapshot = self.__get_snapshot(MAX_WEIGHTS_AGE)
+        pairs = []
+        seen = set()
+        for source in range(len(snapshot.names)):
+            for target in sorted(snapshot.get_reached_with_weight(source, n)):
+                pair = (min(source, target), max(source, target))
+                if pair not in seen:
+                    seen.add(pair)
+                    pairs.append([snapshot.names[source], snapshot.names[target]])
+        return pairs
+
+    def shortest_way_between_users(self, username1, username2) -> list:
+        snapshot = self.__get_snapshot()
+        if username1 not in snapshot.indexes or username2 not in snapshot.indexes:
+            raise ValueError('Invalid users names')
+        source = snapshot.indexes[username1]
+        target = snapshot.indexes[username2]
+        parents = self.__get_bfs_tree(snapshot, source)
+        if parents[target] == -1:
+            raise Exception(f"Way between {username1} and {username2} doesnt exist")
+        way = [target]
+        while way[-1] != source:
+            way.append(parents[way[-1]])
+        return [snapshot.names[user] for user in reversed(way)]
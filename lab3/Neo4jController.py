@@ -1,4 +1,5 @@
 from controller.Controller import Controller
+from servers.neo4j_server.Neo4jDriver import get_pool_stats
 from servers.neo4j_server.Neo4jServer import Neo4jServer
 from view import View
 
@@ -43,3 +44,5 @@ class Neo4jController(object):
             self.__server.get_unrelated_users_with_tagged_messages))
         View.print_list("Користувачі: ", res)
 
+    def show_pool_stats(self):
+        View.print_list("Neo4j connection pools: ", get_pool_stats())
@@ -0,0 +1,85 @@
+import os
+from contextlib import contextmanager
+from threading import Lock
+
+from neo4j import GraphDatabase
+
+# The queries are written for Neo4j 5 and its Python driver: COUNT {} subqueries, execute_write
+NEO4J_URI = os.environ.get("LAB3_NEO4J_URI", "bolt://localhost:7687")
+NEO4J_USER = os.environ.get("LAB3_NEO4J_USER", "neo4j")
+NEO4J_PASSWORD = os.environ.get("LAB3_NEO4J_PASSWORD", "123")
+# Connections of the process to the server, shared by all Neo4jServer objects and threads
+NEO4J_MAX_CONNECTION_POOL_SIZE = int(os.environ.get("LAB3_NEO4J_MAX_CONNECTION_POOL_SIZE", 50))
+# How long a session waits for a free connection before failing, in seconds
+NEO4J_CONNECTION_ACQUISITION_TIMEOUT = float(os.environ.get("LAB3_NEO4J_CONNECTION_ACQUISITION_TIMEOUT", 60))
+
+
+class SharedDriver(object):
+    # A session holds at most one connection of the pool at a time, so sessions in use show how busy the pool is
+
+    def __init__(self, uri, user, password, max_connection_pool_size, connection_acquisition_timeout):
+        self.__driver = GraphDatabase.driver(uri, auth=(user, password),
+                                             max_connection_pool_size=max_connection_pool_size,
+                                             connection_acquisition_timeout=connection_acquisition_timeout)
+        self.__uri = uri
+        self.__max_connection_pool_size = max_connection_pool_size
+        self.__lock = Lock()
+        self.__sessions_in_use = 0
+        self.__peak_sessions_in_use = 0
+        self.__sessions_opened = 0
+
+    @contextmanager
+    def session(self, **config):
+        with self.__lock:
+            self.__sessions_in_use += 1
+            self.__sessions_opened += 1
+            self.__peak_sessions_in_use = max(self.__peak_sessions_in_use, self.__sessions_in_use)
+        try:
+            with self.__driver.session(**config) as session:
+                yield session
+        finally:
+            with self.__lock:
+                self.__sessions_in_use -= 1
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "uri": self.__uri,
+                "max_connection_pool_size": self.__max_connection_pool_size,
+                "sessions_in_use": self.__sessions_in_use,
+                "peak_sessions_in_use": self.__peak_sessions_in_use,
+                "sessions_opened": self.__sessions_opened,
+                "utilisation": self.__sessions_in_use / self.__max_connection_pool_size,
+            }
+
+    def close(self):
+        self.__driver.close()
+
+
+_drivers = {}
+_drivers_lock = Lock()
+
+
+def get_driver(uri=None, user=None, password=None) -> SharedDriver:
+    # One driver, and so one connection pool, per server and user in the whole process
+    uri = uri or NEO4J_URI
+    user = user or NEO4J_USER
+    with _drivers_lock:
+        driver = _drivers.get((uri, user))
+        if driver is None:
+            driver = SharedDriver(uri, user, password or NEO4J_PASSWORD,
+                                  NEO4J_MAX_CONNECTION_POOL_SIZE, NEO4J_CONNECTION_ACQUISITION_TIMEOUT)
+            _drivers[(uri, user)] = driver
+        return driver
+
+
+def get_pool_stats() -> list:
+    with _drivers_lock:
+        return [driver.get_stats() for driver in _drivers.values()]
+
+
+def close_drivers():
+    with _drivers_lock:
+        for driver in _drivers.values():
+            driver.close()
+        _drivers.clear()
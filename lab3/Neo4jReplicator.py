@@ -0,0 +1,183 @@
+import itertools
+import logging
+import time
+import uuid
+from threading import Thread
+
+import redis
+from neo4j.exceptions import ClientError
+
+from servers.neo4j_server.Neo4jServer import Neo4jServer
+from view import View
+
+# Changes made in Redis that Neo4j hasn't got yet, appended in the same MULTI as the change itself.
+# Replicated entries are deleted, so the length of the stream is the replication backlog.
+OUTBOX_STREAM = "neo4j:outbox:"
+# Id of the last entry written to Neo4j
+CHECKPOINT_KEY = "neo4j:outbox:checkpoint:"
+# Hash with "replicated", "batches", "dead_letters", "last_batch_size" and "last_replicated_at"
+STATS_KEY = "neo4j:outbox:stats:"
+# Entries Neo4j rejected, with the "error", kept so they don't stop the replication of the others
+DEAD_LETTER_STREAM = "neo4j:outbox:dead:"
+# Token of the replicator applying the outbox. Entries depend on the ones before them, e.g. a message on the
+# registration of its users, so a single replicator at a time applies them in order.
+LOCK_KEY = "neo4j:outbox:lock:"
+# How long the lock is held without being renewed, in seconds. It's renewed before every batch.
+LOCK_TIMEOUT = 30
+
+BATCH_SIZE = 500
+BLOCK_MILLISECONDS = 1000
+RETRY_DELAY = 5
+
+# Sets the lock (KEYS[1]) to the token ARGV[1] for ARGV[2] milliseconds if it's free or already the token's.
+# Returns 1 when the lock is held by the token.
+ACQUIRE_LOCK_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+# Frees the lock (KEYS[1]) if it's still held by the token ARGV[1]
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def append_to_outbox(pipeline, event, **fields):
+    pipeline.xadd(OUTBOX_STREAM, {"event": event, **fields})
+
+
+def get_replication_lag(r) -> dict:
+    # "pending" entries wait for Neo4j, the oldest of them since "seconds" ago
+    pending = r.xlen(OUTBOX_STREAM)
+    oldest = r.xrange(OUTBOX_STREAM, count=1)
+    seconds = time.time() - int(oldest[0][0].split("-")[0]) / 1000 if oldest else 0
+    return {"pending": pending, "seconds": max(seconds, 0)}
+
+
+class Neo4jReplicator(Thread):
+
+    def __init__(self, neo4j_server: Neo4jServer, batch_size=BATCH_SIZE):
+        Thread.__init__(self)
+        self.__neo4j_server = neo4j_server
+        self.__batch_size = batch_size
+        self.__loop = True
+        self.__r = redis.Redis(charset="utf-8", decode_responses=True)
+        self.__acquire_lock = self.__r.register_script(ACQUIRE_LOCK_SCRIPT)
+        self.__release_lock = self.__r.register_script(RELEASE_LOCK_SCRIPT)
+        self.__token = uuid.uuid4().hex
+
+    def run(self):
+        self.__neo4j_server.create_schema()
+        try:
+            self.__replicate()
+        finally:
+            self.__release_lock(keys=[LOCK_KEY], args=[self.__token])
+
+    def __replicate(self):
+        checkpoint = None
+        while self.__loop:
+            if not self.__acquire_lock(keys=[LOCK_KEY], args=[self.__token, LOCK_TIMEOUT * 1000]):
+                # Another replicator applies the outbox, this one takes over if it stops
+                checkpoint = None
+                time.sleep(BLOCK_MILLISECONDS / 1000)
+                continue
+            if checkpoint is None:
+                checkpoint = self.__r.get(CHECKPOINT_KEY) or "0-0"
+            response = self.__r.xread({OUTBOX_STREAM: checkpoint}, count=self.__batch_size,
+                                      block=BLOCK_MILLISECONDS)
+            if not response:
+                continue
+            entries = response[0][1]
+            try:
+                try:
+                    self.__apply(entries)
+                except (ClientError, KeyError, ValueError):
+                    # Some entry can never be written, the others are written one by one
+                    self.__apply_each(entries)
+            except Exception as e:
+                # Neo4j is unavailable, nothing is checkpointed, the batch is retried and its writes are idempotent
+                View.show_error(f"Replication to Neo4j failed: {e}")
+                time.sleep(RETRY_DELAY)
+                continue
+            if self.__checkpoint(entries):
+                checkpoint = entries[-1][0]
+            else:
+                # The lock expired while the batch was applied, the replicator holding it now applies it again
+                checkpoint = None
+
+    def __apply(self, entries):
+        # Consecutive entries of the same event are written together, the order of the others is kept
+        for event, group in itertools.groupby((fields for _, fields in entries), key=lambda fields: fields["event"]):
+            group = list(group)
+            if event == "registration":
+                self.__neo4j_server.registrations(
+                    [{"name": fields["username"], "redis_id": fields["redis_id"]} for fields in group])
+            elif event == "sign_in":
+                self.__neo4j_server.set_online([fields["redis_id"] for fields in group], True)
+            elif event == "sign_out":
+                self.__neo4j_server.set_online([fields["redis_id"] for fields in group], False)
+            elif event == "message":
+                self.__neo4j_server.create_messages([{
+                    "sender_id": fields["sender_id"],
+                    "consumer_id": fields["consumer_id"],
+                    "id": fields["id"],
+                    "tags": fields["tags"].split(",") if fields["tags"] else []
+                } for fields in group])
+            elif event == "delivered":
+                self.__neo4j_server.deliver_messages([fields["id"] for fields in group])
+            elif event == "spam":
+                self.__neo4j_server.mark_messages_as_spam([fields["id"] for fields in group])
+            else:
+                logging.warning(f"Unknown outbox event {event} skipped")
+
+    def __apply_each(self, entries):
+        for entry_id, fields in entries:
+            try:
+                self.__apply([(entry_id, fields)])
+            except (ClientError, KeyError, ValueError) as e:
+                View.show_error(f"Outbox entry {entry_id} rejected by Neo4j: {e}")
+                pipeline = self.__r.pipeline(True)
+                pipeline.xadd(DEAD_LETTER_STREAM, {**fields, "entry_id": entry_id, "error": str(e)})
+                pipeline.hincrby(STATS_KEY, "dead_letters", 1)
+                pipeline.execute()
+
+    def __checkpoint(self, entries) -> bool:
+        # Only while the lock is held, returns whether the entries were checkpointed
+        with self.__r.pipeline(True) as pipeline:
+            try:
+                pipeline.watch(LOCK_KEY)
+                if pipeline.get(LOCK_KEY) != self.__token:
+                    return False
+                pipeline.multi()
+                pipeline.set(CHECKPOINT_KEY, entries[-1][0])
+                pipeline.xdel(OUTBOX_STREAM, *[entry_id for entry_id, _ in entries])
+                pipeline.hincrby(STATS_KEY, "replicated", len(entries))
+                pipeline.hincrby(STATS_KEY, "batches", 1)
+                pipeline.hset(STATS_KEY, mapping={"last_batch_size": len(entries), "last_replicated_at": time.time()})
+                pipeline.execute()
+            except redis.WatchError:
+                return False
+        lag = get_replication_lag(self.__r)
+        logging.info(f"Replicated {len(entries)} changes to Neo4j, {lag['pending']} pending, "
+                     f"lag {lag['seconds']:.3f}s at {time.ctime()} \n")
+        return True
+
+    def stop(self):
+        self.__loop = False
+
+
+if __name__ == '__main__':
+    replicator = Neo4jReplicator(Neo4jServer())
+    try:
+        replicator.start()
+        replicator.join()
+    except KeyboardInterrupt:
+        replicator.stop()
+        replicator.join()
@@ -1,138 +1,186 @@
-from neo4j import GraphDatabase
-
-from view import View
 from controller.Controller import Tags
+from servers.neo4j_server.GraphAnalytics import GraphAnalytics
+from servers.neo4j_server.Neo4jDriver import SharedDriver, get_driver
+
+# Created at startup by create_schema, users and messages are looked up by these properties on every write
+SCHEMA = [
+    "CREATE CONSTRAINT user_redis_id IF NOT EXISTS FOR (u:user) REQUIRE u.redis_id IS UNIQUE",
+    "CREATE CONSTRAINT user_name IF NOT EXISTS FOR (u:user) REQUIRE u.name IS UNIQUE",
+    "CREATE CONSTRAINT message_redis_id IF NOT EXISTS FOR (m:message) REQUIRE m.redis_id IS UNIQUE",
+]
+# Relations written before the counters kept every message id in r.all and r.spam. They get a message node
+# per id and counters instead, tag counts start at 0 since the tags of their messages weren't kept.
+MIGRATE_RELATIONS_QUERY = ("MATCH (a:user)-[r:messages]->(b:user) WHERE r.all IS NOT NULL "
+                           "FOREACH (id IN r.all | "
+                           "MERGE (m:message {redis_id: id}) "
+                           "ON CREATE SET m.sender_id = a.redis_id, m.consumer_id = b.redis_id, m.tags = [], "
+                           "m.spam = id IN r.spam, m.delivered = false) "
+                           "SET r.total = size(r.all), r.spam = size(r.spam), r.tag_counts = [tag IN r.tags | 0] "
+                           "REMOVE r.all")
+# Users the first version of REGISTRATIONS_QUERY took the name from, nothing reads them
+DELETE_NAMELESS_USERS_QUERY = "MATCH (u:user) WHERE u.name IS NULL DETACH DELETE u"
+
+# Queries are parameterised, so Neo4j plans each of them once and reuses the plan for any input
+# A user is identified by its redis id. A name registered again under a new id is a user Redis no longer has,
+# so the stale user and its relations are deleted first and the name constraint holds. Flushing Redis reuses
+# redis ids, a new user would get the relations of an old one with the same id, so the graph has to be
+# cleared along with Redis.
+REGISTRATIONS_QUERY = ("UNWIND $users AS user "
+                       "OPTIONAL MATCH (stale:user {name: user.name}) WHERE stale.redis_id <> user.redis_id "
+                       "DETACH DELETE stale "
+                       "WITH user "
+                       "MERGE (u:user {redis_id: user.redis_id}) "
+                       "ON CREATE SET u.online = false "
+                       "SET u.name = user.name")
+SET_ONLINE_QUERY = ("UNWIND $redis_ids AS redis_id "
+                    "MATCH (u:user {redis_id: redis_id}) SET u.online = $online")
+# Every message is a node found by its redis id. The relation between two users only counts their messages:
+# r.total, r.spam, and r.tag_counts[i] messages with the tag r.tags[i].
+# Rows are applied in order, so messages between the same users see the tags added by the previous ones.
+# The counters only change when the message node is created, the replicator may replay a batch.
+# Rows whose users aren't in Neo4j are dropped by the MATCH, the number of rows written tells them apart.
+CREATE_MESSAGES_QUERY = ("UNWIND $rows AS row "
+                         "MATCH (a:user {redis_id: row.sender_id}), (b:user {redis_id: row.consumer_id}) "
+                         "MERGE (a)-[r:messages]->(b) "
+                         "ON CREATE SET r.total = 0, r.spam = 0, r.tags = [], r.tag_counts = [] "
+                         "MERGE (m:message {redis_id: row.id}) "
+                         "ON CREATE SET m.sender_id = row.sender_id, m.consumer_id = row.consumer_id, "
+                         "m.tags = row.tags, m.spam = false, m.delivered = false, "
+                         "r.total = r.total + 1, "
+                         "r.tag_counts = [i IN range(0, size(r.tags) - 1) | "
+                         "r.tag_counts[i] + CASE WHEN r.tags[i] IN row.tags THEN 1 ELSE 0 END] + "
+                         "[tag IN row.tags WHERE NOT tag IN r.tags | 1], "
+                         "r.tags = r.tags + [tag IN row.tags WHERE NOT tag IN r.tags] "
+                         "RETURN count(*) AS written")
+MARK_MESSAGES_AS_SPAM_QUERY = ("UNWIND $redis_ids AS redis_id "
+                               "MATCH (m:message {redis_id: redis_id}) WHERE NOT m.spam "
+                               "MATCH (:user {redis_id: m.sender_id})-[r:messages]->(:user {redis_id: m.consumer_id}) "
+                               "SET m.spam = true, r.spam = r.spam + 1")
+# Users with messages tagged with all $tags, and the names of the users they have messages with
+UNRELATED_USERS_QUERY = ("MATCH (u:user)-[r:messages]-() "
+                         "WHERE all(tag IN $tags WHERE tag IN r.tags) "
+                         "WITH DISTINCT u "
+                         "RETURN u.name AS name, [(u)-[:messages]-(other:user) | other.name] AS related")
+DELIVER_MESSAGES_QUERY = ("UNWIND $redis_ids AS redis_id "
+                          "MATCH (m:message {redis_id: redis_id}) SET m.delivered = true")
 
 
 class Neo4jServer(object):
-    def __init__(self):
-        self.__driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "123"))
+    def __init__(self, driver: SharedDriver = None):
+        self.__driver = driver or get_driver()
+        self.__analytics = GraphAnalytics(self.__driver)
         # self.__truncate_db()
 
     def close(self):
-        self.__driver.close()
+        # The driver is shared by every server of the process and closed with close_drivers()
+        pass
+
+    def create_schema(self):
+        with self.__driver.session() as session:
+            for statement in SCHEMA:
+                session.run(statement)
+            session.run(MIGRATE_RELATIONS_QUERY)
+            session.run(DELETE_NAMELESS_USERS_QUERY)
 
     def __truncate_db(self):
         with self.__driver.session() as session:
             session.run("MATCH (n) DETACH DELETE n")
 
     def registration(self, username, redis_id):
+        self.registrations([{"name": username, "redis_id": redis_id}])
+
+    def registrations(self, users: list):
+        # Every user is a dict with "name" and "redis_id"
         with self.__driver.session() as session:
-            session.run("MERGE (u:user {name: $username, redis_id: $redis_id})"
-                        "ON CREATE SET u.online = false", username=username, redis_id=redis_id)
+            session.run(REGISTRATIONS_QUERY,
+                        users=[{"name": user["name"], "redis_id": int(user["redis_id"])} for user in users])
 
     def sign_in(self, redis_id):
-        with self.__driver.session() as session:
-            session.run("MATCH (u:user {redis_id: $redis_id}) SET u.online = true", redis_id=redis_id)
+        self.set_online([redis_id], True)
 
     def sign_out(self, redis_id):
+        self.set_online([redis_id], False)
+
+    def set_online(self, redis_ids: list, online: bool):
         with self.__driver.session() as session:
-            session.run("MATCH (u:user {redis_id: $redis_id}) SET u.online = false", redis_id=redis_id)
+            session.run(SET_ONLINE_QUERY,
+                        redis_ids=[int(redis_id) for redis_id in redis_ids], online=online)
 
     def create_message(self, sender_id, consumer_id, message: dict):
+        self.create_messages([{"sender_id": sender_id, "consumer_id": consumer_id, **message}])
+
+    def create_messages(self, messages: list):
+        # Every message is a dict with "sender_id", "consumer_id", "id" and "tags", all written in one transaction.
+        # Raises ValueError when some sender or consumer isn't in Neo4j, the other messages are written.
+        rows = [{"sender_id": int(message["sender_id"]),
+                 "consumer_id": int(message["consumer_id"]),
+                 "id": int(message["id"]),
+                 "tags": list(dict.fromkeys(message["tags"]))} for message in messages]
+        if not rows:
+            return
         with self.__driver.session() as session:
-            try:
-                # session.write_transaction(self.__create_message_as_node, message["id"], message["tags"])
-                messages_id = session.write_transaction(self.__create_message_as_relation, int(sender_id),
-                                                        int(consumer_id), message["id"])
-                for tag in message["tags"]:
-                    session.write_transaction(self.__add_tag_to_messages, messages_id, tag)
-            except Exception as e:
-                View.show_error(str(e))
-
-    @staticmethod
-    def __create_message_as_relation(tx, sender_id, consumer_id, message_id):
-        result = tx.run("MATCH(a: user {redis_id: $sender_id}), (b:user {redis_id: $consumer_id})"
-                        "MERGE(a) - [r: messages]->(b)"
-                        "ON CREATE SET r.all = [$message_id], r.spam = [], r.tags = []"
-                        "ON MATCH SET r.all = r.all + $message_id "
-                        "RETURN id(r)",
-                        sender_id=sender_id, consumer_id=consumer_id, message_id=message_id)
-        return result.single()[0]
+            # session.execute_write(self.__create_message_as_node, message["id"], message["tags"])
+            written = session.execute_write(self.__create_messages_as_relations, rows)
+        if written < len(rows):
+            raise ValueError(f"{len(rows) - written} of {len(rows)} messages have a sender or consumer "
+                             f"missing in Neo4j")
 
     @staticmethod
-    def __add_tag_to_messages(tx, messages_id, tag):
-        tx.run("MATCH ()-[r]-() where ID(r) = $messages_id "
-               "FOREACH(x in CASE WHEN $tag in r.tags THEN [] ELSE [1] END | "
-               "SET r.tags = coalesce(r.tags,[]) + $tag)", messages_id=messages_id, tag=tag)
+    def __create_messages_as_relations(tx, rows):
+        return tx.run(CREATE_MESSAGES_QUERY, rows=rows).single()["written"]
 
     def deliver_message(self, redis_id):
+        self.deliver_messages([redis_id])
+
+    def deliver_messages(self, redis_ids: list):
         with self.__driver.session() as session:
-            session.run("MATCH (m:messages {redis_id: $redis_id }) SET m.delivered = true", redis_id=redis_id)
+            session.run(DELIVER_MESSAGES_QUERY, redis_ids=[int(redis_id) for redis_id in redis_ids])
 
     def mark_message_as_spam(self, redis_id):
+        self.mark_messages_as_spam([redis_id])
+
+    def mark_messages_as_spam(self, redis_ids: list):
         with self.__driver.session() as session:
-            session.run("MATCH (u1:user)-[r:messages]->(u2:user) "
-                        "WHERE $redis_id IN r.all AND NOT $redis_id IN r.spam "
-                        "SET r.spam = r.spam + $redis_id", redis_id=redis_id)
+            session.run(MARK_MESSAGES_AS_SPAM_QUERY, redis_ids=[int(redis_id) for redis_id in redis_ids])
 
     def get_users_with_tagged_messages(self, tags):
         return self.__record_to_list(self.__get_users_with_tagged_messages_from_db(tags), 'name')
 
     def get_unrelated_users_with_tagged_messages(self, tags):
-        list_of_names = self.__record_to_list(self.__get_users_with_tagged_messages_from_db(tags), 'name')
-        unrelated_users = []
-        for name1 in list_of_names:
-            group = [name1]
-            for name2 in list_of_names:
-                if name1 != name2:
-                    res = self.__check_relation_between_users(name1, name2)
-                    if not res and name1 not in group:
-                        group.append(name2)
-            unrelated_users.append(group)
-
-        return unrelated_users
-
-    def __get_users_with_tagged_messages_from_db(self, tags):
+        # For every user with messages tagged with all "tags", a group of it and the other such users it has no
+        # messages with. The users come with the names of everyone they have messages with from a single query,
+        # instead of a query per pair of users.
         with self.__driver.session() as session:
-            tags = tags.split(", ")
-            for tag in tags:
-                if not Tags.has_member(tag):
-                    raise ValueError(f"Tag: {tag} doesnt exist")
-
-            query = "MATCH (u:user)-[r:messages]-() WHERE"
-            for tag in tags:
-                query += f" \'{tag}\' IN r.tags AND"
+            res = session.run(UNRELATED_USERS_QUERY, tags=self.__parse_tags(tags))
+            users = [(record["name"], set(record["related"])) for record in res]
+        return [[name] + [other for other, _ in users if other != name and other not in related]
+                for name, related in users]
 
-            # removing last AND
-            query = query[:-3] + "RETURN u"
-            return session.run(query)
-
-    def __check_relation_between_users(self, username1, username2):
+    def __get_users_with_tagged_messages_from_db(self, tags):
         with self.__driver.session() as session:
-            res = session.run("MATCH  (u1:user {name: $username1}), (u2:user {name: $username2}) "
-                              "RETURN EXISTS((u1)-[:messages]-(u2))", username1=username1, username2=username2)
-            return res.single()[0]
+            return session.run("MATCH (u:user)-[r:messages]-() "
+                               "WHERE all(tag IN $tags WHERE tag IN r.tags) "
+                               "RETURN u", tags=self.__parse_tags(tags))
 
+    @staticmethod
+    def __parse_tags(tags):
+        tags = tags.split(", ")
+        for tag in tags:
+            if not Tags.has_member(tag):
+                raise ValueError(f"Tag: {tag} doesnt exist")
+        return tags
+
+    # Path queries run on an in-memory snapshot of the graph, enumerating paths in Cypher is exponential
     def shortest_way_between_users(self, username1, username2):
-        users = self.get_users()
-        if username1 not in users or username2 not in users:
-            raise ValueError('Invalid users names')
-        with self.__driver.session() as session:
-            shortest_path = session.run("MATCH p = shortestPath((u1:user)-[*..10]-(u2:user)) "
-                                        "WHERE u1.name = $username1 AND u2.name = $username2 "
-                                        "RETURN p", username1=username1, username2=username2)
-            if shortest_path.peek() is None:
-                raise Exception(f"Way between {username1} and {username2} doesnt exist")
-            for record in shortest_path:
-                nodes = record[0].nodes
-                path = []
-                for node in nodes:
-                    path.append(node._properties['name'])
-                return path
+        return self.__analytics.shortest_way_between_users(username1, username2)
 
     def get_users_with_n_long_relations(self, n):
-        with self.__driver.session() as session:
-            res = session.run(f"MATCH p = (u1:user)-[*]-(u2:user)"
-                              f"WHERE u1 <> u2 AND "
-                              f"reduce(total_len = 0, r IN relationships(p)| total_len + size(r.all)) = {n} "
-                              f"RETURN u1, u2")
-            return self.__pair_record_to_list(res, 'name')
+        return self.__analytics.get_users_with_n_long_relations(int(n))
 
     def get_users_wicth_have_only_spam_conversation(self):
         with self.__driver.session() as session:
             res = session.run("MATCH p = (u1:user)-[]-(u2:user)"
-                              "WHERE u1 <> u2 AND all(x in relationships(p) WHERE x.all = x.spam)"
+                              "WHERE u1 <> u2 AND all(x in relationships(p) WHERE x.total = x.spam)"
                               "RETURN u1, u2")
             return self.__pair_record_to_list(res, 'name')
 
@@ -156,3 +204,4 @@ class Neo4jServer(object):
         my_list = list(res)
         my_list = list(dict.fromkeys(my_list))
         return [el[0]._properties[pull_out_value] for el in my_list]
+
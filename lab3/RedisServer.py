@@ -1,16 +1,53 @@
 import redis
 import datetime
 import logging
+from collections import OrderedDict
+from threading import Lock
 
-from servers.neo4j_server.Neo4jServer import Neo4jServer
+from servers.neo4j_server.Neo4jReplicator import append_to_outbox
 
 logging.basicConfig(filename="./events.log", level=logging.INFO, filemode="w")
 
+# Logins of message senders kept in memory, logins never change once registered
+LOGIN_CACHE_SIZE = 10000
+
+
+class LoginCache(object):
+    # Least recently used user ids are dropped first, shared by all servers of the process
+
+    def __init__(self, size):
+        self.__size = size
+        self.__logins = OrderedDict()
+        self.__lock = Lock()
+
+    def get_logins(self, r, user_ids) -> dict:
+        logins = {}
+        with self.__lock:
+            for user_id in user_ids:
+                if user_id in self.__logins:
+                    self.__logins.move_to_end(user_id)
+                    logins[user_id] = self.__logins[user_id]
+        missing = [user_id for user_id in user_ids if user_id not in logins]
+        if missing:
+            pipeline = r.pipeline(False)
+            for user_id in missing:
+                pipeline.hget(f"user:{user_id}", "login")
+            fetched = dict(zip(missing, pipeline.execute()))
+            logins.update(fetched)
+            with self.__lock:
+                self.__logins.update(fetched)
+                while len(self.__logins) > self.__size:
+                    self.__logins.popitem(last=False)
+        return logins
+
+
+login_cache = LoginCache(LOGIN_CACHE_SIZE)
+
 
 class RedisServer(object):
-    def __init__(self, neo4j_server: Neo4jServer):
+    # Neo4j gets the changes from the outbox through Neo4jReplicator, so it doesn't slow requests down
+    def __init__(self):
         self.__r = redis.Redis(charset="utf-8", decode_responses=True)
-        self.__neo4j_server = neo4j_server
 
     def registration(self, username):
         if self.__r.hget('users:', username):
@@ -28,9 +65,8 @@ class RedisServer(object):
             'sent': 0,
             'delivered': 0
         })
-
+        append_to_outbox(pipeline, "registration", username=username, redis_id=user_id)
         pipeline.execute()
-        self.__neo4j_server.registration(username, user_id)
         logging.info(f"User {username} registered at {datetime.datetime.now()} \n")
         return user_id
 
@@ -40,17 +76,21 @@ class RedisServer(object):
         if not user_id:
             raise Exception(f"User {username} does not exist ")
 
-        self.__r.sadd("online:", username)
+        pipeline = self.__r.pipeline(True)
+        pipeline.sadd("online:", username)
+        append_to_outbox(pipeline, "sign_in", redis_id=user_id)
+        pipeline.execute()
         logging.info(f"User {username} logged in at {datetime.datetime.now()} \n")
         self.__r.publish('users', "User %s signed in" % self.__r.hmget(f"user:{user_id}", 'login')[0])
-        self.__neo4j_server.sign_in(user_id)
         return int(user_id)
 
     def sign_out(self, user_id) -> int:
         logging.info(f"User {user_id} signed out at {datetime.datetime.now()} \n")
         self.__r.publish('users', "User %s signed out" % self.__r.hmget(f"user:{user_id}", 'login')[0])
-        self.__neo4j_server.sign_out(user_id)
-        return self.__r.srem("online:", self.__r.hmget(f"user:{user_id}", 'login')[0])
+        pipeline = self.__r.pipeline(True)
+        pipeline.srem("online:", self.__r.hmget(f"user:{user_id}", 'login')[0])
+        append_to_outbox(pipeline, "sign_out", redis_id=user_id)
+        return pipeline.execute()[0]
 
     def create_message(self, message_text, tags: list, consumer, sender_id) -> int:
 
@@ -76,26 +116,37 @@ class RedisServer(object):
         })
         pipeline.zincrby("sent:", 1, "user:%s" % self.__r.hmget(f"user:{sender_id}", 'login')[0])
         pipeline.hincrby(f"user:{sender_id}", "queue", 1)
+        append_to_outbox(pipeline, "message", sender_id=sender_id, consumer_id=consumer_id, id=message_id,
+                         tags=','.join(tags))
         pipeline.execute()
-
-        self.__neo4j_server.create_message(sender_id, consumer_id, {"id": message_id, "tags": tags})
         return message_id
 
-    def get_messages(self, user_id):
-        messages = self.__r.smembers(f"sentto:{user_id}")
+    def get_messages(self, user_id, offset=0, count=None):
+        # Oldest first, "count" messages from "offset" or all of them. The page and the fields of its messages
+        # come in a single SORT, the senders' logins from the cache or one pipeline.
+        page = {} if count is None else {"start": int(offset), "num": int(count)}
+        messages = self.__r.sort(f"sentto:{user_id}", **page,
+                                 get=["#", "message:*->sender_id", "message:*->text", "message:*->status"],
+                                 groups=True)
+        logins = login_cache.get_logins(self.__r, list({sender_id for _, sender_id, _, _ in messages}))
         messages_list = []
-        for message_id in messages:
-            message = self.__r.hmget(f"message:{message_id}", ["sender_id", "text", "status", "tags"])
-            sender_id = message[0]
-            messages_list.append("From: %s - %s" % (self.__r.hmget("user:%s" % sender_id, 'login')[0], message[1]))
-            # messages_list.append("From: %s - %s, tags: %s" % (self.__r.hmget("user:%s" % sender_id, 'login')[0], message[1], message[3]))
-            if message[2] != "delivered":
-                pipeline = self.__r.pipeline(True)
-                pipeline.hset(f"message:{message_id}", "status", "delivered")
-                pipeline.hincrby(f"user:{sender_id}", "sent", -1)
-                pipeline.hincrby(f"user:{sender_id}", "delivered", 1)
-                pipeline.execute()
-                self.__neo4j_server.deliver_message(message_id)
+        # sender id -> messages delivered now
+        delivered = {}
+        for message_id, sender_id, text, status in messages:
+            messages_list.append("From: %s - %s" % (logins[sender_id], text))
+            if status != "delivered":
+                delivered.setdefault(sender_id, []).append(message_id)
+
+        if delivered:
+            # The deliveries are consecutive in the outbox, so Neo4j gets them in a single update
+            pipeline = self.__r.pipeline(True)
+            for sender_id, message_ids in delivered.items():
+                for message_id in message_ids:
+                    pipeline.hset(f"message:{message_id}", "status", "delivered")
+                    append_to_outbox(pipeline, "delivered", id=message_id)
+                pipeline.hincrby(f"user:{sender_id}", "sent", -len(message_ids))
+                pipeline.hincrby(f"user:{sender_id}", "delivered", len(message_ids))
+            pipeline.execute()
 
         return messages_list
 
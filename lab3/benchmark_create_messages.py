@@ -0,0 +1,61 @@
+import argparse
+import random
+import time
+
+from servers.neo4j_server.Neo4jDriver import close_drivers, get_driver, get_pool_stats
+from servers.neo4j_server.Neo4jServer import Neo4jServer
+from controller.Controller import Tags
+
+# Benchmark users and messages get redis ids from here on, so they don't collide with the emulated ones
+FIRST_REDIS_ID = 1_000_000_000
+
+
+def create_users(server: Neo4jServer, users_count):
+    redis_ids = list(range(FIRST_REDIS_ID, FIRST_REDIS_ID + users_count))
+    server.registrations([{"name": f"benchmark_user_{redis_id}", "redis_id": redis_id} for redis_id in redis_ids])
+    return redis_ids
+
+
+def delete_users():
+    with get_driver().session() as session:
+        for label in ("user", "message"):
+            session.run(f"MATCH (n:{label}) WHERE n.redis_id >= $first_redis_id DETACH DELETE n",
+                        first_redis_id=FIRST_REDIS_ID)
+
+
+def get_random_messages(redis_ids, messages_count, first_message_id):
+    tags = [tag.name for tag in Tags]
+    return [{"sender_id": random.choice(redis_ids),
+             "consumer_id": random.choice(redis_ids),
+             "id": FIRST_REDIS_ID + first_message_id + i,
+             "tags": random.sample(tags, random.randint(0, len(tags)))} for i in range(messages_count)]
+
+
+def measure(server: Neo4jServer, messages, batch_size):
+    started_at = time.perf_counter()
+    if batch_size == 1:
+        for message in messages:
+            server.create_message(message["sender_id"], message["consumer_id"], message)
+    else:
+        for i in range(0, len(messages), batch_size):
+            server.create_messages(messages[i:i + batch_size])
+    return len(messages) / (time.perf_counter() - started_at)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Messages per second written by Neo4jServer at different batch sizes")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 100, 1000])
+    args = parser.parse_args()
+
+    server = Neo4jServer()
+    try:
+        redis_ids = create_users(server, args.users)
+        for number, batch_size in enumerate(args.batch_sizes):
+            messages = get_random_messages(redis_ids, args.messages, number * args.messages)
+            print(f"batch size {batch_size:>5}: {measure(server, messages, batch_size):>10.1f} messages/s")
+    finally:
+        delete_users()
+        print(get_pool_stats())
+        close_drivers()
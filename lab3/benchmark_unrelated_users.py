@@ -0,0 +1,64 @@
+import argparse
+import random
+import time
+
+from benchmark_create_messages import FIRST_REDIS_ID, create_users, delete_users
+from servers.neo4j_server.Neo4jDriver import close_drivers, get_driver
+from servers.neo4j_server.Neo4jServer import Neo4jServer
+
+
+def create_tagged_messages(server: Neo4jServer, redis_ids, messages_per_user):
+    # Every user sends "work" messages, so every user is in the result
+    messages = [{"sender_id": sender_id, "consumer_id": random.choice(redis_ids), "id": FIRST_REDIS_ID + number,
+                 "tags": ["work"]}
+                for number, sender_id in enumerate(redis_ids * messages_per_user)]
+    for i in range(0, len(messages), 1000):
+        server.create_messages(messages[i:i + 1000])
+
+
+def get_groups_pairwise(names):
+    # The previous implementation, with a query per pair of users. It checked whether name1 was in the group
+    # instead of name2, so every group had a single user, here it checks name2.
+    unrelated_users = []
+    with get_driver().session() as session:
+        for name1 in names:
+            group = [name1]
+            for name2 in names:
+                if name1 != name2:
+                    res = session.run("MATCH (u1:user {name: $name1}), (u2:user {name: $name2}) "
+                                      "RETURN EXISTS((u1)-[:messages]-(u2))", name1=name1, name2=name2).single()[0]
+                    if not res and name2 not in group:
+                        group.append(name2)
+            unrelated_users.append(group)
+    return unrelated_users
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time of get_unrelated_users_with_tagged_messages by number of users")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--messages-per-user", type=int, default=3)
+    parser.add_argument("--pairwise-up-to", type=int, default=100,
+                        help="Also time the previous implementation and compare the groups up to this many users")
+    args = parser.parse_args()
+
+    server = Neo4jServer()
+    try:
+        for size in args.sizes:
+            redis_ids = create_users(server, size)
+            create_tagged_messages(server, redis_ids, args.messages_per_user)
+
+            started_at = time.perf_counter()
+            groups = server.get_unrelated_users_with_tagged_messages("work")
+            seconds = time.perf_counter() - started_at
+            report = f"{size:>6} users: {seconds:>9.3f}s, {sum(len(group) for group in groups)} names in groups"
+
+            if size <= args.pairwise_up_to:
+                started_at = time.perf_counter()
+                pairwise_groups = get_groups_pairwise([group[0] for group in groups])
+                report += f", pairwise {time.perf_counter() - started_at:.3f}s"
+                report += ", same groups" if pairwise_groups == groups else ", DIFFERENT GROUPS"
+            print(report)
+            delete_users()
+    finally:
+        delete_users()
+        close_drivers()
@@ -0,0 +1,45 @@
+import argparse
+import time
+
+import redis
+
+from servers.redis_server.RedisServer import RedisServer
+from worker import Worker
+
+# Queues messages of its own users in the local Redis and processes them with a worker, other workers
+# running at the same time would take some of them.
+
+
+def queue_messages(server: RedisServer, users_count, messages_count):
+    users = [f"benchmark_user_{time.time_ns()}_{i}" for i in range(users_count)]
+    user_ids = [server.registration(user) for user in users]
+    for i in range(messages_count):
+        server.create_message(f"message {i}", ["work"], users[i % users_count], user_ids[(i + 1) % users_count])
+    return user_ids
+
+
+def wait_until_processed(r, user_ids):
+    while True:
+        pipeline = r.pipeline(False)
+        for user_id in user_ids:
+            pipeline.hmget(f"user:{user_id}", ["queue", "checking"])
+        if all(int(queue) == 0 and int(checking) == 0 for queue, checking in pipeline.execute()):
+            return
+        time.sleep(0.001)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Messages per second processed by one worker")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=10)
+    args = parser.parse_args()
+
+    r = redis.Redis(charset="utf-8", decode_responses=True)
+    user_ids = queue_messages(RedisServer(), args.users, args.messages)
+
+    started_at = time.perf_counter()
+    worker = Worker(0)
+    worker.setDaemon(True)
+    worker.start()
+    wait_until_processed(r, user_ids)
+    print(f"{args.messages / (time.perf_counter() - started_at):.1f} messages/s")
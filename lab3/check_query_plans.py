@@ -0,0 +1,47 @@
+import sys
+
+from servers.neo4j_server.Neo4jDriver import close_drivers, get_driver
+from servers.neo4j_server.Neo4jServer import (CREATE_MESSAGES_QUERY, DELIVER_MESSAGES_QUERY,
+                                              MARK_MESSAGES_AS_SPAM_QUERY, REGISTRATIONS_QUERY, SET_ONLINE_QUERY,
+                                              Neo4jServer)
+
+# Queries looking users and messages up by redis_id, with parameters to plan them with
+QUERIES = {
+    "registrations": (REGISTRATIONS_QUERY, {"users": [{"name": "user", "redis_id": 1}]}),
+    "set_online": (SET_ONLINE_QUERY, {"redis_ids": [1], "online": True}),
+    "create_messages": (CREATE_MESSAGES_QUERY, {"rows": [{"sender_id": 1, "consumer_id": 2, "id": 1, "tags": []}]}),
+    "mark_messages_as_spam": (MARK_MESSAGES_AS_SPAM_QUERY, {"redis_ids": [1]}),
+    "deliver_messages": (DELIVER_MESSAGES_QUERY, {"redis_ids": [1]}),
+}
+
+SCANS = {"AllNodesScan", "NodeByLabelScan"}
+
+
+def get_operators(plan) -> list:
+    # Neo4j 5 names operators like "NodeUniqueIndexSeek@neo4j"
+    operators = [plan["operatorType"].split("@")[0]]
+    for child in plan.get("children", []):
+        operators += get_operators(child)
+    return operators
+
+
+def check_plan(session, query, parameters) -> list:
+    plan = session.run("EXPLAIN " + query, parameters).consume().plan
+    operators = get_operators(plan)
+    problems = [f"{operator} instead of an index seek" for operator in operators if operator in SCANS]
+    if not any("IndexSeek" in operator for operator in operators):
+        problems.append(f"no index seek in {', '.join(operators)}")
+    return problems
+
+
+if __name__ == '__main__':
+    # EXPLAIN only plans the queries, nothing is written
+    Neo4jServer().create_schema()
+    failed = False
+    with get_driver().session() as session:
+        for name, (query, parameters) in QUERIES.items():
+            problems = check_plan(session, query, parameters)
+            print(f"{name}: {'; '.join(problems) if problems else 'index seeks only'}")
+            failed = failed or bool(problems)
+    close_drivers()
+    sys.exit(1 if failed else 0)
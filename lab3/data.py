@@ -9,6 +9,7 @@ menu_list = {
         'Find the shortest way on graph through messages': Neo4jController.shortest_way_between_users,
         'Find authors that are marked "spam"': Neo4jController.get_users_which_have_only_spam_conversation,
         'Find unrelated users that have tagged messages': Neo4jController.get_unrelated_users_with_tagged_messages,
+        'Show Neo4j connection pool usage': Neo4jController.show_pool_stats,
         'Назад': Controller.stop_loop,
     }
 }
@@ -1,6 +1,8 @@
 from controller.Controller import Controller
 from controller.EmulationController import EmulationController
 from controller.Neo4jController import Neo4jController
+from servers.neo4j_server.Neo4jReplicator import Neo4jReplicator
+from servers.neo4j_server.Neo4jServer import Neo4jServer
 from view import View
 from faker import Faker
 import random
@@ -12,6 +14,11 @@ def emulation():
     users_count = 5
     users = [fake.profile(fields=['username'], sex=None)['username'] for u in range(users_count)]
     threads = []
+    # Copies what the emulated users do to Neo4j while they run, whatever is left is picked up by the next replicator.
+    # While a standalone replicator runs, this one waits for the outbox lock instead.
+    replicator = Neo4jReplicator(Neo4jServer())
+    replicator.setDaemon(True)
+    replicator.start()
     try:
 
         for i in range(users_count):
@@ -28,6 +35,7 @@ def emulation():
 
 
 if __name__ == "__main__":
+    Neo4jServer().create_schema()
     choice = Controller.make_choice(["Using Neo4j", "Emulation"], "Выберите: ")
     if choice == 0:
         Neo4jController()
@@ -0,0 +1,220 @@
+import argparse
+import logging
+import math
+import multiprocessing
+import os
+import random
+import signal
+import threading
+import time
+import uuid
+
+import redis
+
+from view import View
+from worker import Worker, recover_messages
+
+# Queued messages per running worker the supervisor aims for
+MESSAGES_PER_WORKER = 500
+# How often the queue length is checked and the workers scaled, in seconds
+CHECK_INTERVAL = 1
+# How often the throughput of every worker is reported, in seconds
+REPORT_INTERVAL = 10
+# How long stopped workers get to finish their batches when the supervisor exits, in seconds. The ones still
+# running after it are killed and their messages queued again.
+SHUTDOWN_TIMEOUT = 10
+
+
+def run_worker_process(delay, worker_id, stop_event, processed):
+    # Only the supervisor handles the signals, its workers finish their batch and exit when it says so
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker = Worker(delay, worker_id=worker_id)
+    worker.start()
+    while not stop_event.wait(CHECK_INTERVAL):
+        processed.value = worker.processed
+    worker.stop()
+    worker.join()
+    processed.value = worker.processed
+
+
+class WorkerThread(object):
+    def __init__(self, delay):
+        self.__worker = Worker(delay)
+        # Threads can't be killed, they end with the supervisor
+        self.__worker.daemon = True
+        self.worker_id = self.__worker.worker_id
+        self.name = self.__worker.name
+
+    def start(self):
+        self.__worker.start()
+
+    def stop(self):
+        self.__worker.stop()
+
+    def kill(self):
+        pass
+
+    def join(self, timeout=None):
+        self.__worker.join(timeout)
+
+    def is_alive(self):
+        return self.__worker.is_alive()
+
+    def get_processed(self):
+        return self.__worker.processed
+
+
+class WorkerProcess(object):
+    def __init__(self, delay):
+        self.__stop_event = multiprocessing.Event()
+        self.__processed = multiprocessing.Value("l", 0)
+        self.worker_id = uuid.uuid4().hex
+        self.__process = multiprocessing.Process(target=run_worker_process,
+                                                 args=(delay, self.worker_id, self.__stop_event, self.__processed))
+        self.name = None
+
+    def start(self):
+        self.__process.start()
+        self.name = f"process {self.__process.pid}"
+
+    def stop(self):
+        self.__stop_event.set()
+
+    def kill(self):
+        self.__process.kill()
+
+    def join(self, timeout=None):
+        self.__process.join(timeout)
+
+    def is_alive(self):
+        return self.__process.is_alive()
+
+    def get_processed(self):
+        return self.__processed.value
+
+
+class Supervisor(object):
+    # Runs between min_workers and max_workers workers, as many as the queue length needs, until SIGTERM or
+    # SIGINT, then lets every worker finish the messages it has claimed. Workers that die are replaced, and the
+    # messages they had taken are queued again.
+
+    def __init__(self, min_workers, max_workers, use_processes=True, delay=None,
+                 messages_per_worker=MESSAGES_PER_WORKER):
+        self.__r = redis.Redis(charset="utf-8", decode_responses=True)
+        self.__min_workers = min_workers
+        self.__max_workers = max_workers
+        self.__use_processes = use_processes
+        self.__delay = delay
+        self.__messages_per_worker = messages_per_worker
+        self.__workers = []
+        # Workers told to stop, finishing their batches
+        self.__stopped_workers = []
+        # processed messages of every worker at the last report
+        self.__reported = {}
+        self.__stopping = threading.Event()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda *args: self.__stopping.set())
+        signal.signal(signal.SIGINT, lambda *args: self.__stopping.set())
+        reported_at = time.monotonic()
+        while not self.__stopping.is_set():
+            self.__reap()
+            self.__scale()
+            if time.monotonic() - reported_at >= REPORT_INTERVAL:
+                self.__report(time.monotonic() - reported_at)
+                reported_at = time.monotonic()
+            self.__stopping.wait(CHECK_INTERVAL)
+
+        View.show_text(f"Stopping {len(self.__workers)} workers")
+        self.__report(time.monotonic() - reported_at)
+        self.__stop_workers(len(self.__workers))
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while self.__stopped_workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.__reap()
+        for worker in self.__stopped_workers:
+            View.show_error(f"Worker {worker.name} didn't stop in {SHUTDOWN_TIMEOUT} seconds, killing it")
+            worker.kill()
+            worker.join(1)
+            self.__finish_worker(worker)
+        self.__stopped_workers = []
+
+    def __scale(self):
+        queue_length = self.__r.llen("queue:")
+        wanted = math.ceil(queue_length / self.__messages_per_worker)
+        wanted = max(self.__min_workers, min(self.__max_workers, wanted))
+        if wanted > len(self.__workers):
+            for _ in range(wanted - len(self.__workers)):
+                self.__start_worker()
+        elif wanted < len(self.__workers):
+            self.__stop_workers(len(self.__workers) - wanted)
+        else:
+            return
+        logging.info(f"{queue_length} messages queued, running {len(self.__workers)} workers at {time.ctime()} \n")
+
+    def __start_worker(self):
+        # Checks take from 0 to 3 seconds, unless a delay is given
+        delay = self.__delay if self.__delay is not None else random.randint(0, 3)
+        worker = WorkerProcess(delay) if self.__use_processes else WorkerThread(delay)
+        worker.start()
+        self.__workers.append(worker)
+
+    def __stop_workers(self, count):
+        # The newest workers go first, each one finishes its batch before it exits. They are reaped later,
+        # scaling doesn't wait for them.
+        stopped = self.__workers[len(self.__workers) - count:]
+        del self.__workers[len(self.__workers) - count:]
+        for worker in stopped:
+            worker.stop()
+        self.__stopped_workers += stopped
+
+    def __reap(self):
+        # Workers that died are dropped and replaced by the next scaling, stopped ones are dropped once they exit
+        for worker in [worker for worker in self.__workers if not worker.is_alive()]:
+            View.show_error(f"Worker {worker.name} died")
+            self.__workers.remove(worker)
+            self.__finish_worker(worker)
+        for worker in [worker for worker in self.__stopped_workers if not worker.is_alive()]:
+            self.__stopped_workers.remove(worker)
+            worker.join()
+            self.__finish_worker(worker)
+
+    def __finish_worker(self, worker):
+        # A worker that exited normally has nothing left to queue again
+        recovered = recover_messages(self.__r, worker.worker_id)
+        if recovered:
+            View.show_text(f"Queued {recovered} messages of worker {worker.name} again")
+        self.__report_worker(worker, None)
+
+    def __report(self, seconds):
+        for worker in self.__workers:
+            self.__report_worker(worker, seconds)
+
+    def __report_worker(self, worker, seconds):
+        processed = worker.get_processed()
+        new = processed - self.__reported.get(worker.name, 0)
+        if seconds is None:
+            View.show_text(f"Worker {worker.name} stopped after {processed} messages")
+            self.__reported.pop(worker.name, None)
+        else:
+            View.show_text(f"Worker {worker.name}: {new / seconds:.1f} messages/s, {processed} in total")
+            self.__reported[worker.name] = processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run spam check workers, as many as the queue needs")
+    parser.add_argument("--min-workers", type=int, default=1)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads", action="store_true", help="Run workers as threads of this process")
+    parser.add_argument("--delay", type=float, help="Seconds every check takes, random from 0 to 3 by default")
+    parser.add_argument("--messages-per-worker", type=int, default=MESSAGES_PER_WORKER)
+    args = parser.parse_args()
+    try:
+        Supervisor(args.min_workers, args.max_workers, not args.threads, args.delay, args.messages_per_worker).run()
+    except Exception as e:
+        View.show_error(str(e))
+
+
+if __name__ == '__main__':
+    main()
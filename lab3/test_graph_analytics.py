@@ -0,0 +1,113 @@
+import itertools
+import random
+
+from servers.neo4j_server import GraphAnalytics as graph_analytics
+from servers.neo4j_server.GraphAnalytics import GRAPH_VERSION_QUERY, USERS_QUERY, GraphAnalytics
+
+
+class FakeResult(object):
+
+    def __init__(self, records: list):
+        self.records = records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def single(self):
+        return self.records[0]
+
+
+class FakeDriver(object):
+    # Answers the queries of GraphAnalytics from a list of (sender, consumer, messages) relations
+
+    def __init__(self, relations: list):
+        self.relations = relations
+        self.queries = []
+
+    def session(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def run(self, query):
+        self.queries.append(query)
+        names = sorted({name for sender, consumer, _ in self.relations for name in (sender, consumer)})
+        if query == GRAPH_VERSION_QUERY:
+            return FakeResult([(len(self.relations), len(names))])
+        if query == USERS_QUERY:
+            return FakeResult([{"redis_id": name, "name": name} for name in names])
+        return FakeResult([{"sender_id": sender, "consumer_id": consumer, "total": total}
+                           for sender, consumer, total in self.relations])
+
+
+def cypher_n_long_relations(relations: list, n) -> set:
+    # What MATCH p = (u1:user)-[*]-(u2:user) WHERE u1 <> u2 AND <messages on p> = n returns: every trail,
+    # a way through each relation at most once, in both directions
+    pairs = set()
+    names = {name for sender, consumer, _ in relations for name in (sender, consumer)}
+
+    def walk(user, first, weight, used):
+        if weight == n and user != first:
+            pairs.add(frozenset((first, user)))
+        for index, (sender, consumer, total) in enumerate(relations):
+            if index in used or user not in (sender, consumer):
+                continue
+            walk(consumer if user == sender else sender, first, weight + total, used | {index})
+
+    for name in names:
+        walk(name, name, 0, frozenset())
+    return pairs
+
+
+def n_long_relations(relations: list, n) -> set:
+    return {frozenset(pair) for pair in GraphAnalytics(FakeDriver(relations)).get_users_with_n_long_relations(n)}
+
+
+def test_relation_is_not_reused():
+    relations = [("a", "b", 1)]
+    assert n_long_relations(relations, 1) == {frozenset("ab")}
+    assert n_long_relations(relations, 3) == set()
+
+
+def test_triangle_matches_cypher():
+    relations = [("a", "b", 1), ("b", "c", 2), ("c", "a", 1)]
+    assert n_long_relations(relations, 1) == {frozenset("ab"), frozenset("ac")}
+    assert n_long_relations(relations, 2) == {frozenset("bc")}
+    assert n_long_relations(relations, 3) == {frozenset("ab"), frozenset("ac")}
+    assert n_long_relations(relations, 4) == set()
+
+
+def test_random_graphs_match_cypher():
+    generator = random.Random(7)
+    for _ in range(30):
+        names = "abcdef"[:generator.randint(2, 6)]
+        pairs = [pair for pair in itertools.permutations(names, 2) if generator.random() < 0.3]
+        relations = [(sender, consumer, generator.randint(1, 3)) for sender, consumer in pairs]
+        for n in range(1, 8):
+            assert n_long_relations(relations, n) == cypher_n_long_relations(relations, n)
+
+
+def test_shortest_way():
+    analytics = GraphAnalytics(FakeDriver([("a", "b", 1), ("b", "c", 1), ("c", "d", 5), ("a", "d", 1)]))
+    assert analytics.shortest_way_between_users("a", "c") == ["a", "b", "c"]
+    assert analytics.shortest_way_between_users("b", "d") == ["b", "a", "d"]
+
+
+def test_snapshot_is_exported_again_for_new_relations_and_old_weights(monkeypatch):
+    driver = FakeDriver([("a", "b", 1)])
+    analytics = GraphAnalytics(driver)
+    analytics.shortest_way_between_users("a", "b")
+    driver.relations[0] = ("a", "b", 2)
+    # Only the number of messages changed, shortest ways don't depend on it
+    assert analytics.shortest_way_between_users("a", "b") == ["a", "b"]
+    assert driver.queries.count(USERS_QUERY) == 1
+    monkeypatch.setattr(graph_analytics, "MAX_WEIGHTS_AGE", 0)
+    assert analytics.get_users_with_n_long_relations(2) == [["a", "b"]]
+    assert driver.queries.count(USERS_QUERY) == 2
+    driver.relations.append(("b", "c", 1))
+    assert analytics.shortest_way_between_users("a", "c") == ["a", "b", "c"]
+    assert driver.queries.count(USERS_QUERY) == 3
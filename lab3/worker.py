@@ -1,74 +1,144 @@
 import random
-import threading
 import time
+import uuid
 from threading import Thread
 import redis
 
-from servers.neo4j_server.Neo4jServer import Neo4jServer
-from view import View
+from servers.neo4j_server.Neo4jReplicator import append_to_outbox
+
+
+# Moves up to ARGV[1] more ids from the queue (KEYS[1]) to the worker's processing list (KEYS[2]), returns the list
+CLAIM_SCRIPT = """
+for i = 1, tonumber(ARGV[1]) do
+    local message_id = redis.call('RPOP', KEYS[1])
+    if not message_id then
+        break
+    end
+    redis.call('RPUSH', KEYS[2], message_id)
+end
+return redis.call('LRANGE', KEYS[2], 0, -1)
+"""
+
+# Moves the messages ARGV[i] to checking. KEYS[i] is the hash of message ARGV[i] and KEYS[#ARGV + i] the hash of
+# its sender. Returns for every message its id, sender id, consumer id, text and the sender's login, leaves out
+# messages whose hash is gone.
+CHECK_SCRIPT = """
+local checked = {}
+for i, message_id in ipairs(ARGV) do
+    local message = redis.call('HMGET', KEYS[i], 'sender_id', 'consumer_id', 'text')
+    if message[1] then
+        local user_key = KEYS[#ARGV + i]
+        redis.call('HSET', KEYS[i], 'status', 'checking')
+        redis.call('HINCRBY', user_key, 'queue', -1)
+        redis.call('HINCRBY', user_key, 'checking', 1)
+        local login = redis.call('HGET', user_key, 'login') or ''
+        checked[#checked + 1] = {message_id, message[1], message[2] or '', message[3] or '', login}
+    end
+end
+return checked
+"""
+
+# Puts the messages ARGV[i] of a worker's processing list (KEYS[2]) back at the head of the queue (KEYS[1]).
+# KEYS[2 + i] is the hash of message ARGV[i] and KEYS[2 + #ARGV + i] the hash of its sender. Returns their number.
+RECOVER_SCRIPT = """
+for i = #ARGV, 1, -1 do
+    if redis.call('HGET', KEYS[2 + i], 'status') == 'checking' then
+        redis.call('HSET', KEYS[2 + i], 'status', 'queue')
+        local user_key = KEYS[2 + #ARGV + i]
+        redis.call('HINCRBY', user_key, 'checking', -1)
+        redis.call('HINCRBY', user_key, 'queue', 1)
+    end
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+redis.call('DEL', KEYS[2])
+return #ARGV
+"""
+
+# Messages a worker takes from the queue at once, at most
+BATCH_SIZE = 100
+# Longest a batch is held, in seconds of checks. Slow checks take smaller batches, so no message waits long
+# and the other workers get some of a short queue.
+MAX_BATCH_SECONDS = 1
+# How long a worker waits on an empty queue before checking whether it was stopped, in seconds
+POP_TIMEOUT = 1
+
+
+def get_processing_list_name(worker_id):
+    # Messages taken from the queue by the worker and not finished yet
+    return f"processing:{worker_id}"
+
+
+def get_message_keys(r, message_ids: list) -> tuple:
+    # The ids of the messages that still have a hash, and the keys of the hashes of these messages and of their
+    # senders, for the scripts that change both. Senders never change, so they are read before the script.
+    pipeline = r.pipeline(False)
+    for message_id in message_ids:
+        pipeline.hget(f"message:{message_id}", "sender_id")
+    found = [(message_id, sender_id) for message_id, sender_id in zip(message_ids, pipeline.execute())
+             if sender_id is not None]
+    return ([message_id for message_id, _ in found],
+            [f"message:{message_id}" for message_id, _ in found] + [f"user:{sender_id}" for _, sender_id in found])
+
+
+def recover_messages(r, worker_id) -> int:
+    # For workers that died or were killed with messages taken from the queue. Messages whose hash is gone
+    # are dropped.
+    processing = get_processing_list_name(worker_id)
+    message_ids, keys = get_message_keys(r, r.lrange(processing, 0, -1))
+    return r.register_script(RECOVER_SCRIPT)(keys=["queue:", processing, *keys], args=message_ids)
 
 
 class Worker(Thread):
 
-    def __init__(self, delay, neo4j_server: Neo4jServer):
+    def __init__(self, delay, batch_size=BATCH_SIZE, worker_id=None):
         Thread.__init__(self)
-        self.__neo4j_server = neo4j_server
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self.__processing = get_processing_list_name(self.worker_id)
         self.__loop = True
         self.__r = redis.Redis(charset="utf-8", decode_responses=True)
+        self.__claim = self.__r.register_script(CLAIM_SCRIPT)
+        self.__check = self.__r.register_script(CHECK_SCRIPT)
         self.__delay = delay
+        self.__batch_size = batch_size if not delay else max(1, min(batch_size, int(MAX_BATCH_SECONDS / delay)))
+        self.processed = 0
 
     def run(self):
         while self.__loop:
-            message = self.__r.brpop("queue:")
-            if message:
-                message_id = int(message[1])
-
-                self.__r.hmset(f"message:{message_id}", {
-                    'status': 'checking'
-                })
-                message = self.__r.hmget(f"message:{message_id}", ["sender_id", "consumer_id"])
-                sender_id = int(message[0])
-                consumer_id = int(message[1])
-                self.__r.hincrby(f"user:{sender_id}", "queue", -1)
-                self.__r.hincrby(f"user:{sender_id}", "checking", 1)
-                time.sleep(self.__delay)
-                is_spam = random.random() > 0.6
-                pipeline = self.__r.pipeline(True)
-                pipeline.hincrby(f"user:{sender_id}", "checking", -1)
-                if is_spam:
-                    sender_username = self.__r.hmget(f"user:{sender_id}", 'login')[0]
-                    pipeline.zincrby("spam:", 1, f"user:{sender_username}")
-                    pipeline.hmset(f"message:{message_id}", {
-                        'status': 'blocked'
-                    })
-                    pipeline.hincrby(f"user:{sender_id}", "blocked", 1)
-                    pipeline.publish('spam', f"User {sender_username} sent spam message: \"%s\"" %
-                                     self.__r.hmget("message:%s" % message_id, ["text"])[0])
-                    print(f"User {sender_username} sent spam message: \"%s\"" % self.__r.hmget("message:%s" % message_id, ["text"])[0])
-                    self.__neo4j_server.mark_message_as_spam(message_id)
-                else:
-                    pipeline.hmset(f"message:{message_id}", {
-                        'status': 'sent'
-                    })
-                    pipeline.hincrby(f"user:{sender_id}", "sent", 1)
-                    pipeline.sadd(f"sentto:{consumer_id}", message_id)
-                pipeline.execute()
+            # Up to a batch of the oldest messages, blocks only while the queue is empty. Taken messages stay in
+            # the processing list until they are finished, so recover_messages can queue them again.
+            # A claimed batch is always finished, stop() takes effect after it.
+            if self.__r.blmove("queue:", self.__processing, POP_TIMEOUT, "RIGHT", "RIGHT"):
+                message_ids = self.__claim(keys=["queue:", self.__processing], args=[self.__batch_size - 1])
+                message_ids, keys = get_message_keys(self.__r, message_ids)
+                messages = self.__check(keys=keys, args=message_ids) if message_ids else []
+                self.__process(messages)
+                self.processed += len(messages)
+
+    def __process(self, messages):
+        # All the messages are finished in a single MULTI, with their spam marks for Neo4j
+        pipeline = self.__r.pipeline(True)
+        for message_id, sender_id, consumer_id, text, sender_username in messages:
+            time.sleep(self.__delay)
+            is_spam = random.random() > 0.6
+            pipeline.hincrby(f"user:{sender_id}", "checking", -1)
+            if is_spam:
+                pipeline.zincrby("spam:", 1, f"user:{sender_username}")
+                pipeline.hset(f"message:{message_id}", "status", "blocked")
+                pipeline.hincrby(f"user:{sender_id}", "blocked", 1)
+                pipeline.publish('spam', f"User {sender_username} sent spam message: \"%s\"" % text)
+                # After the message itself in the outbox, so Neo4j has its node by then
+                append_to_outbox(pipeline, "spam", id=message_id)
+            else:
+                pipeline.hset(f"message:{message_id}", "status", "sent")
+                pipeline.hincrby(f"user:{sender_id}", "sent", 1)
+                pipeline.sadd(f"sentto:{consumer_id}", message_id)
+        pipeline.delete(self.__processing)
+        pipeline.execute()
 
     def stop(self):
         self.__loop = False
 
 
 if __name__ == '__main__':
-    try:
-        loop = True
-        workers_count = 5
-        workers = []
-        for x in range(workers_count):
-            worker = Worker(random.randint(0, 3), Neo4jServer())
-            worker.setDaemon(True)
-            workers.append(worker)
-            worker.start()
-        while True:
-            pass
-    except Exception as e:
-        View.show_error(str(e))
+    from supervisor import main
+    main()